@@ -0,0 +1,193 @@
+"""
+このファイルは、LLMの回答（回答本文と参照元の文脈）をキャッシュする処理が記述されたファイルです。
+- キーは「モード + 正規化した独立した質問 + モデル設定 + インデックスのバージョン」のハッシュ値
+- データソースが変わるとインデックスのバージョンが変わるため、古い回答は自動的に使われなくなる
+- メモリ上はLRU（件数上限）+ TTL（有効期限）で管理し、必要に応じてローカルのSQLiteにも保存する
+- SQLiteファイルの有効期限切れの回答は、起動時と一定間隔の保存時にまとめて削除し、取得時に見つけた場合もその場で削除する
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from langchain_core.documents import Document
+import constants as ct
+
+
+############################################################
+# 関数定義
+############################################################
+
+def normalize_question(question):
+    """
+    質問文の正規化（全角・半角、大文字・小文字、空白、末尾の句読点の違いを吸収）
+
+    Args:
+        question: 質問文
+
+    Returns:
+        正規化した質問文
+    """
+    normalized = unicodedata.normalize("NFKC", question).lower()
+    normalized = re.sub(r"\s+", " ", normalized).strip()
+    return normalized.rstrip("?？!！。.、, ")
+
+
+def build_cache_key(mode, question, model_settings, index_version):
+    """
+    回答キャッシュのキーの算出
+
+    Args:
+        mode: 回答モード
+        question: 独立した質問（会話履歴なしでも理解できる質問文）
+        model_settings: モデル名・温度・プロンプトなど、回答内容に影響する設定
+        index_version: インデックスのバージョン
+
+    Returns:
+        キャッシュキー
+    """
+    payload = json.dumps(
+        [mode, normalize_question(question), model_settings, index_version],
+        ensure_ascii=False,
+        sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+############################################################
+# クラス定義
+############################################################
+
+class AnswerCache:
+    """
+    LRU + TTL の回答キャッシュ（スレッドセーフ。全セッションで共有する）
+    """
+
+    def __init__(
+        self,
+        max_entries=ct.ANSWER_CACHE_MAX_ENTRIES,
+        ttl_seconds=ct.ANSWER_CACHE_TTL_SECONDS,
+        persist_path=ct.ANSWER_CACHE_PERSIST_PATH,
+        purge_interval_seconds=ct.ANSWER_CACHE_PURGE_INTERVAL_SECONDS
+    ):
+        """
+        Args:
+            max_entries: メモリ上に保持する最大件数
+            ttl_seconds: 回答の有効期限（秒）
+            persist_path: 保存先のSQLiteファイルのパス（None の場合はメモリ上のみ）
+            purge_interval_seconds: 有効期限切れの回答をSQLiteファイルから削除する間隔（秒）
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.purge_interval_seconds = purge_interval_seconds
+        self._purged_at = 0.0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._conn = None
+        if persist_path:
+            persist_dir = os.path.dirname(persist_path)
+            if persist_dir:
+                os.makedirs(persist_dir, exist_ok=True)
+            self._conn = sqlite3.connect(persist_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, created_at REAL NOT NULL, value TEXT NOT NULL)"
+            )
+            # 有効期限切れの回答の削除で、全件を走査しないための索引
+            self._conn.execute("CREATE INDEX IF NOT EXISTS answers_created_at ON answers (created_at)")
+            # 前回までのプロセスが残した有効期限切れの回答を削除
+            with self._lock:
+                self._purge_expired(time.time())
+
+    def get(self, key):
+        """
+        キャッシュからの取得
+
+        Args:
+            key: キャッシュキー
+
+        Returns:
+            回答（answer, context を持つ辞書）。ない場合・有効期限切れの場合は None
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._conn is not None:
+                row = self._conn.execute("SELECT created_at, value FROM answers WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    entry = (row[0], json.loads(row[1]))
+                    self._store(key, entry)
+
+            if entry is None:
+                return None
+            created_at, value = entry
+            if now - created_at > self.ttl_seconds:
+                del self._entries[key]
+                if self._conn is not None:
+                    self._conn.execute("DELETE FROM answers WHERE key = ?", (key,))
+                    self._conn.commit()
+                return None
+
+            self._entries.move_to_end(key)
+            return {
+                "answer": value["answer"],
+                "context": [Document(**doc) for doc in value["context"]]
+            }
+
+    def put(self, key, answer, context):
+        """
+        キャッシュへの保存
+
+        Args:
+            key: キャッシュキー
+            answer: 回答本文
+            context: 回答に使った文脈（ドキュメントのリスト）
+        """
+        now = time.time()
+        value = {
+            "answer": answer,
+            "context": [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in context]
+        }
+        with self._lock:
+            self._store(key, (now, value))
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO answers VALUES (?, ?, ?)",
+                    (key, now, json.dumps(value, ensure_ascii=False, default=str))
+                )
+                self._conn.commit()
+                # 有効期限切れの回答はディスクからも削除（保存のたびではなく、一定間隔でまとめて削除する）
+                if now - self._purged_at >= self.purge_interval_seconds:
+                    self._purge_expired(now)
+
+    def _purge_expired(self, now):
+        """
+        SQLiteファイルから有効期限切れの回答を削除（ロックを取得した状態で呼び出す）
+
+        Args:
+            now: 現在時刻（UNIX時間）
+        """
+        self._conn.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl_seconds,))
+        self._conn.commit()
+        self._purged_at = now
+
+    def _store(self, key, entry):
+        """
+        メモリ上への保存（上限を超えた場合は最も古く使われた回答から削除）
+
+        Args:
+            key: キャッシュキー
+            entry: (保存日時, 回答) のタプル
+        """
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,139 @@
+"""
+このファイルは、1メッセージあたりのチェーン組み立て・LLM呼び出しのオーバーヘッドを比較するベンチマークです。
+- 比較対象：「メッセージごとに ChatOpenAI とチェーンを組み立てる方式」と「ChainRegistry で使い回す方式」
+- LLMのAPIはローカルのスタブサーバー（固定の応答を返す）に置き換えるため、ネットワークやAPIキーは不要
+- リポジトリのルートで「python -m benchmarks.bench_chain_overhead」として実行します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import json
+import socket
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.documents import Document
+from langchain_core.output_parsers import StrOutputParser
+from langchain_openai import ChatOpenAI
+from langchain.chains.combine_documents import create_stuff_documents_chain
+import constants as ct
+from chains import ChainRegistry
+
+
+############################################################
+# クラス定義
+############################################################
+
+class StubChatCompletionHandler(BaseHTTPRequestHandler):
+    """
+    OpenAI の Chat Completions API の形式で、固定の応答を返すスタブ
+    """
+    # keep-alive を有効にするため HTTP/1.1 で応答
+    protocol_version = "HTTP/1.1"
+    # 新規接続の数（コネクションプールが効いているかの確認用）
+    connection_count = 0
+
+    def setup(self):
+        super().setup()
+        # ヘッダーと本文の分割送信で遅延ACKの待ちが計測に混ざらないよう、Nagleアルゴリズムを無効化
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        StubChatCompletionHandler.connection_count += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = json.dumps({
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": ct.MODEL,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "スタブの回答"}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+############################################################
+# 関数定義
+############################################################
+
+def build_per_message(base_url):
+    """
+    変更前の方式：メッセージごとに ChatOpenAI とプロンプト・チェーンを組み立てる
+
+    Args:
+        base_url: LLMのAPIのURL
+
+    Returns:
+        (「独立した質問」生成チェーン, 本問合せチェーン)
+    """
+    llm = ChatOpenAI(model_name=ct.MODEL, temperature=ct.TEMPERATURE, base_url=base_url)
+    question_generator_prompt = ChatPromptTemplate.from_messages(
+        [("system", ct.SYSTEM_PROMPT_CREATE_INDEPENDENT_TEXT), MessagesPlaceholder("chat_history"), ("human", "{input}")]
+    )
+    question_answer_prompt = ChatPromptTemplate.from_messages(
+        [("system", ct.SYSTEM_PROMPT_INQUIRY), MessagesPlaceholder("chat_history"), ("human", "{input}")]
+    )
+    return (
+        question_generator_prompt | llm | StrOutputParser(),
+        create_stuff_documents_chain(llm, question_answer_prompt)
+    )
+
+
+def run_message(question_generator_chain, question_answer_chain):
+    """
+    1メッセージ分の処理（独立した質問の生成 + 回答生成）を実行
+
+    Args:
+        question_generator_chain: 「独立した質問」生成チェーン
+        question_answer_chain: 本問合せチェーン
+    """
+    inputs = {"input": "EcoTeeの代行出荷サービスとは？", "chat_history": ["前の質問"]}
+    question_generator_chain.invoke(inputs)
+    question_answer_chain.invoke({**inputs, "context": [Document(page_content="文脈")]})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="1メッセージあたりのオーバーヘッドの比較")
+    parser.add_argument("--messages", type=int, default=200, help="計測するメッセージ数")
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "sk-stub")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubChatCompletionHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    # 変更前：メッセージごとに組み立て
+    StubChatCompletionHandler.connection_count = 0
+    start = time.perf_counter()
+    for _ in range(args.messages):
+        run_message(*build_per_message(base_url))
+    before = (time.perf_counter() - start) / args.messages
+    before_connections = StubChatCompletionHandler.connection_count
+
+    # 変更後：ChainRegistry を使い回す
+    registry = ChainRegistry(base_url=base_url)
+    StubChatCompletionHandler.connection_count = 0
+    start = time.perf_counter()
+    for _ in range(args.messages):
+        run_message(registry.question_generator_chain, registry.question_answer_chains[ct.ANSWER_MODE_2])
+    after = (time.perf_counter() - start) / args.messages
+    after_connections = StubChatCompletionHandler.connection_count
+
+    server.shutdown()
+    print(f"メッセージごとに組み立て: {before * 1000:.2f}ms/メッセージ（新規接続 {before_connections}回）")
+    print(f"ChainRegistry を使い回し: {after * 1000:.2f}ms/メッセージ（新規接続 {after_connections}回）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+このファイルは、チャンク分割の方式（改行単位・文字数の CharacterTextSplitter と、日本語の文・段落単位・トークン数の JapaneseTextSplitter）を
+./data 配下のファイルで比較するベンチマークです。
+- チャンク数、チャンクの長さ（平均・中央値・最大）、短いチャンクの数、文末・行末で終わるチャンクの割合、分割の所要時間を出力します。
+- 質問と「回答に必要な文字列」の組に対して、検索結果の上位k件のいずれかのチャンクに必要な文字列がすべて含まれる割合（ヒット率）を出力します。
+  既定では語彙検索（BM25）で計測し、「--vector」を指定すると埋め込みモデルによるベクトル検索でも計測します（OpenAI の API キーが必要）。
+- リポジトリのルートで「python -m benchmarks.bench_chunking」として実行します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import re
+import time
+import argparse
+import statistics
+import numpy as np
+from langchain.text_splitter import CharacterTextSplitter
+import constants as ct
+from indexing import collect_source_files, load_file_cached, adjust_string
+from japanese_text_splitter import JapaneseTextSplitter
+from lexical_index import LexicalIndex
+from token_counter import get_encoding_name
+
+
+############################################################
+# 設定関連
+############################################################
+# (質問, 回答に必要な文字列のリスト)。空白・改行を除いた本文で、1つのチャンクにすべて含まれればヒットとする
+EVAL_QUERIES = [
+    ("代行出荷サービスの基本料金はいくらですか？", ["1配送先あたり¥300"]),
+    ("代行出荷サービスの個別配送は何件まで対応していますか？", ["個別配送", "最大10,000件"]),
+    ("代行出荷でブランドロゴ入りパッケージを使う場合の追加料金は？", ["ブランドロゴ入りパッケージ:¥50/枚"]),
+    ("株主優待の基準日はいつですか？", ["毎年3月31日および9月30日"]),
+    ("ゴールド優待プランの商品引換券はいくら分ですか？", ["ゴールド優待プラン", "商品引換券（5,000円相当）"]),
+    ("プラチナ優待プランでもらえる優待ポイントは？", ["プラチナ優待プラン", "優待ポイント（3,000ポイント）"]),
+    ("EcoTeeの本社の所在地はどこですか？", ["東京都渋谷区神南1-10-5"]),
+    ("EcoTeeの従業員数を教えてください", ["従業員数:25名"]),
+    ("売上の何%を環境保護団体に寄付していますか？", ["売上の3%を環境保護団体に寄付"]),
+    ("プレミアムエコTシャツの価格は？", ["プレミアムエコTシャツ", "¥3,800"]),
+    ("法人のカスタム大量注文は何枚から注文できますか？", ["法人（カスタム大量注文）:最低10枚から"]),
+    ("デザインの修正は何回まで無料ですか？", ["修正は最大2回まで無料", "¥500の手数料"]),
+    ("注文確定後、何時間以内ならキャンセルできますか？", ["24時間以内であれば無料でキャンセル可能"]),
+    ("急ぎ注文の特急料金と発送日は？", ["特急料金（¥1,000）で最短翌営業日発送"]),
+    ("配送料金と送料無料になる条件を教えてください", ["全国一律¥500", "5枚以上の注文で送料無料"]),
+    ("返品は商品到着後何日以内なら可能ですか？", ["商品到着後7日以内であれば返品可能"]),
+    ("カーボンオフセットオプションの料金は？", ["カーボンオフセットオプション", "¥100を追加可能"]),
+    ("チャットサポートは何時まで対応していますか？", ["チャットサポートは22:00まで"]),
+    ("議事録の見出しはどのように構成するルールですか？", ["階層化した見出し"]),
+    ("議事録の承認プロセスについて教えてください", ["承認プロセス", "上司や議長の確認・承認"]),
+    ("全社ミーティングで共有された営業部門の成功事例は？", ["新規顧客獲得キャンペーンで目標の150%達成"]),
+]
+_WHITESPACE = re.compile(r"[\s\u200b]+")
+
+
+############################################################
+# 関数定義
+############################################################
+
+def load_corpus(data_dir):
+    """
+    データソースのファイルを読み込み、チャンク分割前と同じ文字列調整を行う
+
+    Args:
+        data_dir: データソースのディレクトリ
+
+    Returns:
+        ドキュメントのリスト
+    """
+    docs = []
+    for path in collect_source_files(data_dir):
+        docs.extend(load_file_cached(path))
+    for doc in docs:
+        doc.page_content = adjust_string(doc.page_content)
+    return docs
+
+
+def chunk_stats(chunks, seconds):
+    """
+    チャンクの統計
+
+    Args:
+        chunks: チャンクのドキュメントのリスト
+        seconds: 分割の所要時間[秒]
+
+    Returns:
+        統計の文字列
+    """
+    lengths = [len(chunk.page_content) for chunk in chunks]
+    # 文末または行末（箇条書き・見出しの1行の終わり）で終わるチャンクの割合
+    clean_ends = sum(
+        chunk.page_content.rstrip().endswith(("。", "！", "？", "!", "?", "」", "）", ")"))
+        for chunk in chunks
+    )
+    return (
+        f"チャンク数 {len(chunks)}, 文字数 平均 {statistics.mean(lengths):.0f} / 中央値 {statistics.median(lengths):.0f} / "
+        f"最大 {max(lengths)}, 100文字未満 {sum(length < 100 for length in lengths)}件, "
+        f"文末で終わる割合 {clean_ends / len(chunks):.1%}, 分割 {seconds * 1000:.0f}ms"
+    )
+
+
+def is_hit(docs, answers):
+    """
+    検索結果のいずれかのチャンクに、回答に必要な文字列がすべて含まれるか
+
+    Args:
+        docs: 検索結果のドキュメントのリスト
+        answers: 回答に必要な文字列のリスト
+
+    Returns:
+        ヒットしたかどうか
+    """
+    answers = [_WHITESPACE.sub("", answer) for answer in answers]
+    for doc in docs:
+        text = _WHITESPACE.sub("", doc.page_content)
+        if all(answer in text for answer in answers):
+            return True
+    return False
+
+
+def lexical_hit_rate(chunks, k):
+    """
+    語彙検索（BM25）でのヒット率
+
+    Args:
+        chunks: チャンクのドキュメントのリスト
+        k: 取得件数
+
+    Returns:
+        ヒット率
+    """
+    index = LexicalIndex.build(chunks)
+    hits = [is_hit([doc for doc, _ in index.search(query, k)], answers) for query, answers in EVAL_QUERIES]
+    return sum(hits) / len(hits)
+
+
+def vector_hit_rate(chunks, k, embeddings):
+    """
+    ベクトル検索でのヒット率
+
+    Args:
+        chunks: チャンクのドキュメントのリスト
+        k: 取得件数
+        embeddings: 埋め込みモデル
+
+    Returns:
+        ヒット率
+    """
+    vectors = np.array(embeddings.embed_documents([chunk.page_content for chunk in chunks]), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    query_vectors = np.array(embeddings.embed_documents([query for query, _ in EVAL_QUERIES]), dtype=np.float32)
+    hits = []
+    for query_vector, (_, answers) in zip(query_vectors, EVAL_QUERIES):
+        top = np.argsort(-(vectors @ query_vector))[:k]
+        hits.append(is_hit([chunks[i] for i in top], answers))
+    return sum(hits) / len(hits)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="チャンク分割の方式の比較")
+    parser.add_argument("--data-dir", default=ct.RAG_TOP_FOLDER_PATH, help="データソースのディレクトリ")
+    parser.add_argument("--k", type=int, default=ct.RETRIEVER_TOP_K, help="ヒット率を計測する取得件数")
+    parser.add_argument("--vector", action="store_true", help="ベクトル検索でのヒット率も計測する")
+    args = parser.parse_args()
+
+    docs = load_corpus(args.data_dir)
+    splitters = {
+        "character": CharacterTextSplitter(chunk_size=ct.CHUNK_SIZE, chunk_overlap=ct.CHUNK_OVERLAP, separator="\n"),
+        "japanese": JapaneseTextSplitter(),
+    }
+    embeddings = None
+    if args.vector:
+        from langchain_openai import OpenAIEmbeddings
+        embeddings = OpenAIEmbeddings(model=ct.EMBEDDING_MODEL)
+
+    print(
+        f"ドキュメント数: {len(docs)}, トークン数の数え方: {get_encoding_name(ct.EMBEDDING_MODEL)}, "
+        f"質問数: {len(EVAL_QUERIES)}, 取得件数: {args.k}"
+    )
+    for name, splitter in splitters.items():
+        start = time.perf_counter()
+        chunks = splitter.split_documents(docs)
+        seconds = time.perf_counter() - start
+        result = f"{name:>9}: {chunk_stats(chunks, seconds)}, ヒット率 語彙検索 {lexical_hit_rate(chunks, args.k):.1%}"
+        if embeddings is not None:
+            result += f" / ベクトル検索 {vector_hit_rate(chunks, args.k, embeddings):.1%}"
+        print(result)
+
+
+if __name__ == "__main__":
+    main()
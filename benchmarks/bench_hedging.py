@@ -0,0 +1,122 @@
+"""
+このファイルは、クエリのベクトル化を「ヘッジなし」と「ヘッジあり」（直近の所要時間の95パーセンタイルを超えたら同じ呼び出しをもう1つ送る）で
+実行し、応答時間の中央値・99パーセンタイルを比較するベンチマークです。
+- 埋め込みのAPIはローカルのスタブサーバーに置き換え、一定の割合の呼び出しだけ応答を大きく遅らせる（--tail-ratio, --tail-latency）
+- 期限（STAGE_DEADLINE_SECONDS の "embed"）を超えた件数と、ヘッジにより増えた送信回数も出力します。
+- リポジトリのルートで「python -m benchmarks.bench_hedging」として実行します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import time
+import random
+import argparse
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+from langchain_openai import OpenAIEmbeddings
+import constants as ct
+import deadlines
+from deadlines import RequestDeadline, StageTimeout, LatencyTracker
+from request_scheduler import RequestScheduler, ScheduledEmbeddings
+from token_counter import get_encoding
+from benchmarks.bench_request_scheduler import StubOpenAIHandler
+
+
+############################################################
+# クラス定義
+############################################################
+
+class TailLatencyHandler(StubOpenAIHandler):
+    """
+    一定の割合の呼び出しだけ応答を大きく遅らせるスタブ
+    """
+    tail_ratio = 0.05
+    tail_latency = 1.0
+
+    def response_latency(self):
+        if random.random() < TailLatencyHandler.tail_ratio:
+            return TailLatencyHandler.tail_latency
+        return StubOpenAIHandler.latency * random.uniform(0.8, 1.2)
+
+
+############################################################
+# 関数定義
+############################################################
+
+def measure(embeddings, queries, hedge, concurrency):
+    """
+    期限付きでクエリのベクトル化を実行し、応答時間を計測
+
+    Args:
+        embeddings: 埋め込みモデル
+        queries: 検索クエリのリスト
+        hedge: ヘッジするかどうか
+        concurrency: 同時に実行するクエリ数
+
+    Returns:
+        (応答時間[秒]のリスト, 期限切れの件数)
+    """
+    def _embed(query):
+        start = time.perf_counter()
+        try:
+            RequestDeadline(ct.STAGE_DEADLINE_SECONDS["embed"]).run("embed", lambda: embeddings.embed_query(query), hedge=hedge)
+            return time.perf_counter() - start, False
+        except StageTimeout:
+            return time.perf_counter() - start, True
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(_embed, queries))
+    return [seconds for seconds, _ in results], sum(timed_out for _, timed_out in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ヘッジの有無による応答時間の比較")
+    parser.add_argument("--queries", type=int, default=1000, help="計測するクエリ数")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時に実行するクエリ数")
+    parser.add_argument("--latency", type=float, default=0.05, help="スタブの通常の応答時間[秒]")
+    parser.add_argument("--tail-ratio", type=float, default=0.05, help="応答を遅らせる呼び出しの割合")
+    parser.add_argument("--tail-latency", type=float, default=1.0, help="遅らせる場合の応答時間[秒]")
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "sk-stub")
+    get_encoding(ct.EMBEDDING_MODEL)
+    StubOpenAIHandler.capacity = 10 ** 6
+    StubOpenAIHandler.latency = args.latency
+    TailLatencyHandler.tail_ratio = args.tail_ratio
+    TailLatencyHandler.tail_latency = args.tail_latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), TailLatencyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    embeddings = ScheduledEmbeddings(
+        OpenAIEmbeddings(model=ct.EMBEDDING_MODEL, base_url=base_url, check_embedding_ctx_length=False, max_retries=0),
+        RequestScheduler("embedding", 10 ** 6)
+    )
+    print(
+        f"クエリ数: {args.queries}, 同時実行数: {args.concurrency}, "
+        f"応答時間: 通常 {args.latency * 1000:.0f}ms / {args.tail_ratio:.0%}の呼び出しは {args.tail_latency * 1000:.0f}ms"
+    )
+
+    for hedge in (False, True):
+        # パーセンタイルの算出に使う記録を、計測ごとにやり直す（最初の HEDGE_MIN_SAMPLES 件はヘッジしない）
+        deadlines.latency_tracker = LatencyTracker()
+        StubOpenAIHandler.reset()
+        queries = [f"検索クエリ{hedge}-{i}" for i in range(args.queries)]
+        latencies, timeouts = measure(embeddings, queries, hedge, args.concurrency)
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(
+            f"{'ヘッジあり' if hedge else 'ヘッジなし'}: 中央値 {statistics.median(latencies) * 1000:.0f}ms / "
+            f"p99 {p99 * 1000:.0f}ms, 期限切れ {timeouts}件, "
+            f"送信 {StubOpenAIHandler.requests}回（クエリ数の {StubOpenAIHandler.requests / args.queries:.1%}）"
+        )
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+このファイルは、多数のセッションが同時に同じような質問をした場合の OpenAI API の呼び出しを、
+「チェーンから直接呼び出す方式」と「RequestScheduler を通す方式」で比較するベンチマークです。
+- LLM・埋め込みのAPIはローカルのスタブサーバーに置き換える（ネットワークやAPIキーは不要）
+- スタブは、同時に処理中の呼び出しが --capacity を超えると 429（レート制限）を返す
+- 送信回数・429の回数・失敗した質問の数・応答時間（中央値・99パーセンタイル）・最大の順番待ち件数を出力します。
+- リポジトリのルートで「python -m benchmarks.bench_request_scheduler」として実行します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import json
+import time
+import base64
+import socket
+import argparse
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.output_parsers import StrOutputParser
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+import constants as ct
+from chains import ChainRegistry
+from request_scheduler import RequestScheduler, ScheduledEmbeddings
+from token_counter import get_encoding
+
+
+############################################################
+# クラス定義
+############################################################
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    OpenAI の Chat Completions API・Embeddings API の形式で応答し、同時実行数が上限を超えると429を返すスタブ
+    """
+    protocol_version = "HTTP/1.1"
+    capacity = 4
+    latency = 0.2
+    lock = threading.Lock()
+    in_flight = 0
+    requests = 0
+    rate_limited = 0
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    @classmethod
+    def reset(cls):
+        with cls.lock:
+            cls.requests = 0
+            cls.rate_limited = 0
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        cls = StubOpenAIHandler
+        with cls.lock:
+            cls.requests += 1
+            accepted = cls.in_flight < cls.capacity
+            if accepted:
+                cls.in_flight += 1
+            else:
+                cls.rate_limited += 1
+        if not accepted:
+            self._send(429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}})
+            return
+
+        try:
+            time.sleep(self.response_latency())
+            if self.path.endswith("/embeddings"):
+                self._send(200, self._embeddings(request))
+            else:
+                self._send(200, {
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": ct.MODEL,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": "スタブの回答"}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+                })
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def response_latency(self):
+        """
+        応答までの時間[秒]（応答時間のばらつきを再現する場合はサブクラスで変更する）
+        """
+        return StubOpenAIHandler.latency
+
+    @staticmethod
+    def _embeddings(request):
+        inputs = request["input"] if isinstance(request["input"], list) else [request["input"]]
+        data = []
+        for i, _ in enumerate(inputs):
+            vector = np.full(8, 1.0 / (i + 1), dtype=np.float32)
+            embedding = vector.tolist()
+            if request.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.tobytes()).decode("ascii")
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        return {"object": "list", "data": data, "model": ct.EMBEDDING_MODEL, "usage": {"prompt_tokens": 1, "total_tokens": 1}}
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+############################################################
+# 関数定義
+############################################################
+
+def run_sessions(ask, questions, sessions):
+    """
+    複数のセッションから同時に質問し、応答時間と失敗数を計測
+
+    Args:
+        ask: 1つの質問を処理する関数
+        questions: 質問のリスト
+        sessions: 同時に質問するセッション数
+
+    Returns:
+        (応答時間[秒]のリスト, 失敗した質問の数)
+    """
+    def _ask(question):
+        start = time.perf_counter()
+        try:
+            ask(question)
+            return time.perf_counter() - start, False
+        except Exception:
+            return time.perf_counter() - start, True
+
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        results = list(executor.map(_ask, questions))
+    return [seconds for seconds, _ in results], sum(failed for _, failed in results)
+
+
+def report(name, latencies, failures, scheduler=None):
+    """
+    計測結果の出力
+
+    Args:
+        name: 方式の名前
+        latencies: 応答時間[秒]のリスト
+        failures: 失敗した質問の数
+        scheduler: RequestScheduler（ある場合は待ち時間なども出力）
+    """
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    result = (
+        f"{name}: 送信 {StubOpenAIHandler.requests}回（429: {StubOpenAIHandler.rate_limited}回）, 失敗 {failures}件, "
+        f"応答時間 中央値 {statistics.median(latencies) * 1000:.0f}ms / p99 {p99 * 1000:.0f}ms"
+    )
+    if scheduler is not None:
+        stats = scheduler.stats()
+        result += (
+            f", 共有 {stats['coalesced']}回, 再試行 {stats['retries']}回, "
+            f"平均待ち {stats['wait_avg_ms']:.0f}ms / 最大待ち {stats['wait_max_ms']:.0f}ms"
+        )
+    print(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI API の呼び出し制御の比較")
+    parser.add_argument("--sessions", type=int, default=32, help="同時に質問するセッション数")
+    parser.add_argument("--questions", type=int, default=96, help="質問の総数")
+    parser.add_argument("--distinct", type=int, default=4, help="質問の種類の数（会議直後に同じ質問が集中する状況を再現）")
+    parser.add_argument("--capacity", type=int, default=4, help="スタブが同時に受け付ける呼び出し数（超えると429）")
+    parser.add_argument("--latency", type=float, default=0.2, help="スタブの応答時間[秒]")
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "sk-stub")
+    # トークナイザーの読み込みが計測に混ざらないよう、先に読み込んでおく
+    get_encoding(ct.MODEL)
+    get_encoding(ct.EMBEDDING_MODEL)
+    StubOpenAIHandler.capacity = args.capacity
+    StubOpenAIHandler.latency = args.latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubOpenAIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    questions = [f"全社ミーティングで話していた新制度{i % args.distinct}について教えて" for i in range(args.questions)]
+    inputs = lambda question: {"input": question, "chat_history": []}
+    print(f"セッション数: {args.sessions}, 質問数: {args.questions}（{args.distinct}種類）, スタブの同時受付数: {args.capacity}")
+
+    # 変更前：チェーンから直接呼び出す（クライアントの既定の再試行のみ）
+    prompt = ChatPromptTemplate.from_messages(
+        [("system", ct.SYSTEM_PROMPT_CREATE_INDEPENDENT_TEXT), MessagesPlaceholder("chat_history"), ("human", "{input}")]
+    )
+    direct_chain = prompt | ChatOpenAI(model_name=ct.MODEL, temperature=ct.TEMPERATURE, base_url=base_url) | StrOutputParser()
+    StubOpenAIHandler.reset()
+    latencies, failures = run_sessions(lambda q: direct_chain.invoke(inputs(q)), questions, args.sessions)
+    report("チャット 直接呼び出し", latencies, failures)
+
+    # 変更後：ChainRegistry（ScheduledChatModel 経由）で呼び出す。スタブの受付数に合わせて同時実行数を制限
+    registry = ChainRegistry(base_url=base_url)
+    scheduler = RequestScheduler("chat", args.capacity, ct.OPENAI_CHAT_TPM_LIMIT)
+    registry.llm.scheduler = scheduler
+    StubOpenAIHandler.reset()
+    latencies, failures = run_sessions(lambda q: registry.question_generator_chain.invoke(inputs(q)), questions, args.sessions)
+    report("チャット RequestScheduler", latencies, failures, scheduler)
+
+    # 検索クエリの埋め込み
+    raw_embeddings = OpenAIEmbeddings(model=ct.EMBEDDING_MODEL, base_url=base_url, check_embedding_ctx_length=False)
+    StubOpenAIHandler.reset()
+    latencies, failures = run_sessions(raw_embeddings.embed_query, questions, args.sessions)
+    report("埋め込み 直接呼び出し", latencies, failures)
+
+    scheduler = RequestScheduler("embedding", args.capacity, ct.OPENAI_EMBEDDING_TPM_LIMIT)
+    embeddings = ScheduledEmbeddings(
+        OpenAIEmbeddings(model=ct.EMBEDDING_MODEL, base_url=base_url, check_embedding_ctx_length=False, max_retries=0),
+        scheduler
+    )
+    StubOpenAIHandler.reset()
+    latencies, failures = run_sessions(embeddings.embed_query, questions, args.sessions)
+    report("埋め込み RequestScheduler", latencies, failures, scheduler)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+このファイルは、検索用のベクターストアを「Chroma」と「NumPy のメモリマップした行列」で比較するベンチマークです。
+- 乱数で作ったチャンク（正規化済みの埋め込み + 本文）から両方のベクターストアを作成し、
+  作成時間、開く時間、検索のレイテンシ（p50 / p99）、メモリ使用量（RSS）、厳密な検索結果との一致率（recall@k）を計測します。
+- NumPy の行列は float16 と int8 の両方を計測します。
+- 開く時間以降は、メモリ使用量が互いに影響しないよう、ベクターストアごとに別プロセスで計測します。
+- リポジトリのルートで「python -m benchmarks.bench_vector_store」として実行します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import subprocess
+import tempfile
+import numpy as np
+from numpy_store import NumpyVectorStore
+
+
+############################################################
+# 関数定義
+############################################################
+
+def rss_mb():
+    """
+    現在のプロセスのメモリ使用量（RSS）
+
+    Returns:
+        RSS[MB]（/proc を読めない環境では最大RSS）
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+
+
+def make_corpus(count, dim, seed=0):
+    """
+    乱数によるチャンクの作成
+
+    Args:
+        count: チャンク数
+        dim: 埋め込みの次元数
+        seed: 乱数のシード
+
+    Returns:
+        (IDのリスト, 本文のリスト, メタデータのリスト, 埋め込みの配列)
+    """
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((count, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    ids = [f"chunk-{i}" for i in range(count)]
+    texts = [f"チャンク{i}の本文。" * 20 for i in range(count)]
+    metadatas = [{"source": f"./data/file{i // 10}.pdf", "page": i % 10, "chunk_id": ids[i]} for i in range(count)]
+    return ids, texts, metadatas, vectors
+
+
+def open_chroma(path):
+    """
+    ベンチマーク用の Chroma を開く
+
+    Args:
+        path: 保存先のディレクトリ
+
+    Returns:
+        Chroma のベクターストア
+    """
+    from langchain_community.vectorstores import Chroma
+    return Chroma(collection_name="bench", persist_directory=path)
+
+
+def build(backend, path, corpus, batch_size=2048):
+    """
+    ベクターストアを作成し、所要時間を返す
+
+    Args:
+        backend: "chroma", "numpy-float16" または "numpy-int8"
+        path: 保存先のディレクトリ
+        corpus: make_corpus の戻り値
+        batch_size: 1度に登録するチャンク数
+
+    Returns:
+        所要時間[秒]
+    """
+    ids, texts, metadatas, vectors = corpus
+    start = time.perf_counter()
+    if backend == "chroma":
+        db = open_chroma(path)
+        for i in range(0, len(ids), batch_size):
+            db._collection.add(
+                ids=ids[i:i + batch_size],
+                embeddings=vectors[i:i + batch_size].tolist(),
+                documents=texts[i:i + batch_size],
+                metadatas=metadatas[i:i + batch_size]
+            )
+        db.persist()
+    else:
+        batches = (
+            (ids[i:i + batch_size], texts[i:i + batch_size], metadatas[i:i + batch_size], vectors[i:i + batch_size])
+            for i in range(0, len(ids), batch_size)
+        )
+        NumpyVectorStore.build(path, len(ids), vectors.shape[1], batches, dtype=backend.split("-")[1])
+    return time.perf_counter() - start
+
+
+def measure(backend, path, count, dim, queries, k):
+    """
+    ベクターストアを開き、検索を繰り返して計測（子プロセスで実行）
+
+    Args:
+        backend: "chroma", "numpy-float16" または "numpy-int8"
+        path: 保存先のディレクトリ
+        count: チャンク数
+        dim: 埋め込みの次元数
+        queries: 検索回数
+        k: 取得件数
+
+    Returns:
+        計測結果の辞書
+    """
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    db = open_chroma(path) if backend == "chroma" else NumpyVectorStore(path)
+    open_time = time.perf_counter() - start
+    rss_opened = rss_mb()
+
+    rng = np.random.default_rng(1)
+    query_vectors = rng.standard_normal((queries, dim), dtype=np.float32)
+    latencies = []
+    results = []
+    for vector in query_vectors:
+        start = time.perf_counter()
+        if backend == "chroma":
+            ids = db._collection.query(query_embeddings=[vector.tolist()], n_results=k)["ids"][0]
+        else:
+            rows, _ = db.search_by_vector(vector, k)
+            ids = [db.document(row).metadata["chunk_id"] for row in rows]
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(set(ids))
+    rss_query = rss_mb()
+
+    # 厳密な検索結果（float32 の全件との内積）との一致率（メモリ使用量の計測後に算出）
+    _, _, _, vectors = make_corpus(count, dim)
+    exact = np.argsort(-(query_vectors @ vectors.T), axis=1)[:, :k]
+    recall = np.mean([
+        len(result & {f"chunk-{i}" for i in exact_rows}) / k for result, exact_rows in zip(results, exact)
+    ])
+
+    return {
+        "open_s": open_time,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "rss_open_mb": rss_opened - rss_before,
+        "rss_query_mb": rss_query - rss_before,
+        "recall": float(recall),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chroma と NumPy のメモリマップした行列の比較")
+    parser.add_argument("--count", type=int, default=20000, help="チャンク数")
+    parser.add_argument("--dim", type=int, default=1536, help="埋め込みの次元数")
+    parser.add_argument("--queries", type=int, default=200, help="検索回数")
+    parser.add_argument("--k", type=int, default=20, help="取得件数")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # 子プロセス：開く時間・検索・メモリ使用量の計測結果をJSONで出力
+    if args.child:
+        print(json.dumps(measure(args.child, args.path, args.count, args.dim, args.queries, args.k)))
+        return
+
+    work_dir = tempfile.mkdtemp(prefix="bench_vector_store_")
+    try:
+        corpus = make_corpus(args.count, args.dim)
+        print(f"チャンク数: {args.count}, 次元数: {args.dim}, 検索回数: {args.queries}, 取得件数: {args.k}")
+        for backend in ["chroma", "numpy-float16", "numpy-int8"]:
+            path = os.path.join(work_dir, backend)
+            build_time = build(backend, path, corpus)
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_vector_store", "--child", backend, "--path", path,
+                 "--count", str(args.count), "--dim", str(args.dim), "--queries", str(args.queries), "--k", str(args.k)],
+                check=True, capture_output=True, text=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(
+                f"{backend:>13}: 作成 {build_time:.2f}秒, 開く {result['open_s'] * 1000:.1f}ms, "
+                f"検索 p50 {result['p50_ms']:.2f}ms / p99 {result['p99_ms']:.2f}ms, "
+                f"RSS増加 開いた直後 {result['rss_open_mb']:.0f}MB / 検索後 {result['rss_query_mb']:.0f}MB, "
+                f"recall@{args.k} {result['recall']:.3f}"
+            )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+このファイルは、LLMクライアントとRAG用のチェーンをプロセス内で1度だけ組み立て、全セッションで使い回すための処理が記述されたファイルです。
+- LLMクライアントは、keep-alive を有効にした1つのHTTPクライアント（コネクションプール）を共有する
+- チェーンは回答モードごとに1つ作成し、会話履歴などのリクエストごとの値は実行時（invoke）に渡す
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import httpx
+from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_openai import ChatOpenAI
+from langchain.chains.combine_documents import create_stuff_documents_chain
+from langchain_core.output_parsers import StrOutputParser
+import constants as ct
+from request_scheduler import ScheduledChatModel
+
+
+############################################################
+# クラス定義
+############################################################
+
+class ChainRegistry:
+    """
+    回答モードごとのチェーンと、共有のLLMクライアントを保持するクラス
+    """
+
+    def __init__(self, base_url=None):
+        """
+        Args:
+            base_url: LLMのAPIのURL（省略時は OpenAI の既定値。ベンチマークでローカルのスタブを使う場合に指定）
+        """
+        # 毎回のTLSハンドシェイクを避けるため、keep-alive のコネクションプールをプロセス内で共有
+        self.http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=ct.LLM_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=ct.LLM_HTTP_MAX_CONNECTIONS,
+                keepalive_expiry=ct.LLM_HTTP_KEEPALIVE_SECONDS
+            )
+        )
+
+        # LLM本体の用意（モデル名・温度は constants 側で集中管理）
+        # - 同時実行数・トークン数の制限、同じ内容の呼び出しの共有、再試行は ScheduledChatModel がプロセス全体で行うため、
+        #   クライアント自身の再試行は無効にする
+        self.llm = ScheduledChatModel(
+            ChatOpenAI(
+                model_name=ct.MODEL,
+                temperature=ct.TEMPERATURE,
+                http_client=self.http_client,
+                base_url=base_url,
+                timeout=ct.OPENAI_REQUEST_TIMEOUT_SECONDS,
+                max_retries=0
+            )
+        )
+
+        # 履歴を踏まえた「独立した質問」生成チェーン
+        question_generator_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", ct.SYSTEM_PROMPT_CREATE_INDEPENDENT_TEXT),
+                MessagesPlaceholder("chat_history"),
+                ("human", "{input}")
+            ]
+        )
+        self.question_generator_chain = question_generator_prompt | self.llm | StrOutputParser()
+
+        # 古い会話履歴を要約に畳み込むチェーン（前回の要約 + 新しく古くなったターンから要約を作り直す）
+        history_summary_prompt = ChatPromptTemplate.from_template(ct.SYSTEM_PROMPT_SUMMARIZE_HISTORY)
+        self.history_summary_chain = history_summary_prompt | self.llm | StrOutputParser()
+
+        # モード別の本問合せプロンプト（文書検索 / 社内問い合わせ）と、文脈を stuff して回答するチェーン
+        self.question_answer_templates = {
+            # 社内文書検索：関連がなければ「該当資料なし」を厳格に返す設計
+            ct.ANSWER_MODE_1: ct.SYSTEM_PROMPT_DOC_SEARCH,
+            # 社内問い合わせ：文脈に基づき Markdown 詳細回答。必要に応じ一般情報も許容
+            ct.ANSWER_MODE_2: ct.SYSTEM_PROMPT_INQUIRY,
+        }
+        self.question_answer_chains = {}
+        for mode, template in self.question_answer_templates.items():
+            question_answer_prompt = ChatPromptTemplate.from_messages(
+                [
+                    ("system", template),
+                    MessagesPlaceholder("chat_history"),
+                    ("human", "{input}")
+                ]
+            )
+            self.question_answer_chains[mode] = create_stuff_documents_chain(self.llm, question_answer_prompt)
+
+    def model_settings(self, mode):
+        """
+        回答内容に影響する設定（回答キャッシュのキーに使用）
+
+        Args:
+            mode: 回答モード
+
+        Returns:
+            モデル名・温度・プロンプトの辞書
+        """
+        return {"model": ct.MODEL, "temperature": ct.TEMPERATURE, "prompt": self.question_answer_templates[mode]}
@@ -0,0 +1,167 @@
+"""
+このファイルは、LLMとのやりとり用の会話履歴を管理する処理が記述されたファイルです。
+- 直近のターンはそのまま保持し、それより古いターンは要約に畳み込む（要約は前回の要約 + 新しく古くなったターンから作り直す）
+- 要約の更新は会話履歴への追加時に別スレッドで開始し、回答を返すのを待たせない（実行中の要約は同時に1つだけ）
+- 要約が終わるまでの古いターンは、要約されていないターンとしてそのまま送る（要約に畳み込んだターンは保持しない）
+- LLMに送る際は、回答モードごとのトークン数の上限に収まるよう、新しいターンから順に詰める
+  （直近のターンだけで上限を超える場合も、追加の質問の文脈が失われないよう、上限まで切り詰めて送る）
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+import constants as ct
+from token_counter import count_message_tokens, truncate_tokens
+
+
+############################################################
+# 設定関連
+############################################################
+# 上限まで切り詰めたメッセージの末尾に付ける印
+TRUNCATED_MARK = "…（以下省略）"
+
+
+############################################################
+# クラス定義
+############################################################
+
+class ChatHistory:
+    """
+    要約付きの会話履歴（セッションごとに1つ作成する）
+    """
+
+    _executor = ThreadPoolExecutor(max_workers=ct.CHAT_HISTORY_SUMMARY_WORKERS, thread_name_prefix="history-summary")
+
+    def __init__(self, max_turns=ct.CHAT_HISTORY_MAX_TURNS, fold_max_turns=ct.CHAT_HISTORY_FOLD_MAX_TURNS):
+        """
+        Args:
+            max_turns: そのまま保持する直近のターン数
+            fold_max_turns: 1回の要約で畳み込む最大ターン数
+        """
+        self.max_turns = max_turns
+        self.fold_max_turns = fold_max_turns
+        # 要約に畳み込んでいない (質問, 回答) のリスト
+        self.turns = []
+        # turns より前のターンを畳み込んだ要約
+        self.summary = ""
+        # 要約は別スレッドで更新するため、要約と turns の組をロックで保護する
+        self._lock = threading.Lock()
+        self._folding = None
+
+    def __len__(self):
+        return len(self.turns)
+
+    def add_turn(self, question, answer, summarizer=None):
+        """
+        ターンを追加し、直近のターン数を超えた古いターンの要約への畳み込みを別スレッドで開始する
+
+        Args:
+            question: ユーザーの入力文字列
+            answer: LLMの回答本文
+            summarizer: 要約用のチェーン（summary, conversation を受け取る。None の場合は要約しない）
+        """
+        with self._lock:
+            self.turns.append((question, answer))
+            if summarizer is None or (self._folding is not None and not self._folding.done()):
+                return
+            end = min(len(self.turns) - self.max_turns, self.fold_max_turns)
+            if end <= 0:
+                return
+            self._folding = self._executor.submit(self._fold, summarizer, self.summary, self.turns[:end])
+
+    def _fold(self, summarizer, summary, folding):
+        """
+        古いターンを要約に畳み込む（別スレッドで実行）
+
+        Args:
+            summarizer: 要約用のチェーン
+            summary: 開始時点の要約
+            folding: 畳み込む (質問, 回答) のリスト（turns の先頭。実行中の要約は1つだけのため、完了時も turns の先頭にある）
+        """
+        conversation = "\n".join(f"ユーザー: {q}\nアシスタント: {a}" for q, a in folding)
+        try:
+            new_summary = summarizer.invoke({"summary": summary or "（なし）", "conversation": conversation})
+        except Exception as e:
+            # 要約に失敗した場合は畳み込まずに残し（要約されていないターンとして送る）、次のターンの追加時に改めて要約する
+            logging.getLogger(ct.LOGGER_NAME).error(f"会話履歴の要約に失敗しました: {e}")
+            return
+        with self._lock:
+            self.summary = new_summary
+            del self.turns[:len(folding)]
+
+    def to_messages(self, token_budget):
+        """
+        トークン数の上限に収まる範囲で、LLMに送るメッセージのリストを作成
+
+        Args:
+            token_budget: 会話履歴（要約を含む）のトークン数の上限
+
+        Returns:
+            (メッセージのリスト, トークン数) のタプル
+        """
+        with self._lock:
+            turns = list(self.turns)
+            summary = self.summary
+
+        used_tokens = 0
+        messages = []
+        # 要約されていないターン（要約が終わっていない古いターンを含む）を、新しいものから順に上限まで詰める
+        for i, (question, answer) in enumerate(reversed(turns)):
+            turn_messages = [HumanMessage(content=question), AIMessage(content=answer)]
+            turn_tokens = count_message_tokens(turn_messages)
+            if used_tokens + turn_tokens > token_budget:
+                # 直近のターンは、上限を超える場合も切り詰めて送る（長い回答の直後でも、追加の質問の言い換えができるように）
+                if i == 0:
+                    turn_messages = self._truncate_turn(question, answer, token_budget)
+                    turn_tokens = count_message_tokens(turn_messages)
+                    messages[:0] = turn_messages
+                    used_tokens += turn_tokens
+                break
+            messages[:0] = turn_messages
+            used_tokens += turn_tokens
+
+        # 残りの上限に収まる場合のみ、古いターンの要約を先頭に加える
+        if summary:
+            summary_message = SystemMessage(content=f"これまでの会話の要約:\n{summary}")
+            summary_tokens = count_message_tokens([summary_message])
+            if used_tokens + summary_tokens <= token_budget:
+                messages.insert(0, summary_message)
+                used_tokens += summary_tokens
+
+        return messages, used_tokens
+
+    @staticmethod
+    def _truncate_turn(question, answer, token_budget):
+        """
+        1ターンを、トークン数の上限に収まるよう先頭から切り詰める（質問は上限の半分まで、回答は残りの分）
+
+        Args:
+            question: 質問
+            answer: 回答
+            token_budget: トークン数の上限
+
+        Returns:
+            メッセージのリスト（上限が小さすぎる場合は空のリスト）
+        """
+        # メッセージごとの区切りと、切り詰めた印の分を除いた上限
+        overhead = count_message_tokens([HumanMessage(content=TRUNCATED_MARK), AIMessage(content=TRUNCATED_MARK)])
+        available = token_budget - overhead
+        if available <= 0:
+            return []
+
+        def _truncate(text, max_tokens):
+            truncated = truncate_tokens(text, max_tokens)
+            return truncated if truncated == text else truncated + TRUNCATED_MARK
+
+        question = _truncate(question, available // 2)
+        answer_budget = available - count_message_tokens([HumanMessage(content=question)]) + 4
+        turn_messages = [HumanMessage(content=question), AIMessage(content=_truncate(answer, answer_budget))]
+        # 切り出した位置でトークンの区切りが変わり、わずかに上限を超える場合は、回答をさらに縮める
+        while count_message_tokens(turn_messages) > token_budget and answer_budget > 0:
+            answer_budget -= max(1, answer_budget // 10)
+            turn_messages[1] = AIMessage(content=_truncate(answer, answer_budget))
+        return turn_messages if count_message_tokens(turn_messages) <= token_budget else []
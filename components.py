@@ -255,11 +255,12 @@ def display_search_llm_response(llm_response):
             content["sub_choices"] = sub_choices
 
     else:
-        # 該当なし（固定メッセージをそのまま表示）
-        st.markdown(ct.NO_DOC_MATCH_MESSAGE)
+        # 該当なし（固定メッセージをそのまま表示。期限内に検索できなかった場合は、その旨を表示）
+        answer = ct.RETRIEVAL_TIMEOUT_ANSWER if llm_response["answer"] == ct.RETRIEVAL_TIMEOUT_ANSWER else ct.NO_DOC_MATCH_MESSAGE
+        st.markdown(answer)
         content = {
             "mode": ct.ANSWER_MODE_1,
-            "answer": ct.NO_DOC_MATCH_MESSAGE,
+            "answer": answer,
             "no_file_path_flg": True,
         }
 
@@ -270,7 +271,7 @@ def display_contact_llm_response(llm_response):
     """
     「社内問い合わせ」モードにおけるLLMレスポンスを表示
 
-    - 回答本文を表示
+    - 回答本文を表示（ストリーミングの場合は、情報源を先に表示してから回答本文を順次表示）
     - 参照元がある場合は、ファイルパスにページ番号があれば（ページNo.X）を付けて表示
     - 返り値（content）は会話ログの再生用データ
     """
@@ -284,35 +285,51 @@ def display_contact_llm_response(llm_response):
             pass
         return f"（ページNo.{meta_page}）"
 
-    # 回答本文
-    st.markdown(llm_response["answer"])
+    # ストリーミングの場合は、先に情報源を表示してから回答本文を順次表示する
+    streaming = "answer_stream" in llm_response
+
+    # 回答本文（情報源より上に表示するため、表示位置だけ先に確保）
+    answer_placeholder = st.empty()
+    if not streaming:
+        answer_placeholder.markdown(llm_response["answer"])
 
     file_info_list = []  # 表示した参照元（文字列）を格納（会話ログ用に保存）
+    message = "情報源"
 
     # 「社内文書に情報がなかった」以外の場合は情報源を表示
-    if llm_response["answer"] != ct.INQUIRY_NO_MATCH_ANSWER:
-        st.divider()
-        message = "情報源"
-        st.markdown(f"##### {message}")
-
-        seen_paths = set()  # 同一ファイル重複抑止
-
-        for document in llm_response["context"]:
-            file_path = document.metadata.get("source", "")
-            if not file_path or file_path in seen_paths:
-                continue
-            seen_paths.add(file_path)
+    # （ストリーミングの場合は回答が確定していないため、いったん表示して回答確定後に判定する）
+    sources_placeholder = st.empty()
+    if streaming or llm_response["answer"] != ct.INQUIRY_NO_MATCH_ANSWER:
+        with sources_placeholder.container():
+            st.divider()
+            st.markdown(f"##### {message}")
+
+            seen_paths = set()  # 同一ファイル重複抑止
+
+            for document in llm_response["context"]:
+                file_path = document.metadata.get("source", "")
+                if not file_path or file_path in seen_paths:
+                    continue
+                seen_paths.add(file_path)
+
+                # ページ番号があれば末尾に付与
+                if "page" in document.metadata:
+                    display_text = f"{file_path}　{_page_label(document.metadata['page'])}"
+                else:
+                    display_text = file_path
 
-            # ページ番号があれば末尾に付与
-            if "page" in document.metadata:
-                display_text = f"{file_path}　{_page_label(document.metadata['page'])}"
-            else:
-                display_text = file_path
+                icon = utils.get_source_icon(file_path)
+                st.info(display_text, icon=icon)
 
-            icon = utils.get_source_icon(file_path)
-            st.info(display_text, icon=icon)
+                file_info_list.append(display_text)
 
-            file_info_list.append(display_text)
+    if streaming:
+        # 読み切った時点で llm_response["answer"] に回答本文全体が設定される
+        with answer_placeholder.container():
+            st.write_stream(llm_response["answer_stream"])
+        if llm_response["answer"] == ct.INQUIRY_NO_MATCH_ANSWER:
+            sources_placeholder.empty()
+            file_info_list = []
 
     # 会話ログ再生用のデータを返す
     content = {
@@ -40,14 +40,156 @@ APP_BOOT_MESSAGE = "アプリが起動されました。"
 # ============================
 
 RETRIEVER_TOP_K = 5        # 関連ドキュメントの取得件数（以前は3）
-CHUNK_SIZE = 500           # ドキュメント分割時の1チャンクの最大文字数
-CHUNK_OVERLAP = 100        # チャンクの重なり部分の文字数
+CHUNK_SIZE = 500           # ドキュメント分割時の1チャンクの最大文字数（TEXT_SPLITTER が "character" の場合）
+CHUNK_OVERLAP = 100        # チャンクの重なり部分の文字数（TEXT_SPLITTER が "character" の場合）
+
+# チャンク分割の方式（"japanese": 日本語の文・段落単位でトークン数により分割 / "character": 改行単位で文字数により分割）
+TEXT_SPLITTER = "japanese"
+CHUNK_SIZE_TOKENS = 500        # 1チャンクの最大トークン数（EMBEDDING_MODEL のトークナイザーで数える）
+CHUNK_OVERLAP_TOKENS = 100     # 段落の途中で区切る場合に、前のチャンクから引き継ぐ文の最大トークン数
+CHUNK_MIN_FILL_RATIO = 0.5     # 見出し・箇条書き・話者・段落の先頭で区切る場合の、チャンクの最小の充填率
+CHUNK_HEADING_MAX_CHARS = 40   # 文末のない行を見出しとみなす最大文字数（見出しは次のチャンクの先頭に移す）
+
+# 検索方式（"vector": ベクトル検索のみ / "hybrid": ベクトル検索 + 語彙検索）
+RETRIEVER_MODE = "hybrid"
+HYBRID_FETCH_K = 20        # ハイブリッド検索で、各検索方式から取得する候補数
+RRF_K = 60                 # Reciprocal Rank Fusion の定数（大きいほど下位の候補も重視）
+LEXICAL_NGRAM_SIZES = (2, 3)  # 語彙検索の索引語とする文字n-gramの長さ
+LEXICAL_BM25_K1 = 1.2
+LEXICAL_BM25_B = 0.75
+# 社員ID（EMP0001）や会社名（カタカナの名前）のように、クエリにそのまま含まれる語が一部のチャンクにだけ一致する場合は、
+# ベクトル検索の関連度スコアが低くても「該当資料なし」としない
+LEXICAL_EXACT_TERM_PATTERN = r"[a-z]+[0-9][a-z0-9_-]*|[ァ-ヴー・]{4,}"
+LEXICAL_EXACT_MATCH_MAX_DOC_RATIO = 0.05  # 語を含むチャンクが全体のこの割合以下の場合のみ一致とみなす
+# 参照元の多様化（同じファイルのチャンクで上位k件が埋まるのを防ぎ、k件の異なるファイルを提示する）
+RETRIEVER_DIVERSIFY = True
+RETRIEVER_DIVERSITY_UNIT = "source"       # 多様化の単位（"source": ファイル単位 / "page": ページ単位）
+RETRIEVER_MAX_CHUNKS_PER_SOURCE = 1       # 同じファイル（またはページ）から選ぶ最大件数
+RETRIEVER_MMR_LAMBDA = 0.7                # MMRの関連度と多様性の重み（1で関連度のみ）
+RETRIEVER_DIVERSITY_FETCH_FACTOR = 8      # 多様化する場合の候補数（k の何倍を取得するか）
+# 会話履歴がある場合に、質問の言い換え（LLM呼び出し）と並行して入力文そのままで先に検索しておくかどうか（投機的な検索）
+SPECULATIVE_RETRIEVAL_ENABLED = True
+# 言い換え後の質問と入力文の埋め込みのコサイン類似度がこの値以上なら、先に検索した結果をそのまま使う
+SPECULATIVE_RETRIEVAL_SIMILARITY_THRESHOLD = 0.95
+# 類似度が下限未満の場合に、言い換え後の質問での検索結果と統合する際の、先に検索した結果の重み（0の場合は統合しない）
+SPECULATIVE_RETRIEVAL_MERGE_WEIGHT = 0.5
+SPECULATIVE_RETRIEVAL_WORKERS = 8         # 投機的な検索を実行するスレッド数（プロセス内の全セッションで共有）
+# 会社名・部署名・製品名の辞書による検索対象の絞り込み（質問に含まれる名前に対応するファイルに検索を限定・優先）
+ENTITY_ROUTING_ENABLED = True
+# フォルダ名を名前とするフォルダ（この直下のフォルダ名を、その種類の名前とする。先に書いたものを優先）
+ENTITY_PARTITION_RULES = [
+    ("company", "./data/MTG議事録/顧客/既存"),
+    ("company", "./data/MTG議事録/顧客/見込み"),
+    ("department", "./data/MTG議事録"),
+]
+# ファイル名の「」内から製品名を取り出す対象のフォルダと、辞書に追加する製品名
+ENTITY_PRODUCT_FOLDER = "./data/サービスについて"
+ENTITY_PRODUCT_NAMES = []
+# 本文で名前に触れているファイルも、その名前の対象とする種類（部署名は本文に頻出するため対象外）
+ENTITY_TEXT_LINK_TYPES = ("company", "product")
+# 種類ごとの扱い（"restrict": 対象のファイルに検索を限定 / "boost": 対象のファイルの検索結果を順位の統合に加えて優先）
+ENTITY_ROUTING = {"company": "restrict", "department": "boost", "product": "boost"}
+ENTITY_BOOST_WEIGHT = 1.0                 # "boost" の場合の、対象のファイルに限定した検索結果の重み（RRF）
+# 表記ゆれ（名前にどちらかが含まれる場合、もう一方に置き換えた名前も辞書に加える）
+ENTITY_SPELLING_VARIANTS = [("ズン", "ゾン"), ("ヴァ", "バ"), ("ヴィ", "ビ"), ("ヴェ", "ベ"), ("ヴォ", "ボ")]
+ENTITY_COMPANY_SUFFIXES = ("株式会社", "合同会社", "有限会社")  # 省略した呼び方も辞書に加える法人格
+ENTITY_MIN_ALIAS_LENGTH = 3               # 省略・表記ゆれで作った名前の最小文字数（短すぎる名前による誤検出を防ぐ）
+
+# 社内文書検索の高速化（LLMに関連性を判定させず、ベクトル検索の関連度スコアで「該当資料なし」を判定）
+DOC_SEARCH_FAST_PATH = True
+# 最上位の関連度スコアの下限（Chroma の既定の距離（L2の2乗）では、関連度 = 1 - 距離 / √2。
+# 正規化済みの埋め込みではコサイン類似度0.78がおよそ0.69に相当）
+# 実データの「関連あり/なし」の質問のスコア分布を見て調整する
+DOC_SEARCH_SCORE_THRESHOLD = 0.69
+# 最上位のスコアが候補全体の平均を上回るべき幅（0の場合は判定しない）
+DOC_SEARCH_SCORE_MARGIN = 0.0
+
+# 表形式データ（CSV）への集計・絞り込み
+TABLE_CATEGORY_MAX_VALUES = 1000   # 値の種類がこの数以下の列を、絞り込み・グループ化の対象とする
+# 値の種類の数が行数のこの割合以下の列のみを対象とする（ID・氏名・メールアドレスなど、行ごとにほぼ異なる値の列を除く）
+TABLE_CATEGORY_MAX_RATIO = 0.5
+TABLE_QUERY_MAX_ROWS = 200         # LLMに文脈として渡す該当行の最大数
+# 表形式データを対象とした質問と判定する語（「社員向け規程の一覧」などを取り違えないよう、表の値も含む場合のみ）
+TABLE_QUERY_KEYWORDS = ("社員", "従業員", "名簿", "メンバー", "人材")
+TABLE_QUERY_COUNT_PATTERN = r"人数|何人|何名|件数|いくつ|数を|数は"
+TABLE_QUERY_LIST_PATTERN = r"一覧|リスト|全員|すべて|全て|洗い出"
 
 # ==========================================
 # LLM設定系
 # ==========================================
 MODEL = "gpt-4o-mini"
+EMBEDDING_MODEL = "text-embedding-ada-002"   # 埋め込みモデル（チャンクのトークン数もこのモデルのトークナイザーで数える）
 TEMPERATURE = 0.5
+LLM_HTTP_MAX_CONNECTIONS = 20     # LLMのAPIへの共有コネクションプールの最大接続数
+LLM_HTTP_KEEPALIVE_SECONDS = 60   # 使われていない接続を保持しておく秒数
+STREAM_INQUIRY_ANSWER = True      # 「社内問い合わせ」の回答本文をトークン単位で順次表示するかどうか
+# トークナイザーの定義ファイルの保存先（一度オンラインで取得すれば、以降はオフラインでも同じトークナイザーを使える。
+# 環境変数 TIKTOKEN_CACHE_DIR が設定されている場合はそちらを使う）
+TIKTOKEN_CACHE_DIR = "./tiktoken_cache"
+TOKENIZER_RETRY_SECONDS = 300     # トークナイザーの取得に失敗した場合に、取得し直すまでの秒数
+
+# OpenAI API の呼び出しの制御（プロセス内の全セッションで共有。チャットと埋め込みで別々に制限する）
+# - 同じ内容の呼び出しが同時に複数あれば、1回だけ送信して結果を共有する
+# - 同時実行数・1分あたりのトークン数の上限を超える場合は、順番待ちしてから送信する
+# - レート制限（429）・タイムアウト・接続エラー・サーバーエラーの場合は、ランダムな揺らぎ付きの指数的な間隔で再試行する
+OPENAI_CHAT_MAX_CONCURRENCY = 8
+OPENAI_CHAT_TPM_LIMIT = 200000            # 1分あたりのトークン数の上限（0の場合は制限しない）
+OPENAI_CHAT_COMPLETION_TOKENS_ESTIMATE = 500   # 上限の判定で見込む、1回の応答のトークン数
+OPENAI_EMBEDDING_MAX_CONCURRENCY = 4
+OPENAI_EMBEDDING_TPM_LIMIT = 1000000
+OPENAI_RETRY_MAX_ATTEMPTS = 5             # 最初の呼び出しを含む最大試行回数
+OPENAI_RETRY_BASE_SECONDS = 0.5           # 再試行の待ち時間の基準（試行ごとに2倍にし、0からその値までのランダムな時間だけ待つ）
+OPENAI_RETRY_MAX_SECONDS = 20.0
+OPENAI_QUEUE_TIMEOUT_SECONDS = 60.0       # 順番待ちの最大時間（超えた場合はエラーにする）
+OPENAI_REQUEST_TIMEOUT_SECONDS = 60.0     # 1回の API 呼び出しの通信のタイムアウト（期限切れで見切った呼び出しも、この時間で終わる）
+
+# 1回の質問の処理の期限（段階ごとの期限と、回答モードごとの全体の期限。どちらか早い方で打ち切る）
+# 期限切れの場合は、段階に応じて縮退した結果を返す（回答キャッシュには保存しない）
+# - 質問の言い換え: 入力文をそのまま検索に使う
+# - クエリのベクトル化・検索: 語彙検索のみの結果を使う
+# - 回答の生成: 社内文書検索は検索結果のファイル一覧のみ、社内問い合わせは参照元のみを表示する
+STAGE_DEADLINE_SECONDS = {
+    "rewrite": 8.0,
+    "embed": 3.0,
+    "retrieve": 5.0,
+    "generate": 45.0,
+}
+REQUEST_DEADLINE_SECONDS = {
+    ANSWER_MODE_1: 20.0,
+    ANSWER_MODE_2: 60.0,
+}
+STAGE_EXECUTOR_WORKERS = 64               # 期限付きで各段階を実行するスレッド数（プロセス内の全セッションで共有）
+# 冪等な呼び出し（クエリのベクトル化・社内文書検索の判定）が、直近の所要時間のパーセンタイルを超えても終わらない場合に、
+# 同じ呼び出しをもう1つ送り、先に終わった方を使う（ヘッジ）
+HEDGE_ENABLED = True
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20                    # 所要時間の記録がこの件数に満たない間はヘッジしない
+HEDGE_LATENCY_WINDOW = 200                # パーセンタイルの算出に使う直近の記録の件数
+
+# 回答キャッシュ（モード・独立した質問・モデル設定・インデックスのバージョンが同じ質問には、保存済みの回答を返す）
+ANSWER_CACHE_MAX_ENTRIES = 1000
+ANSWER_CACHE_TTL_SECONDS = 24 * 60 * 60
+# ディスクに保存する場合のSQLiteファイルのパス（None の場合はメモリ上のみ）
+ANSWER_CACHE_PERSIST_PATH = "./.cache/answer_cache.sqlite3"
+ANSWER_CACHE_PURGE_INTERVAL_SECONDS = 10 * 60  # 有効期限切れの回答をSQLiteファイルから削除する間隔（起動時にも削除する）
+
+# 会話履歴（直近のターンはそのまま送り、それより古いターンは要約に畳み込む）
+CHAT_HISTORY_MAX_TURNS = 4            # そのまま送る直近のターン数（1ターン = 質問 + 回答）
+CHAT_HISTORY_SUMMARY_MAX_CHARS = 400  # 古いターンの要約の最大文字数
+CHAT_HISTORY_FOLD_MAX_TURNS = 4       # 1回の要約で畳み込む最大ターン数（要約に失敗し続けても、送る会話が長くなり続けないように）
+CHAT_HISTORY_SUMMARY_WORKERS = 4      # 要約を実行するスレッド数（プロセス内の全セッションで共有）
+# 1回のリクエストで送る会話履歴（要約を含む）のトークン数の上限（回答モードごと）
+CHAT_HISTORY_TOKEN_BUDGET = {
+    ANSWER_MODE_1: 800,
+    ANSWER_MODE_2: 2000,
+}
+
+# 回答生成に渡す文脈（連続するチャンクをまとめた後、検索順位の高い順に上限まで詰める）
+CONTEXT_TOKEN_BUDGET = {
+    ANSWER_MODE_1: 2000,
+    ANSWER_MODE_2: 4000,
+}
+CONTEXT_MIN_OVERLAP_CHARS = 10  # 連続するチャンクの重なりとみなす最小の文字数
 
 
 # ==========================================
@@ -63,6 +205,90 @@ SUPPORTED_EXTENSIONS = {
 WEB_URL_LOAD_TARGETS = [
     "https://generative-ai.web-camp.io/"
 ]
+# ファイル読み込みの並列プロセス数（1の場合は並列化せず逐次読み込み）
+LOAD_MAX_WORKERS = 4
+
+
+# ==========================================
+# ベクターストア（インデックス）系
+# ==========================================
+# サーバープロセス内で1つだけ作成し、全セッションで共有するインデックスの保存先
+VECTOR_STORE_DIR_PATH = "./.vectorstore"
+VECTOR_STORE_COLLECTION_NAME = "company_inner_search"
+# データソースごとのサイズ・更新日時・ハッシュ値・チャンクIDを記録するマニフェスト（差分更新用）
+# 登録が完了したデータソースのみ記録されるため、作成途中で落ちた場合の再開地点も兼ねる
+VECTOR_STORE_MANIFEST_FILE = "manifest.json"
+# 登録するチャンクのメタデータなどの形式のバージョン（変更時は全データソースを再処理する）
+INDEX_SCHEMA_VERSION = 2
+# 検索に使うベクターストア（"chroma": Chroma をそのまま使う / "numpy": 更新後のインデックスをメモリマップする行列に書き出して使う）
+# ※ INDEX_WATCH_ENABLED が True の場合は、検索中に更新の影響を受けないよう常に "numpy" と同じく行列に書き出して使う
+VECTOR_STORE_BACKEND = "chroma"
+NUMPY_STORE_DIR_PATH = "./.vectorstore/numpy"   # インデックスのバージョンごとの書き出し先の親ディレクトリ
+# 行列の型（"float16" / "int8"）。int8 は行ごとの倍率付きで、容量が半分になり float32 への変換も速いが、精度がわずかに落ちる
+NUMPY_STORE_DTYPE = "float16"
+NUMPY_STORE_SEARCH_BLOCK_ROWS = 16384           # 検索時に1度に float32 に変換して内積を取る行数
+NUMPY_STORE_EXPORT_BATCH_SIZE = 2048            # 書き出し時に Chroma から1度に読み出すチャンク数
+
+# ./data 配下の変更を監視し、バックグラウンドでインデックスを差分更新して差し替えるかどうか
+# （監視する場合、検索にはバージョンごとに書き出した行列（NUMPY_STORE_DIR_PATH）を使う）
+INDEX_WATCH_ENABLED = True
+INDEX_WATCH_DEBOUNCE_SECONDS = 2.0       # 最後の変更からこの秒数だけ変更がなければ更新する
+INDEX_WATCH_MAX_DELAY_SECONDS = 30.0     # 変更が続いている場合でも、最初の変更からこの秒数で更新する
+INDEX_WATCH_POLL_INTERVAL_SECONDS = 5.0  # watchfiles が使えない場合の定期確認の間隔
+INDEX_WATCH_FORCE_POLLING = False        # watchfiles を使わず定期確認で監視するかどうか（ネットワークドライブなど）
+
+# 検索サーバー（retrieval_server.py）の URL。設定すると、各 Streamlit プロセスはインデックスを持たず検索サーバーに問い合わせる
+# （例: "http://127.0.0.1:8765" / Unix ドメインソケットの場合は "unix:/tmp/company_inner_search.sock"）
+RETRIEVAL_SERVER_URL = None
+RETRIEVAL_SERVER_HOST = "127.0.0.1"
+RETRIEVAL_SERVER_PORT = 8765
+RETRIEVAL_SERVER_LOG_FILE = "retrieval_server.log"
+RETRIEVAL_SERVER_EMBED_BATCH_SIZE = 64       # 検索クエリの埋め込みを1回のリクエストにまとめる最大件数
+RETRIEVAL_SERVER_EMBED_BATCH_WAIT_MS = 10    # 最初のクエリが届いてから、他のクエリをまとめるために待つ最大時間[ミリ秒]
+RETRIEVAL_SERVER_EMBED_WORKERS = 4           # 埋め込みモデルに同時に送るリクエスト数
+RETRIEVAL_CLIENT_MAX_CONNECTIONS = 8         # 1つの Streamlit プロセスから検索サーバーへの最大接続数（接続は使い回す）
+RETRIEVAL_CLIENT_TIMEOUT_SECONDS = 30.0
+RETRIEVAL_CLIENT_VERSION_CHECK_SECONDS = 2.0  # インデックスのバージョンを検索サーバーに確認する最短の間隔
+INDEX_BATCH_SIZE = 256             # ベクトル化・登録を行う1バッチあたりのチャンク数
+INDEX_CHECKPOINT_INTERVAL = 8      # ベクターストアとマニフェストを途中保存する間隔（バッチ数）
+# 内容がほぼ同じファイル（同じ文書のPDF版とWord版など）を1つだけ登録し、他のファイルのパスは正本のメタデータに残す
+DEDUP_ENABLED = True
+# 重複とみなす Jaccard 類似度（文字n-gramの集合の一致率）の下限
+# 同じ会議の「書き起こし（PDF）」と「要約した議事録（Word）」は内容が異なるため、この値では重複とみなさない
+DEDUP_SIMILARITY_THRESHOLD = 0.8
+DEDUP_SHINGLE_SIZE = 5             # 類似度の算出に使う文字n-gramの長さ
+DEDUP_NUM_PERM = 128               # MinHash の署名の長さ（長いほど類似度の推定が正確）
+# 類似度を算出する候補を絞り込むための、署名の分割数（LSH のバンド数。署名の長さを割り切れる値）
+# いずれかのバンドが一致したデータソースのみと比較する（4要素 × 32バンドでは、類似度0.8のデータソースはほぼ確実に候補に入る）
+DEDUP_LSH_BANDS = 32
+# 正本として優先する拡張子の順（ページ番号を持つPDFを優先）
+DEDUP_PREFERRED_EXTENSIONS = [".pdf", ".docx", ".txt", ".csv"]
+
+
+# ==========================================
+# 埋め込みキャッシュ系
+# ==========================================
+# 埋め込みモデル名と正規化したチャンク文字列をキーに、埋め込みベクトルを保存するSQLiteファイル
+EMBEDDING_CACHE_PATH = "./.cache/embedding_cache.sqlite3"
+# 保存時のベクトルの型（"float16" にすると容量は半分になるが、精度がわずかに落ちる）
+EMBEDDING_CACHE_DTYPE = "float32"
+EMBEDDING_BATCH_SIZE = 64          # 埋め込みモデルへの1リクエストあたりの最大テキスト件数
+EMBEDDING_BATCH_MAX_CHARS = 40000  # 埋め込みモデルへの1リクエストあたりの最大文字数
+EMBEDDING_MAX_CONCURRENCY = 4      # 埋め込みモデルへの同時リクエスト数の上限
+# 検索時のメモリ上のキャッシュ（インデックスのバージョンごとに持ち、インデックスが更新されると空の状態から使い始める）
+QUERY_EMBEDDING_CACHE_SIZE = 1024  # 正規化した検索クエリ → クエリの埋め込み の保持件数（LRU）
+RETRIEVAL_RESULT_CACHE_SIZE = 1024 # クエリの埋め込み・検索条件 → 検索結果のチャンクIDの順位 の保持件数（LRU）
+
+
+# ==========================================
+# 抽出済みテキストのキャッシュ系
+# ==========================================
+# PDF・Wordファイルなどから抽出したページ単位のテキストを、ファイルのハッシュ値ごとに保存する
+PARSED_TEXT_CACHE_ENABLED = True
+PARSED_TEXT_CACHE_DIR_PATH = "./.cache/parsed_text"
+# テキストの抽出処理を変更した場合に上げる（古いキャッシュは使われなくなり、prune で削除される）
+PARSED_TEXT_CACHE_VERSION = 1
+PARSED_TEXT_CACHE_ZSTD_LEVEL = 9   # zstd の圧縮レベル（zstandard がない環境では gzip で保存）
 
 
 # ==========================================
@@ -70,6 +296,18 @@ WEB_URL_LOAD_TARGETS = [
 # ==========================================
 SYSTEM_PROMPT_CREATE_INDEPENDENT_TEXT = "会話履歴と最新の入力をもとに、会話履歴なしでも理解できる独立した入力テキストを生成してください。"
 
+SYSTEM_PROMPT_SUMMARIZE_HISTORY = f"""
+    あなたは会話の要約アシスタントです。
+    これまでの要約に新しい会話を加えた要約を、{CHAT_HISTORY_SUMMARY_MAX_CHARS}文字以内で作成してください。
+    後続の質問の理解に必要な固有名詞（社員名、部署名、会社名、製品名、ファイル名など）や決定事項は残してください。
+
+    【これまでの要約】
+    {{summary}}
+
+    【新しい会話】
+    {{conversation}}
+"""
+
 SYSTEM_PROMPT_DOC_SEARCH = """
     あなたは社内の文書検索アシスタントです。
     以下の条件に基づき、ユーザー入力に対して回答してください。
@@ -104,6 +342,9 @@ SYSTEM_PROMPT_INQUIRY = """
 # ==========================================
 INQUIRY_NO_MATCH_ANSWER = "回答に必要な情報が見つかりませんでした。"
 NO_DOC_MATCH_ANSWER = "該当資料なし"
+GENERATION_TIMEOUT_ANSWER = "回答の生成が時間内に完了しなかったため、関連する可能性のある資料のみを表示します。"
+GENERATION_TIMEOUT_NOTE = "（回答の生成が時間内に完了しなかったため、途中までの回答を表示しています。）"
+RETRIEVAL_TIMEOUT_ANSWER = "資料の検索が時間内に完了しなかったため、回答できませんでした。時間をおいて再度お試しください。"
 
 
 # ==========================================
@@ -0,0 +1,141 @@
+"""
+このファイルは、検索結果のチャンクを回答生成の文脈に組み立てる処理が記述されたファイルです。
+- 同じファイル・同じページの連続するチャンクは、重なり部分を除いて1つの文脈にまとめる
+- 他の文脈に含まれる文脈は送らない
+- 検索順位の高い文脈から順に、トークン数の上限に収まる分だけを送る
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import logging
+from langchain_core.documents import Document
+import constants as ct
+from token_counter import count_tokens
+
+
+############################################################
+# 関数定義
+############################################################
+
+def chunk_position(doc):
+    """
+    ファイル内でのチャンクの通し番号（チャンクIDの末尾）
+
+    Args:
+        doc: ドキュメント
+
+    Returns:
+        通し番号（チャンクIDがない場合は None）
+    """
+    chunk_id = doc.metadata.get("chunk_id")
+    if not chunk_id:
+        return None
+    try:
+        return int(chunk_id.rsplit("-", 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def merge_text(former, latter, min_overlap=ct.CONTEXT_MIN_OVERLAP_CHARS):
+    """
+    連続する2つのチャンクの本文を、重なり部分を除いてつなげる
+
+    Args:
+        former: 前のチャンクの本文
+        latter: 後のチャンクの本文
+        min_overlap: 重なりとみなす最小の文字数（偶然の一致で文字を削らないため）
+
+    Returns:
+        つなげた本文
+    """
+    # 重なりの長さはチャンク分割の方式によって異なる（文単位の場合は文字数が決まらない）ため、長い方から順に確かめる
+    for size in range(min(len(former), len(latter)), min_overlap - 1, -1):
+        if former.endswith(latter[:size]):
+            return former + latter[size:]
+    return f"{former}\n{latter}"
+
+
+def merge_chunks(docs):
+    """
+    同じファイル・同じページの連続するチャンクをまとめ、他の文脈に含まれる文脈を除く
+
+    Args:
+        docs: 検索結果のドキュメントのリスト（検索順位の順）
+
+    Returns:
+        (文脈のドキュメント, 元のチャンクの最高順位, 元のチャンクIDのリスト) のリスト（最高順位の順）
+    """
+    groups = {}
+    for rank, doc in enumerate(docs):
+        key = (doc.metadata.get("source"), doc.metadata.get("page"))
+        groups.setdefault(key, []).append((rank, doc))
+
+    segments = []
+    for members in groups.values():
+        # 通し番号が分からないチャンクは、連続しているか判断できないため単独の文脈とする
+        members.sort(key=lambda member: (chunk_position(member[1]) is None, chunk_position(member[1]) or 0))
+        current = None
+        for rank, doc in members:
+            position = chunk_position(doc)
+            if current is not None and position is not None and current["position"] is not None:
+                if position == current["position"]:
+                    continue
+                if position == current["position"] + 1:
+                    current["text"] = merge_text(current["text"], doc.page_content)
+                    current["position"] = position
+                    current["rank"] = min(current["rank"], rank)
+                    current["chunk_ids"].append(doc.metadata["chunk_id"])
+                    continue
+            current = {
+                "text": doc.page_content,
+                "metadata": doc.metadata,
+                "position": position,
+                "rank": rank,
+                "chunk_ids": [doc.metadata.get("chunk_id")] if position is not None else [],
+            }
+            segments.append(current)
+
+    # 他の文脈にそのまま含まれる文脈（重複して送ることになる部分）は除く
+    kept = []
+    for segment in sorted(segments, key=lambda segment: len(segment["text"]), reverse=True):
+        if not any(segment["text"] in other["text"] for other in kept):
+            kept.append(segment)
+    kept.sort(key=lambda segment: segment["rank"])
+
+    return [
+        (Document(page_content=segment["text"], metadata=dict(segment["metadata"])), segment["rank"], segment["chunk_ids"])
+        for segment in kept
+    ]
+
+
+def pack_context(docs, token_budget):
+    """
+    検索結果のチャンクを、トークン数の上限に収まる文脈に組み立てる
+
+    Args:
+        docs: 検索結果のドキュメントのリスト（検索順位の順）
+        token_budget: 文脈のトークン数の上限
+
+    Returns:
+        回答生成に渡す文脈のドキュメントのリスト（検索順位の順）
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    packed = []
+    used_tokens = 0
+    for doc, rank, chunk_ids in merge_chunks(docs):
+        tokens = count_tokens(doc.page_content)
+        # 上限を超える文脈は飛ばし、より短い下位の文脈で残りの上限を埋める
+        if used_tokens + tokens > token_budget:
+            logger.info(f"文脈のトークン数の上限を超えるため送信しません: {doc.metadata.get('source')}（{tokens}トークン）")
+            continue
+        packed.append(doc)
+        used_tokens += tokens
+        logger.info(
+            f"文脈{len(packed)}: {doc.metadata.get('source')} ページ: {doc.metadata.get('page')} "
+            f"順位: {rank + 1} チャンク: {', '.join(chunk_ids) or 'なし'}（{tokens}トークン）"
+        )
+
+    logger.info(f"文脈を組み立てました（チャンク {len(docs)}件 → 文脈 {len(packed)}件, {used_tokens}トークン / 上限 {token_budget}）")
+    return packed
@@ -0,0 +1,236 @@
+"""
+このファイルは、1回の質問の処理を段階ごと（質問の言い換え・クエリのベクトル化・検索・回答の生成）の期限付きで実行する処理が記述されたファイルです。
+- 各段階は共有のスレッドで実行し、期限（段階ごとの期限と全体の残り時間の早い方）を過ぎたら待つのをやめて StageTimeout を送出する
+  （見切った呼び出しは裏で終わるまで動くが、Streamlit のスクリプトのスレッドは解放される。
+   ストリーミングの応答は、見切った時点で次の要素を待たずに読むのをやめ、イテレーターを閉じる）
+- 冪等な呼び出しは、直近の所要時間のパーセンタイルを過ぎても終わらなければ同じ呼び出しをもう1つ送り、先に終わった方を使う（ヘッジ）
+- 段階ごとの所要時間は、ヘッジの判定のためプロセス内で記録する（期限切れの場合も、期限の秒数以上かかったものとして記録する）
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import constants as ct
+from request_scheduler import independent_calls
+
+
+############################################################
+# 設定関連
+############################################################
+# ログに出力する段階の名前
+STAGE_LABELS = {
+    "rewrite": "質問の言い換え",
+    "embed": "クエリのベクトル化",
+    "retrieve": "検索",
+    "generate": "回答の生成",
+}
+_executor = ThreadPoolExecutor(max_workers=ct.STAGE_EXECUTOR_WORKERS, thread_name_prefix="stage")
+
+
+############################################################
+# 関数定義
+############################################################
+
+def _run_independently(fn):
+    """
+    ヘッジの複製の呼び出し（送信中の元の呼び出しに相乗りしないよう、新しく送信する）
+    """
+    with independent_calls():
+        return fn()
+
+
+############################################################
+# クラス定義
+############################################################
+
+class StageTimeout(TimeoutError):
+    """
+    段階の期限切れ
+    """
+
+    def __init__(self, stage, timeout):
+        super().__init__(f"{STAGE_LABELS.get(stage, stage)}が期限（{timeout:.2f}秒）内に完了しませんでした")
+        self.stage = stage
+        self.timeout = timeout
+
+
+class LatencyTracker:
+    """
+    段階ごとの直近の所要時間の記録（プロセス内の全セッションで共有）
+    """
+
+    def __init__(self, window=ct.HEDGE_LATENCY_WINDOW):
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._window = window
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self._samples.setdefault(stage, deque(maxlen=self._window)).append(seconds)
+
+    def percentile(self, stage, percentile, min_samples=ct.HEDGE_MIN_SAMPLES):
+        """
+        直近の所要時間のパーセンタイル
+
+        Returns:
+            秒数（記録が min_samples 件に満たない場合は None）
+        """
+        with self._lock:
+            samples = list(self._samples.get(stage, ()))
+        if len(samples) < min_samples:
+            return None
+        return float(np.percentile(samples, percentile))
+
+
+latency_tracker = LatencyTracker()
+
+
+class RequestDeadline:
+    """
+    1回の質問の処理全体の期限と、段階ごとの期限付きの実行
+    """
+
+    def __init__(self, total_seconds, stage_seconds=None):
+        """
+        Args:
+            total_seconds: 処理全体の期限[秒]
+            stage_seconds: 段階ごとの期限[秒]の辞書（省略時は STAGE_DEADLINE_SECONDS）
+        """
+        self.start = time.monotonic()
+        self.expires = self.start + total_seconds
+        self.stage_seconds = stage_seconds or ct.STAGE_DEADLINE_SECONDS
+
+    @classmethod
+    def for_mode(cls, mode):
+        """
+        回答モードごとの全体の期限で作成
+
+        Args:
+            mode: 回答モード
+
+        Returns:
+            RequestDeadline
+        """
+        return cls(ct.REQUEST_DEADLINE_SECONDS[mode])
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def timeout(self, stage):
+        """
+        段階に使える時間（段階ごとの期限と、全体の残り時間の短い方）
+        """
+        return min(self.stage_seconds[stage], self.remaining())
+
+    def run(self, stage, fn, hedge=False, track_as=None):
+        """
+        段階を期限付きで実行
+
+        Args:
+            stage: 段階の名前（STAGE_DEADLINE_SECONDS のキー）
+            fn: 実行する関数
+            hedge: 冪等な呼び出しで、遅い場合に同じ呼び出しをもう1つ送るかどうか
+            track_as: 所要時間を記録する名前（同じ段階でも所要時間の傾向が異なる呼び出しを分ける場合。省略時は stage）
+
+        Returns:
+            fn の戻り値
+        """
+        logger = logging.getLogger(ct.LOGGER_NAME)
+
+        timeout = self.timeout(stage)
+        if timeout <= 0:
+            raise StageTimeout(stage, 0.0)
+
+        start = time.monotonic()
+        futures = [_executor.submit(fn)]
+        track_as = track_as or stage
+        hedge_after = latency_tracker.percentile(track_as, ct.HEDGE_PERCENTILE) if hedge and ct.HEDGE_ENABLED else None
+        if hedge_after is not None and hedge_after < timeout:
+            done, _ = wait(futures, timeout=hedge_after)
+            if not done:
+                logger.info(
+                    f"{STAGE_LABELS[stage]}が{ct.HEDGE_PERCENTILE}パーセンタイル（{hedge_after * 1000:.0f}ms）を超えたため、"
+                    "同じ呼び出しをもう1つ送ります"
+                )
+                futures.append(_executor.submit(_run_independently, fn))
+
+        pending = futures
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, start + timeout - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    seconds = time.monotonic() - start
+                    latency_tracker.record(track_as, seconds)
+                    logger.info(
+                        f"{STAGE_LABELS[stage]}: {seconds * 1000:.1f}ms"
+                        + ("（ヘッジした呼び出しの結果）" if future is not futures[0] else "")
+                    )
+                    return future.result()
+                error = future.exception()
+        if error is not None and not pending:
+            raise error
+        # 期限切れの呼び出しも記録しないと、遅い呼び出しほど記録から漏れてパーセンタイルが実際より小さくなる
+        latency_tracker.record(track_as, max(time.monotonic() - start, timeout))
+        raise StageTimeout(stage, timeout)
+
+    def iterate(self, stage, iterator):
+        """
+        イテレーター（ストリーミングの応答など）を期限付きで読み進める（期限は読み切るまでの全体にかかる）
+
+        Args:
+            stage: 段階の名前
+            iterator: 読み進めるイテレーター
+
+        Yields:
+            イテレーターの要素
+        """
+        timeout = self.timeout(stage)
+        if timeout <= 0:
+            raise StageTimeout(stage, 0.0)
+
+        start = time.monotonic()
+        items = queue.Queue()
+        # 期限切れ・読み手の中断後に、共有のスレッドが応答を読み続けないための合図
+        stopped = threading.Event()
+
+        def _pump():
+            try:
+                for item in iterator:
+                    if stopped.is_set():
+                        break
+                    items.put((True, item))
+                else:
+                    items.put((False, None))
+            except Exception as e:
+                items.put((False, e))
+            finally:
+                # 読むのをやめた場合は、イテレーターを閉じて接続などを解放する（閉じられるのは読んでいるスレッドのみ）
+                if stopped.is_set() and hasattr(iterator, "close"):
+                    iterator.close()
+
+        _executor.submit(_pump)
+        try:
+            while True:
+                try:
+                    has_item, item = items.get(timeout=max(0.0, start + timeout - time.monotonic()))
+                except queue.Empty:
+                    latency_tracker.record(stage, max(time.monotonic() - start, timeout))
+                    raise StageTimeout(stage, timeout)
+                if not has_item:
+                    if item is not None:
+                        raise item
+                    latency_tracker.record(stage, time.monotonic() - start)
+                    return
+                yield item
+        finally:
+            stopped.set()
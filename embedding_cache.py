@@ -0,0 +1,203 @@
+"""
+このファイルは、埋め込みベクトルをローカルのSQLiteにキャッシュする処理が記述されたファイルです。
+- キャッシュキーは「埋め込みモデル名 + 正規化したチャンク文字列」のハッシュ値
+- キャッシュにないテキストのみ、件数・文字数の上限付きバッチに分け、同時実行数を制限して埋め込みモデルに送信
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import hashlib
+import logging
+import sqlite3
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from langchain_core.embeddings import Embeddings
+import constants as ct
+from token_counter import count_tokens
+
+
+############################################################
+# クラス定義
+############################################################
+
+class CachedEmbeddings(Embeddings):
+    """
+    埋め込みモデルをラップし、ドキュメントの埋め込みベクトルをSQLiteにキャッシュするクラス
+    - 埋め込みモデルは langchain の Embeddings であれば何でもよい（オフライン確認用の Fake も可）
+    - 検索クエリ（embed_query）はキャッシュせず、そのまま埋め込みモデルに渡す
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        cache_path=ct.EMBEDDING_CACHE_PATH,
+        dtype=ct.EMBEDDING_CACHE_DTYPE,
+        batch_size=ct.EMBEDDING_BATCH_SIZE,
+        batch_max_chars=ct.EMBEDDING_BATCH_MAX_CHARS,
+        max_concurrency=ct.EMBEDDING_MAX_CONCURRENCY
+    ):
+        """
+        Args:
+            embeddings: ラップする埋め込みモデル
+            cache_path: キャッシュ（SQLite）のファイルパス
+            dtype: 保存時のベクトルの型（"float32" または "float16"）
+            batch_size: 1リクエストあたりの最大テキスト件数
+            batch_max_chars: 1リクエストあたりの最大文字数
+            max_concurrency: 埋め込みモデルへの同時リクエスト数の上限
+        """
+        self.embeddings = embeddings
+        # モデルが変わった場合にキャッシュが混ざらないよう、キーにモデル名を含める
+        self.model_name = getattr(embeddings, "model", None) or type(embeddings).__name__
+        self.dtype = dtype
+        self.batch_size = batch_size
+        self.batch_max_chars = batch_max_chars
+        self.max_concurrency = max_concurrency
+
+        # Streamlitは複数スレッドから呼び出すため、1つの接続をロックで保護して共有
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, dtype TEXT NOT NULL, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    def embed_documents(self, texts):
+        """
+        ドキュメントの埋め込み（キャッシュにあるものは埋め込みモデルに送信しない）
+
+        Args:
+            texts: 埋め込み対象のテキストのリスト
+
+        Returns:
+            埋め込みベクトルのリスト
+        """
+        logger = logging.getLogger(ct.LOGGER_NAME)
+
+        keys = [self.cache_key(text) for text in texts]
+        vectors = self._get_many(set(keys))
+
+        # キャッシュにないテキストのみ（同一テキストは1回だけ）埋め込みモデルに送信
+        miss_texts = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors and key not in miss_texts:
+                miss_texts[key] = text
+
+        if miss_texts:
+            miss_keys = list(miss_texts.keys())
+            batches = self._make_batches(miss_keys, miss_texts)
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                results = list(executor.map(
+                    lambda batch: self.embeddings.embed_documents([miss_texts[key] for key in batch]),
+                    batches
+                ))
+            new_vectors = {}
+            for batch, batch_vectors in zip(batches, results):
+                new_vectors.update(zip(batch, batch_vectors))
+            self._put_many(new_vectors)
+            vectors.update(new_vectors)
+
+        hit_count = len(texts) - sum(1 for key in keys if key in miss_texts)
+        # 埋め込みモデルの料金・レート制限はトークン数で決まるため、省略した量もトークン数で数える
+        saved_tokens = sum(count_tokens(text, ct.EMBEDDING_MODEL) for key, text in zip(keys, texts) if key not in miss_texts)
+        logger.info(
+            f"埋め込みキャッシュ: ヒット {hit_count}件, ミス {len(miss_texts)}件, 送信を省略したトークン数 {saved_tokens}"
+        )
+
+        return [np.asarray(vectors[key], dtype=np.float32).tolist() for key in keys]
+
+    def embed_query(self, text):
+        """
+        検索クエリの埋め込み（キャッシュせずに埋め込みモデルへ渡す）
+
+        Args:
+            text: 検索クエリ
+
+        Returns:
+            埋め込みベクトル
+        """
+        return self.embeddings.embed_query(text)
+
+    def cache_key(self, text):
+        """
+        キャッシュキーの算出
+
+        Args:
+            text: 埋め込み対象のテキスト
+
+        Returns:
+            埋め込みモデル名と正規化したテキストのハッシュ値
+        """
+        normalized = unicodedata.normalize("NFC", text).strip()
+        return hashlib.sha256(f"{self.model_name}\n{normalized}".encode("utf-8")).hexdigest()
+
+    def _make_batches(self, keys, texts):
+        """
+        件数・文字数の上限を超えないようにバッチ分割
+
+        Args:
+            keys: キャッシュキーのリスト
+            texts: キャッシュキーからテキストへの辞書
+
+        Returns:
+            キャッシュキーのリストのリスト
+        """
+        batches = []
+        batch = []
+        batch_chars = 0
+        for key in keys:
+            text_chars = len(texts[key])
+            if batch and (len(batch) >= self.batch_size or batch_chars + text_chars > self.batch_max_chars):
+                batches.append(batch)
+                batch = []
+                batch_chars = 0
+            batch.append(key)
+            batch_chars += text_chars
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _get_many(self, keys):
+        """
+        キャッシュからの一括取得
+
+        Args:
+            keys: キャッシュキーの集合
+
+        Returns:
+            キャッシュキーから埋め込みベクトル（float32の配列）への辞書
+        """
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            # SQLiteのプレースホルダ数の上限を超えないよう分割して問い合わせ
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, dtype, vector FROM embeddings WHERE key IN ({','.join('?' * len(part))})",
+                    part
+                ).fetchall()
+                for key, dtype, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=dtype).astype(np.float32)
+        return found
+
+    def _put_many(self, vectors):
+        """
+        キャッシュへの一括保存
+
+        Args:
+            vectors: キャッシュキーから埋め込みベクトルへの辞書
+        """
+        rows = [
+            (key, self.dtype, np.asarray(vector, dtype=self.dtype).tobytes())
+            for key, vector in vectors.items()
+        ]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+            self._conn.commit()
@@ -0,0 +1,305 @@
+"""
+このファイルは、会社名・部署名・製品名の辞書（エンティティ辞書）による検索対象の絞り込みの処理が記述されたファイルです。
+- 辞書はインデックスのスナップショットの作成時に、フォルダ名（顧客ごと・部署ごとのフォルダ）とファイル名から作成する
+- 法人格を省いた呼び方や表記ゆれ（ホライズン/ホライゾンなど）も、同じ名前として辞書に加える
+- 名前ごとの対象ファイルは、その名前のフォルダ内のファイルと、本文でその名前に触れているファイル
+- 質問に含まれる名前は Aho–Corasick 法で検出するため、辞書の名前の数によらず質問の長さに比例した時間で済む
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import re
+import unicodedata
+from collections import deque
+import constants as ct
+
+
+############################################################
+# 設定関連
+############################################################
+# ログに出力する種類の名前
+ENTITY_TYPE_LABELS = {
+    "company": "会社",
+    "department": "部署",
+    "product": "製品",
+}
+
+
+############################################################
+# 関数定義
+############################################################
+
+def normalize_text(text):
+    """
+    名前の照合用の正規化（全角・半角と大文字・小文字の違いを無視する）
+
+    Args:
+        text: 対象のテキスト
+
+    Returns:
+        正規化したテキスト
+    """
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def name_variants(name, entity_type):
+    """
+    名前の別の呼び方（法人格の省略・表記ゆれ・区切り文字の省略）
+
+    Args:
+        name: 名前
+        entity_type: 名前の種類
+
+    Returns:
+        元の名前を含む、別の呼び方の集合
+    """
+    forms = {name}
+    if entity_type == "company":
+        for suffix in ct.ENTITY_COMPANY_SUFFIXES:
+            if name.endswith(suffix):
+                forms.add(name[:-len(suffix)])
+            if name.startswith(suffix):
+                forms.add(name[len(suffix):])
+
+    for a, b in ct.ENTITY_SPELLING_VARIANTS:
+        forms |= {form.replace(a, b) for form in forms} | {form.replace(b, a) for form in forms}
+    forms |= {form.replace("・", "") for form in forms}
+
+    return {name} | {form for form in forms if len(form) >= ct.ENTITY_MIN_ALIAS_LENGTH}
+
+
+def partition_entity(source, rules=ct.ENTITY_PARTITION_RULES):
+    """
+    ファイルのパスから、そのファイルが属するフォルダの名前と種類を取得
+
+    Args:
+        source: ファイルのパス
+        rules: (種類, 親フォルダ) のリスト（先に一致したものを使う）
+
+    Returns:
+        (種類, 名前)（どのフォルダにも属さない場合は None）
+    """
+    path = os.path.normpath(source)
+    for entity_type, parent in rules:
+        parent = os.path.normpath(parent) + os.sep
+        if path.startswith(parent):
+            parts = path[len(parent):].split(os.sep)
+            # 親フォルダの直下のファイルは、どの名前のフォルダにも属さない
+            if len(parts) >= 2:
+                return entity_type, parts[0]
+            return None
+    return None
+
+
+############################################################
+# クラス定義
+############################################################
+
+class AhoCorasick:
+    """
+    複数の文字列をテキストから一度に検出する Aho–Corasick オートマトン
+    """
+
+    def __init__(self, patterns):
+        """
+        Args:
+            patterns: 検出する文字列 → 検出時に返す値 の辞書
+        """
+        self._goto = [{}]
+        self._fail = [0]
+        self._outputs = [[]]
+        for pattern, value in patterns.items():
+            if not pattern:
+                continue
+            node = 0
+            for char in pattern:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._outputs.append([])
+                node = next_node
+            self._outputs[node].append((len(pattern), value))
+
+        # 幅優先で失敗遷移を作成し、失敗遷移先で検出される文字列も出力に含める
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_node] = self._goto[fail].get(char, 0) if node else 0
+                self._outputs[next_node] = self._outputs[next_node] + self._outputs[self._fail[next_node]]
+                queue.append(next_node)
+
+    def find(self, text):
+        """
+        テキスト中の出現箇所をすべて検出
+
+        Args:
+            text: 対象のテキスト
+
+        Yields:
+            (開始位置, 終了位置, 値)
+        """
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for length, value in self._outputs[node]:
+                yield i - length + 1, i + 1, value
+
+
+class EntityRoute:
+    """
+    質問に含まれる名前から決めた検索対象
+    """
+
+    def __init__(self, entities, restrict_sources, boost_sources):
+        """
+        Args:
+            entities: 検出した (種類, 名前) のリスト
+            restrict_sources: 検索を限定するファイルのパスの集合（限定しない場合は None）
+            boost_sources: 優先するファイルのパスの集合（優先しない場合は None）
+        """
+        self.entities = entities
+        self.restrict_sources = restrict_sources
+        self.boost_sources = boost_sources
+
+    @property
+    def key(self):
+        """
+        検索結果のキャッシュキーに含める値（同じインデックスのバージョンでは、名前から対象のファイルが決まる）
+        """
+        return tuple(sorted(self.entities))
+
+    def describe(self):
+        """
+        Returns:
+            ログ用の文字列
+        """
+        names = ", ".join(f"{name}（{ENTITY_TYPE_LABELS.get(entity_type, entity_type)}）" for entity_type, name in self.entities)
+        actions = []
+        if self.restrict_sources is not None:
+            actions.append(f"検索対象を{len(self.restrict_sources)}ファイルに限定")
+        if self.boost_sources is not None:
+            actions.append(f"{len(self.boost_sources)}ファイルを優先")
+        return f"{names} → {', '.join(actions)}"
+
+
+class EntityIndex:
+    """
+    会社名・部署名・製品名と、それぞれの対象ファイルの辞書
+    """
+
+    def __init__(self, sources_by_entity):
+        """
+        Args:
+            sources_by_entity: (種類, 名前) → 対象ファイルのパスの集合 の辞書
+        """
+        self.sources_by_entity = sources_by_entity
+        self._automaton = AhoCorasick(self._aliases(sources_by_entity))
+
+    @staticmethod
+    def _aliases(entities):
+        """
+        正規化した別の呼び方 → (種類, 名前) の辞書（同じ呼び方の名前が複数ある場合は、先に作ったものを使う）
+        """
+        aliases = {}
+        for entity_type, name in entities:
+            for variant in name_variants(name, entity_type):
+                aliases.setdefault(normalize_text(variant), (entity_type, name))
+        return aliases
+
+    @classmethod
+    def build(cls, documents):
+        """
+        チャンクのドキュメントから辞書を作成
+
+        Args:
+            documents: チャンクのドキュメントのリスト
+
+        Returns:
+            作成した EntityIndex
+        """
+        sources_by_entity = {}
+        sources = {doc.metadata.get("source") for doc in documents} - {None}
+        for source in sorted(sources):
+            entity = partition_entity(source)
+            if entity is not None:
+                sources_by_entity.setdefault(entity, set()).add(source)
+            # 製品名は、サービスのファイル名の「」内から取り出す（例: Webサービス「EcoTee Creator」について.docx）
+            if os.path.normpath(source).startswith(os.path.normpath(ct.ENTITY_PRODUCT_FOLDER) + os.sep):
+                for name in re.findall(r"「(.+?)」", os.path.basename(source)):
+                    sources_by_entity.setdefault(("product", name), set()).add(source)
+        for name in ct.ENTITY_PRODUCT_NAMES:
+            sources_by_entity.setdefault(("product", name), set())
+
+        # 本文で名前に触れているファイルも、その名前の対象に加える
+        linked = {entity: sources for entity, sources in sources_by_entity.items() if entity[0] in ct.ENTITY_TEXT_LINK_TYPES}
+        if linked:
+            automaton = AhoCorasick(cls._aliases(linked))
+            for doc in documents:
+                source = doc.metadata.get("source")
+                if source is None:
+                    continue
+                for _, _, entity in automaton.find(normalize_text(doc.page_content)):
+                    sources_by_entity[entity].add(source)
+
+        return cls({entity: frozenset(sources) for entity, sources in sources_by_entity.items() if sources})
+
+    def detect(self, query):
+        """
+        質問に含まれる名前の検出（重なる場合は、長い方の名前を使う）
+
+        Args:
+            query: 質問
+
+        Returns:
+            (種類, 名前) のリスト（出現順、重複なし）
+        """
+        matches = sorted(self._automaton.find(normalize_text(query)), key=lambda match: (match[0], -match[1]))
+        entities = []
+        covered_until = 0
+        for start, end, entity in matches:
+            # 長い名前の一部分として現れた別の名前（例: 会社名の中の部署名）は除く
+            if end <= covered_until:
+                continue
+            covered_until = max(covered_until, end)
+            if entity not in entities:
+                entities.append(entity)
+        return entities
+
+    def route(self, query, routing=ct.ENTITY_ROUTING):
+        """
+        質問に含まれる名前から、検索対象を決める
+
+        Args:
+            query: 質問
+            routing: 種類ごとの扱い（"restrict" / "boost"）
+
+        Returns:
+            EntityRoute（名前が含まれない場合は None）
+        """
+        entities = self.detect(query)
+        if not entities:
+            return None
+
+        restrict_sources, boost_sources = None, None
+        for entity in entities:
+            sources = self.sources_by_entity[entity]
+            if routing.get(entity[0]) == "restrict":
+                restrict_sources = (restrict_sources or frozenset()) | sources
+            elif routing.get(entity[0]) == "boost":
+                boost_sources = (boost_sources or frozenset()) | sources
+        # 限定した範囲の外のファイルは、優先する意味がない
+        if restrict_sources is not None and boost_sources is not None:
+            boost_sources = (boost_sources & restrict_sources) or None
+
+        return EntityRoute(entities, restrict_sources, boost_sources)
@@ -0,0 +1,369 @@
+"""
+このファイルは、インデックス（ベクターストア・語彙検索用インデックス・名前の辞書・表形式データ）の現在の版を管理し、
+./data 配下の変更を監視してバックグラウンドで更新する処理が記述されたファイルです。
+- 検索に使う一式を「スナップショット」として1つのオブジェクトにまとめ、更新時は新しいスナップショットを作ってから参照を差し替える
+  （参照の代入は1命令で行われるため、検索中のリクエストは取得済みのスナップショットを最後まで使い、更新待ちでブロックされない）
+- 監視は watchfiles（Linux では inotify）で行い、使えない環境ではファイルのサイズ・更新日時の定期確認に切り替える
+- 変更が続く間は待ち（デバウンス）、落ち着いてからまとめて差分更新する
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import time
+import shutil
+import logging
+import threading
+from langchain_core.documents import Document
+import constants as ct
+import indexing
+from entity_index import EntityIndex
+from lexical_index import LexicalIndex
+from retrieval_cache import RetrievalCache
+from retrievers import HybridRetriever
+from table_query import TableStore
+from numpy_store import NumpyVectorStore, prune_snapshots
+
+try:
+    import watchfiles
+except ImportError:
+    watchfiles = None
+
+
+############################################################
+# クラス定義
+############################################################
+
+class IndexSnapshot:
+    """
+    ある時点のインデックスの一式（作成後は変更しない）
+    """
+
+    def __init__(self, version, vector_store, lexical_index, table_store, entity_index=None):
+        """
+        Args:
+            version: インデックスのバージョン
+            vector_store: 検索用のベクターストア
+            lexical_index: 語彙検索用インデックス（ベクトル検索のみの場合は None）
+            table_store: 表形式データ（CSV）の集計用テーブル
+            entity_index: 会社名・部署名・製品名の辞書（検索対象を絞り込まない場合は None）
+        """
+        self.version = version
+        self.vector_store = vector_store
+        self.lexical_index = lexical_index
+        self.table_store = table_store
+        self.entity_index = entity_index
+        # ベクターストアを検索するRetriever（状態を持たないため、全セッションで共有する）
+        # - "hybrid" の場合は、ベクトル検索 + 語彙検索（社員IDや会社名など、完全一致させたい語の取りこぼしを防ぐ）
+        self.retriever = HybridRetriever(
+            vector_store=vector_store,
+            lexical_index=lexical_index,
+            k=ct.RETRIEVER_TOP_K,
+            diversify=ct.RETRIEVER_DIVERSIFY,
+            # キャッシュはスナップショットごとに持ち、インデックスが更新されると新しいスナップショットの空のキャッシュに切り替わる
+            cache=RetrievalCache(version),
+            entity_index=entity_index
+        )
+
+
+class IndexManager:
+    """
+    インデックスの現在のスナップショットの保持と、バックグラウンドでの更新を行うクラス
+    """
+
+    def __init__(self, db, isolate_snapshots=None):
+        """
+        初回の差分更新を行い、最初のスナップショットを作成する
+
+        Args:
+            db: 差分更新の書き込み先となる Chroma のベクターストア
+            isolate_snapshots: 検索用のベクターストアを、バージョンごとの行列（NumpyVectorStore）に書き出すかどうか
+                （省略時は、VECTOR_STORE_BACKEND が "numpy" の場合またはディレクトリを監視する場合に書き出す）
+        """
+        self._db = db
+        if isolate_snapshots is None:
+            isolate_snapshots = ct.VECTOR_STORE_BACKEND == "numpy" or ct.INDEX_WATCH_ENABLED
+        self._isolate_snapshots = isolate_snapshots
+        # 差分更新（Chroma への書き込み）は同時に1つだけ実行する
+        self._refresh_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._snapshot = None
+        self.last_refresh_seconds = None
+        self.refresh()
+
+    @classmethod
+    def open(cls, embeddings, isolate_snapshots=None):
+        """
+        ディスク上のインデックスを開き、データソースとの差分を反映した IndexManager を作成
+
+        Args:
+            embeddings: 埋め込みモデル
+            isolate_snapshots: 検索用のベクターストアを、バージョンごとの行列に書き出すかどうか（省略時は IndexManager の既定）
+
+        Returns:
+            作成した IndexManager
+        """
+        logger = logging.getLogger(ct.LOGGER_NAME)
+
+        # マニフェストがない（＝どの時点の状態か分からない）インデックスが残っている場合は削除してから作り直す
+        manifest_path = os.path.join(ct.VECTOR_STORE_DIR_PATH, ct.VECTOR_STORE_MANIFEST_FILE)
+        if os.path.isdir(ct.VECTOR_STORE_DIR_PATH) and not os.path.isfile(manifest_path):
+            shutil.rmtree(ct.VECTOR_STORE_DIR_PATH)
+
+        # ベクターストアを開き、データソースとの差分のみ反映（作成途中で落ちていた場合は続きから再開）
+        index_manager = cls(indexing.open_vector_store(embeddings), isolate_snapshots)
+        logger.info(f"ベクターストアの準備が完了しました: {ct.VECTOR_STORE_DIR_PATH}")
+        return index_manager
+
+    @property
+    def current(self):
+        """
+        現在のスナップショット（リクエストの開始時に1度だけ取得し、そのリクエスト内では同じものを使う）
+        """
+        return self._snapshot
+
+    def refresh(self):
+        """
+        データソースとの差分をインデックスに反映し、変更があれば新しいスナップショットに差し替える
+
+        Returns:
+            スナップショットを差し替えたかどうか
+        """
+        logger = logging.getLogger(ct.LOGGER_NAME)
+
+        with self._refresh_lock:
+            start = time.perf_counter()
+            indexing.sync_vector_store(self._db)
+            version = indexing.get_index_version()
+
+            previous = self._snapshot
+            if previous is not None and previous.version == version:
+                logger.info(f"インデックスに変更はありません（バージョン: {version}）")
+                return False
+
+            snapshot = self._build_snapshot(version)
+            # 参照の差し替えのみで公開する（検索中のリクエストは古いスナップショットを使い続ける）
+            self._snapshot = snapshot
+            self.last_refresh_seconds = time.perf_counter() - start
+
+            if self._isolate_snapshots:
+                # 直前のバージョンは、差し替え前に取得したリクエストが使い終わるまで残す
+                keep = [self._snapshot_name(version)]
+                if previous is not None:
+                    keep.append(self._snapshot_name(previous.version))
+                prune_snapshots(ct.NUMPY_STORE_DIR_PATH, keep=keep)
+
+            logger.info(
+                f"インデックスを公開しました（バージョン: {previous.version if previous else 'なし'} → {version}, "
+                f"更新の所要時間: {self.last_refresh_seconds:.2f}秒）"
+            )
+            return True
+
+    def _snapshot_name(self, version):
+        """
+        バージョンごとの行列の書き出し先のディレクトリ名
+
+        Args:
+            version: インデックスのバージョン
+
+        Returns:
+            ディレクトリ名
+        """
+        return f"{version}-{ct.NUMPY_STORE_DTYPE}"
+
+    def _build_snapshot(self, version):
+        """
+        現在のインデックスからスナップショットを作成
+
+        Args:
+            version: インデックスのバージョン
+
+        Returns:
+            作成した IndexSnapshot
+        """
+        logger = logging.getLogger(ct.LOGGER_NAME)
+
+        vector_store = self._db
+        if self._isolate_snapshots:
+            # 次の差分更新で Chroma に書き込んでも影響を受けないよう、このバージョンの内容を行列に書き出して検索に使う
+            start = time.perf_counter()
+            vector_store = NumpyVectorStore.from_chroma(
+                self._db, os.path.join(ct.NUMPY_STORE_DIR_PATH, self._snapshot_name(version))
+            )
+            logger.info(
+                f"検索用の行列を開きました（チャンク数: {len(vector_store)}, 所要時間: {time.perf_counter() - start:.2f}秒）: "
+                f"{vector_store.path}"
+            )
+
+        lexical_index = None
+        if ct.RETRIEVER_MODE == "hybrid":
+            start = time.perf_counter()
+            lexical_index = LexicalIndex.from_vector_store(vector_store)
+            logger.info(
+                f"語彙検索用インデックスを作成しました（チャンク数: {len(lexical_index.documents)}, "
+                f"索引語数: {len(lexical_index.postings)}, 所要時間: {time.perf_counter() - start:.2f}秒）"
+            )
+
+        entity_index = None
+        if ct.ENTITY_ROUTING_ENABLED:
+            start = time.perf_counter()
+            if lexical_index is not None:
+                documents = lexical_index.documents
+            else:
+                data = vector_store.get(include=["documents", "metadatas"])
+                documents = [
+                    Document(page_content=text, metadata=metadata or {})
+                    for text, metadata in zip(data["documents"], data["metadatas"])
+                ]
+            entity_index = EntityIndex.build(documents)
+            logger.info(
+                f"会社名・部署名・製品名の辞書を作成しました（名前の数: {len(entity_index.sources_by_entity)}, "
+                f"所要時間: {time.perf_counter() - start:.2f}秒）"
+            )
+
+        table_store = TableStore.load(indexing.collect_source_files(ct.RAG_TOP_FOLDER_PATH))
+        logger.info(
+            "表形式データを読み込みました: "
+            + ", ".join(f"{table.path}（{len(table.df)}行）" for table in table_store.tables)
+        )
+
+        return IndexSnapshot(version, vector_store, lexical_index, table_store, entity_index)
+
+    def start_watching(self, path=ct.RAG_TOP_FOLDER_PATH):
+        """
+        ディレクトリの監視を別スレッドで開始（変更が落ち着いたら差分更新する）
+
+        Args:
+            path: 監視するディレクトリ
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=watch_directory, args=(path, self._on_change, self._stop_event), name="index-watcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop_watching(self):
+        """
+        ディレクトリの監視を停止
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _on_change(self, paths):
+        """
+        ディレクトリの変更時の処理（監視スレッドで実行）
+
+        Args:
+            paths: 変更されたファイルパスの集合
+        """
+        logger = logging.getLogger(ct.LOGGER_NAME)
+        logger.info(f"データソースの変更を検知しました（{len(paths)}件）: {', '.join(sorted(paths)[:5])}")
+        try:
+            self.refresh()
+        except Exception as e:
+            # 更新に失敗しても、現在のスナップショットで検索を続ける（次の変更時に再度更新する）
+            logger.error(f"インデックスの更新に失敗しました: {e}", exc_info=True)
+
+
+############################################################
+# 関数定義
+############################################################
+
+def is_watched_file(path):
+    """
+    監視対象のファイルか（対応している拡張子で、一時ファイル・隠しファイルでないもの）
+
+    Args:
+        path: ファイルパス
+
+    Returns:
+        監視対象かどうか
+    """
+    name = os.path.basename(path)
+    if name.startswith((".", "~$")):
+        return False
+    return os.path.splitext(name)[1] in ct.SUPPORTED_EXTENSIONS
+
+
+def watch_directory(path, on_change, stop_event):
+    """
+    ディレクトリを監視し、変更が落ち着くたびに on_change を呼び出す（stop_event が立つまで戻らない）
+
+    Args:
+        path: 監視するディレクトリ
+        on_change: 変更されたファイルパスの集合を受け取る関数
+        stop_event: 監視を停止するためのイベント
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    if watchfiles is not None and not ct.INDEX_WATCH_FORCE_POLLING:
+        try:
+            logger.info(f"データソースの監視を開始しました（watchfiles）: {path}")
+            # 最後の変更から step の時間だけ変更がなければ、それまでの変更がまとめて返される（変更が続いても debounce の時間で打ち切る）
+            # on_change の実行中に起きた変更は、次の繰り返しでまとめて返される
+            for changes in watchfiles.watch(
+                path,
+                watch_filter=lambda change, changed_path: is_watched_file(changed_path),
+                step=int(ct.INDEX_WATCH_DEBOUNCE_SECONDS * 1000),
+                debounce=int(ct.INDEX_WATCH_MAX_DELAY_SECONDS * 1000),
+                stop_event=stop_event,
+                raise_interrupt=False
+            ):
+                on_change({changed_path for _, changed_path in changes})
+            return
+        except Exception as e:
+            if stop_event.is_set():
+                return
+            logger.warning(f"watchfiles による監視ができないため、定期確認に切り替えます: {e}")
+
+    poll_directory(path, on_change, stop_event)
+
+
+def poll_directory(path, on_change, stop_event):
+    """
+    ファイルのサイズ・更新日時を定期的に確認して変更を検知（watchfiles が使えない場合の代わり）
+
+    Args:
+        path: 監視するディレクトリ
+        on_change: 変更されたファイルパスの集合を受け取る関数
+        stop_event: 監視を停止するためのイベント
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    logger.info(f"データソースの監視を開始しました（{ct.INDEX_WATCH_POLL_INTERVAL_SECONDS}秒ごとの定期確認）: {path}")
+
+    def _scan():
+        state = {}
+        for file_path in indexing.collect_source_files(path):
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            state[file_path] = (stat.st_size, stat.st_mtime)
+        return state
+
+    def _diff(before, after):
+        return {key for key in before.keys() | after.keys() if before.get(key) != after.get(key)}
+
+    state = _scan()
+    while not stop_event.wait(ct.INDEX_WATCH_POLL_INTERVAL_SECONDS):
+        current = _scan()
+        changed = _diff(state, current)
+        if not changed:
+            continue
+        # 変更が続く間は待ち、デバウンスの時間だけ変化がなくなってから更新する（変更が続いても上限の時間で打ち切る）
+        deadline = time.monotonic() + ct.INDEX_WATCH_MAX_DELAY_SECONDS
+        while not stop_event.wait(ct.INDEX_WATCH_DEBOUNCE_SECONDS):
+            latest = _scan()
+            if latest == current or time.monotonic() >= deadline:
+                break
+            changed |= _diff(current, latest)
+            current = latest
+        if stop_event.is_set():
+            return
+        state = current
+        on_change(changed)
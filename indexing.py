@@ -0,0 +1,701 @@
+"""
+このファイルは、RAGの参照先となるデータソースを読み込み、ベクターストア（インデックス）を作成・更新する処理が記述されたファイルです。
+- データソース（./data 配下のファイル、Webページ）の読み込み（ファイルから抽出したテキストはキャッシュして再利用）
+- マニフェスト（ファイルごとのサイズ・更新日時・ハッシュ値・チャンクID）による差分更新
+- バッチ単位のベクトル化・登録と、途中保存（チェックポイント）による再開
+- 内容がほぼ同じファイル（同じ文書のPDF版とWord版など）の統合
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import json
+import hashlib
+import logging
+import sys
+import unicodedata
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from langchain_community.document_loaders import WebBaseLoader
+from langchain.text_splitter import CharacterTextSplitter
+from langchain_community.vectorstores import Chroma
+import constants as ct
+from near_duplicates import minhash_signature, estimate_similarity, canonical_rank, MinHashLSH
+from japanese_text_splitter import JapaneseTextSplitter
+from token_counter import get_encoding, get_encoding_name
+import parsed_text_cache
+from constants import CHUNK_SIZE, CHUNK_OVERLAP
+
+
+############################################################
+# 関数定義
+############################################################
+
+def open_vector_store(embeddings):
+    """
+    ディスク上のベクターストアを開く（存在しなければ空のベクターストアが作成される）
+
+    Args:
+        embeddings: 埋め込みモデル
+
+    Returns:
+        ベクターストア
+    """
+    return Chroma(
+        collection_name=ct.VECTOR_STORE_COLLECTION_NAME,
+        embedding_function=embeddings,
+        persist_directory=ct.VECTOR_STORE_DIR_PATH
+    )
+
+
+def sync_vector_store(db):
+    """
+    マニフェストとデータソースの現状を比較し、追加・変更・削除があったデータソースのみベクターストアに反映する
+    - 「ファイル探索 → 読み込み → 文字列調整・チャンク分割 → バッチ単位のベクトル化・登録」を
+      ジェネレーターでつないで処理するため、メモリ使用量はコーパス全体ではなくバッチサイズに比例する
+    - 一定バッチごとにベクターストアとマニフェストを保存するため、途中で落ちても続きから再開できる
+
+    Args:
+        db: 更新対象のベクターストア
+
+    Returns:
+        処理件数（skipped: 変更なし, updated: 追加・変更, deleted: 削除, failed: 読み込み失敗）の辞書
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    manifest = load_manifest()
+    sources = manifest["sources"]
+    stats = {"skipped": 0, "updated": 0, "deleted": 0, "failed": 0}
+
+    # トークナイザーを取得できない場合は文字数で分割し、設定にもその旨（"chars"）を記録する
+    # （初回の作成でも検索できるインデックスを作り、取得できるようになった後の更新で全データソースを分割し直す）
+    if ct.TEXT_SPLITTER == "japanese" and get_encoding(ct.EMBEDDING_MODEL) is None:
+        logger.warning(
+            f"トークナイザー（{get_encoding_name(ct.EMBEDDING_MODEL)}）を取得できないため、文字数でチャンクに分割します。"
+            f"定義ファイルを {os.environ.get('TIKTOKEN_CACHE_DIR')} に配置すると、次回の更新時にトークン数で分割し直します。"
+        )
+
+    # チャンク分割などの設定が前回と異なる場合、全データソースを再処理対象にする
+    # （途中で落ちても再処理対象のまま残るよう、エントリのサイズ・ハッシュ値を消してから保存）
+    if manifest.get("config") != get_index_config():
+        if sources:
+            logger.info("インデックスの設定が変更されたため、全データソースを再処理します。")
+        for entry in sources.values():
+            entry.update({"size": None, "mtime": None, "sha256": None})
+        manifest["config"] = get_index_config()
+
+    # 作成途中でも再開できるよう、処理開始時点でマニフェストを書き出しておく
+    save_manifest(manifest)
+
+    writer = IndexWriter(db, manifest)
+
+    # ./data 配下のファイル（変更があったファイルのみ、順に読み込んでバッチに積む）
+    current_paths = collect_source_files(ct.RAG_TOP_FOLDER_PATH)
+    pending = {}
+    changed_paths = iter_changed_files(current_paths, sources, pending, stats)
+    # 変更の判定で算出したハッシュ値を、抽出済みテキストのキャッシュの照合にも使う（ファイルを読み直してハッシュ値を算出しない）
+    for path, docs in load_files(changed_paths, digest_of=lambda path: pending[path]["sha256"]):
+        info = pending.pop(path)
+        # 読み込みに失敗したファイルはマニフェストを更新せず、次回の更新時に再度読み込む
+        if docs is None:
+            stats["failed"] += 1
+            continue
+        writer.add_source(path, info, docs)
+        stats["updated"] += 1
+
+    # Webページ（取得した本文のハッシュ値で変更の有無を判定）
+    for web_url in ct.WEB_URL_LOAD_TARGETS:
+        entry = sources.get(web_url)
+        try:
+            docs = WebBaseLoader(web_url).load()
+        except Exception as e:
+            logger.error(f"Webページの読み込みに失敗しました: {web_url}\n{e}")
+            stats["failed"] += 1
+            continue
+        digest = hashlib.sha256("".join(doc.page_content for doc in docs).encode("utf-8")).hexdigest()
+        if entry and entry["sha256"] == digest:
+            stats["skipped"] += 1
+            continue
+
+        info = {"size": sum(len(doc.page_content) for doc in docs), "mtime": None, "sha256": digest}
+        writer.add_source(web_url, info, docs)
+        stats["updated"] += 1
+
+    # 削除されたデータソースのチャンクをベクターストアから除去
+    current_keys = set(current_paths) | set(ct.WEB_URL_LOAD_TARGETS)
+    for key in [key for key in sources if key not in current_keys]:
+        writer.remove_source(key)
+        stats["deleted"] += 1
+
+    # 残りのバッチを登録
+    writer.flush()
+    writer.checkpoint()
+
+    # 重複として登録を省いたデータソースと、それにより減ったチャンク数
+    duplicates = [entry for entry in sources.values() if entry.get("duplicate_of")]
+    saved_chunks = sum(entry.get("duplicate_chunks", 0) for entry in duplicates)
+    index_size = db._collection.count()
+
+    logger.info(
+        f"インデックスを更新しました（スキップ: {stats['skipped']}件, 更新: {stats['updated']}件, "
+        f"削除: {stats['deleted']}件, 失敗: {stats['failed']}件）"
+    )
+    logger.info(
+        f"重複の統合: {len(duplicates)}ファイル, チャンク数: {index_size + saved_chunks}件 → {index_size}件"
+    )
+
+    return stats
+
+
+def iter_changed_files(paths, sources, pending, stats):
+    """
+    前回の更新から追加・変更されたファイルのみを順に返す
+
+    Args:
+        paths: ファイルパスのリスト
+        sources: マニフェスト上のデータソースごとのエントリ
+        pending: 返したファイルのサイズ・更新日時・ハッシュ値を格納する辞書（読み込み後に取り出す）
+        stats: 処理件数の辞書（変更なしの件数を加算）
+
+    Yields:
+        追加・変更されたファイルのパス
+    """
+    for path in paths:
+        entry = sources.get(path)
+        stat = os.stat(path)
+
+        # サイズと更新日時が前回と同じであれば、中身を読まずにスキップ
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            stats["skipped"] += 1
+            continue
+
+        # 更新日時だけが変わり、中身が同じ場合もスキップ（マニフェストのみ更新）
+        digest = file_sha256(path)
+        if entry and entry["sha256"] == digest:
+            entry["size"] = stat.st_size
+            entry["mtime"] = stat.st_mtime
+            stats["skipped"] += 1
+            continue
+
+        pending[path] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": digest}
+        yield path
+
+
+def split_documents(docs):
+    """
+    ドキュメントの文字列調整とチャンク分割
+
+    Args:
+        docs: 読み込んだドキュメントのリスト
+
+    Returns:
+        チャンク分割後のドキュメントのリスト
+    """
+    # OSがWindowsの場合、Unicode正規化と、cp932（Windows用の文字コード）で表現できない文字を除去
+    for doc in docs:
+        doc.page_content = adjust_string(doc.page_content)
+        for key in doc.metadata:
+            doc.metadata[key] = adjust_string(doc.metadata[key])
+
+    # チャンク分割用のオブジェクトを作成
+    if ct.TEXT_SPLITTER == "japanese":
+        text_splitter = JapaneseTextSplitter()
+    else:
+        text_splitter = CharacterTextSplitter(
+            chunk_size=CHUNK_SIZE,
+            chunk_overlap=CHUNK_OVERLAP,
+            separator="\n"
+        )
+
+    # チャンク分割を実施
+    return text_splitter.split_documents(docs)
+
+
+def get_index_config():
+    """
+    インデックスの設定（変更時に全データソースを再処理するため、マニフェストに記録する）
+
+    Returns:
+        スキーマのバージョン、チャンク分割と重複の統合の設定の辞書
+    """
+    return {
+        "schema": ct.INDEX_SCHEMA_VERSION,
+        "text_splitter": ct.TEXT_SPLITTER,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "chunk_tokens": [ct.CHUNK_SIZE_TOKENS, ct.CHUNK_OVERLAP_TOKENS, ct.CHUNK_MIN_FILL_RATIO, ct.CHUNK_HEADING_MAX_CHARS],
+        # 埋め込みモデルのトークナイザーが変わったら作り直す
+        # （取得できずに文字数で分割した場合は "chars" を記録し、取得できるようになった時点で作り直す）
+        "tokenizer": get_encoding_name(ct.EMBEDDING_MODEL) if get_encoding(ct.EMBEDDING_MODEL) is not None else "chars",
+        "dedup": [ct.DEDUP_ENABLED, ct.DEDUP_SIMILARITY_THRESHOLD, ct.DEDUP_SHINGLE_SIZE, ct.DEDUP_NUM_PERM, ct.DEDUP_PREFERRED_EXTENSIONS],
+    }
+
+
+def get_index_version(manifest=None):
+    """
+    インデックスのバージョンの算出（データソースの中身または設定が変わると値が変わる）
+
+    Args:
+        manifest: マニフェスト（省略時はディスクから読み込む）
+
+    Returns:
+        インデックスのバージョン（ハッシュ値の先頭16文字）
+    """
+    if manifest is None:
+        manifest = load_manifest()
+    payload = json.dumps(
+        [manifest.get("config"), sorted((key, entry["sha256"]) for key, entry in manifest["sources"].items())],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def load_manifest():
+    """
+    マニフェストの読み込み
+
+    Returns:
+        マニフェスト（存在しない場合は空のマニフェスト）
+    """
+    manifest_path = os.path.join(ct.VECTOR_STORE_DIR_PATH, ct.VECTOR_STORE_MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return {"config": None, "sources": {}}
+
+    with open(manifest_path, encoding="utf8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest):
+    """
+    マニフェストの書き出し（書き込み途中で落ちても壊れないよう、一時ファイルに書いてから置き換える）
+
+    Args:
+        manifest: マニフェスト
+    """
+    os.makedirs(ct.VECTOR_STORE_DIR_PATH, exist_ok=True)
+    manifest_path = os.path.join(ct.VECTOR_STORE_DIR_PATH, ct.VECTOR_STORE_MANIFEST_FILE)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w", encoding="utf8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+def file_sha256(path):
+    """
+    ファイルの中身のハッシュ値を算出
+
+    Args:
+        path: ファイルパス
+
+    Returns:
+        SHA-256のハッシュ値（16進数文字列）
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def collect_source_files(path):
+    """
+    読み込み対象のファイルパスを再帰的に収集
+
+    Args:
+        path: 読み込み対象のファイル/フォルダのパス
+
+    Returns:
+        対応している拡張子のファイルパスのリスト（順序を固定するためソート済み）
+    """
+    # パスがフォルダの場合、フォルダ内のファイル/フォルダに対して再帰的に処理
+    if os.path.isdir(path):
+        paths = []
+        for file in sorted(os.listdir(path)):
+            paths.extend(collect_source_files(os.path.join(path, file)))
+        return paths
+
+    # 想定していたファイル形式の場合のみ対象とする
+    if os.path.splitext(path)[1] in ct.SUPPORTED_EXTENSIONS:
+        return [path]
+    return []
+
+
+def load_files(paths, max_workers=ct.LOAD_MAX_WORKERS, digest_of=None):
+    """
+    複数ファイルの読み込み（max_workers が2以上の場合はプロセスプールで並列に読み込む）
+    - 結果は並列数に関わらず、渡したファイルパスの順で返す
+    - 先読みするファイル数を並列数の2倍までに抑え、読み込み結果がメモリに溜まり続けないようにする
+    - 1ファイルの読み込み失敗はログに記録して None を返し、他のファイルの読み込みは継続する
+
+    Args:
+        paths: ファイルパスのイテラブル
+        max_workers: 並列に読み込むプロセス数
+        digest_of: ファイルパスから算出済みのハッシュ値を返す関数（抽出済みテキストのキャッシュの照合に使う。
+            None の場合は読み込み時にハッシュ値を算出する）
+
+    Yields:
+        (ファイルパス, 読み込んだドキュメントのリスト または None) のタプル
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    digest_of = digest_of or (lambda path: None)
+
+    def _result(path, future):
+        try:
+            return path, future.result()
+        except Exception as e:
+            logger.error(f"ファイルの読み込みに失敗しました: {path}\n{e}")
+            return path, None
+
+    # 逐次読み込み
+    if max_workers <= 1:
+        for path in paths:
+            try:
+                yield path, load_file_cached(path, digest_of(path))
+            except Exception as e:
+                logger.error(f"ファイルの読み込みに失敗しました: {path}\n{e}")
+                yield path, None
+        return
+
+    # 並列読み込み（PDFのテキスト抽出はCPU処理のため、スレッドではなくプロセスで並列化）
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        for path in paths:
+            in_flight.append((path, executor.submit(load_file_cached, path, digest_of(path))))
+            if len(in_flight) >= max_workers * 2:
+                yield _result(*in_flight.popleft())
+        while in_flight:
+            yield _result(*in_flight.popleft())
+
+
+def load_file_cached(path, digest=None):
+    """
+    ファイル内のデータ読み込み（抽出済みテキストのキャッシュがあれば、ファイルを解析せずにそちらを使う）
+
+    Args:
+        path: ファイルパス
+        digest: 変更の判定で算出済みのファイルのハッシュ値（None の場合はここで算出する）
+
+    Returns:
+        読み込んだドキュメントのリスト
+    """
+    if not ct.PARSED_TEXT_CACHE_ENABLED:
+        return load_file(path)
+    return parsed_text_cache.load(path, digest or file_sha256(path), load_file)
+
+
+def load_file(path):
+    """
+    ファイル内のデータ読み込み
+
+    Args:
+        path: ファイルパス
+
+    Returns:
+        読み込んだドキュメントのリスト
+    """
+    # ファイルの拡張子に合ったdata loaderを使ってデータ読み込み
+    file_extension = os.path.splitext(path)[1]
+    loader = ct.SUPPORTED_EXTENSIONS[file_extension](path)
+    return loader.load()
+
+
+def adjust_string(s):
+    """
+    Windows環境でRAGが正常動作するよう調整
+
+    Args:
+        s: 調整を行う文字列
+
+    Returns:
+        調整を行った文字列
+    """
+    # 調整対象は文字列のみ
+    if type(s) is not str:
+        return s
+
+    # OSがWindowsの場合、Unicode正規化と、cp932（Windows用の文字コード）で表現できない文字を除去
+    if sys.platform.startswith("win"):
+        s = unicodedata.normalize('NFC', s)
+        s = s.encode("cp932", "ignore").decode("cp932")
+        return s
+
+    # OSがWindows以外の場合はそのまま返す
+    return s
+
+
+############################################################
+# クラス定義
+############################################################
+
+class IndexWriter:
+    """
+    チャンクをバッチ単位でベクターストアに登録し、登録が完了したデータソースをマニフェストに反映するクラス
+    - 複数ファイルのチャンクをまとめて1バッチとしてベクトル化するため、小さいファイルが多くてもリクエスト数が増えない
+    - データソースは全チャンクの登録が完了した時点で初めてマニフェストに記録される
+    - 内容がほぼ同じファイルは正本のみを登録し、他のファイル（重複）のパスは正本のチャンクのメタデータ
+      （alternate_sources）とマニフェストに残す
+    """
+
+    def __init__(self, db, manifest, batch_size=ct.INDEX_BATCH_SIZE, checkpoint_interval=ct.INDEX_CHECKPOINT_INTERVAL, dedup=ct.DEDUP_ENABLED):
+        """
+        Args:
+            db: 登録先のベクターストア
+            manifest: マニフェスト
+            batch_size: 1バッチあたりのチャンク数
+            checkpoint_interval: ベクターストアとマニフェストを保存する間隔（バッチ数）
+            dedup: 内容がほぼ同じファイルを1つにまとめるかどうか
+        """
+        self.db = db
+        self.manifest = manifest
+        self.batch_size = batch_size
+        self.checkpoint_interval = checkpoint_interval
+        self.dedup = dedup
+        self._batch_docs = []
+        self._batch_ids = []
+        # 全チャンクをバッチに積み終え、登録完了を待っているデータソース
+        self._waiting = {}
+        self._flush_count = 0
+        # 正本の候補（重複ではなく、署名を持つデータソース）の LSH 索引（マニフェストと登録完了待ちのエントリに合わせて更新する）
+        self._lsh = MinHashLSH()
+        for key, entry in manifest["sources"].items():
+            self._index_entry(key, entry)
+
+    def add_source(self, source_key, info, docs):
+        """
+        1つのデータソースの古いチャンクを削除し、新しいチャンクをバッチに積む
+        （他のデータソースと内容がほぼ同じ場合は、正本のみが登録されるよう調整する）
+
+        Args:
+            source_key: データソースのキー（ファイルパスまたはURL）
+            info: データソースのサイズ・更新日時・ハッシュ値
+            docs: データソースから読み込んだドキュメント
+        """
+        # 前回登録したチャンクを削除
+        old_entry = self._entry(source_key)
+        orphan_keys = []
+        if old_entry:
+            if old_entry["chunk_ids"]:
+                self.db.delete(ids=old_entry["chunk_ids"])
+            # 前回は他のデータソースの重複だった場合、正本のメタデータから外す
+            if old_entry.get("duplicate_of"):
+                self._remove_alternate(old_entry["duplicate_of"], source_key)
+            # 前回は正本だった場合、重複として登録を省いていたデータソースは判定し直す
+            orphan_keys = old_entry.get("alternates", [])
+
+        splitted_docs = split_documents(docs)
+        entry = {**info, "chunk_ids": [], "minhash": None, "duplicate_of": None, "alternates": []}
+
+        # 内容がほぼ同じデータソースの検出（Webページは対象外）
+        canonical_key = None
+        if self.dedup and not source_key.startswith("http"):
+            entry["minhash"] = minhash_signature("".join(doc.page_content for doc in docs))
+            canonical_key = self._find_duplicate(source_key, entry["minhash"])
+
+        # 既存の正本の方が優先される場合は、チャンクを登録せず正本の別パスとして記録
+        if canonical_key is not None and canonical_rank(canonical_key) < canonical_rank(source_key):
+            logger = logging.getLogger(ct.LOGGER_NAME)
+            logger.info(f"内容がほぼ同じため登録を省きました: {source_key}（正本: {canonical_key}）")
+            entry["duplicate_of"] = canonical_key
+            entry["duplicate_chunks"] = len(splitted_docs)
+            self._set_alternates(canonical_key, self._entry(canonical_key)["alternates"] + [source_key])
+            self._stage(source_key, entry)
+            self._reprocess(orphan_keys)
+            return
+
+        # 新しいデータソースの方が優先される場合は、既存の正本とその別パスを引き継ぐ
+        demoted = None
+        if canonical_key is not None:
+            demoted = dict(self._entry(canonical_key))
+            entry["alternates"] = [canonical_key] + demoted["alternates"]
+
+        # データソースと中身から決まるIDを付与
+        key_hash = hashlib.sha1(source_key.encode("utf-8")).hexdigest()[:16]
+        chunk_ids = [f"{key_hash}-{info['sha256'][:12]}-{i}" for i in range(len(splitted_docs))]
+
+        # 前回の処理が途中で中断された場合に備え、同じIDのチャンクが残っていれば削除
+        if chunk_ids:
+            existing_ids = self.db.get(ids=chunk_ids)["ids"]
+            if existing_ids:
+                self.db.delete(ids=existing_ids)
+
+        for doc, chunk_id in zip(splitted_docs, chunk_ids):
+            # 検索結果から元のチャンクを特定できるよう、メタデータにもIDを持たせる
+            doc.metadata["chunk_id"] = chunk_id
+            if entry["alternates"]:
+                doc.metadata["alternate_sources"] = "\n".join(entry["alternates"])
+            self._batch_docs.append(doc)
+            self._batch_ids.append(chunk_id)
+            if len(self._batch_docs) >= self.batch_size:
+                self.flush()
+
+        # 既存の正本は、新しいデータソースのチャンクを積み終えてから重複に切り替える
+        if demoted is not None:
+            logger = logging.getLogger(ct.LOGGER_NAME)
+            logger.info(f"内容がほぼ同じため登録を省きました: {canonical_key}（正本: {source_key}）")
+            if demoted["chunk_ids"]:
+                self.db.delete(ids=demoted["chunk_ids"])
+            demoted.update(chunk_ids=[], alternates=[], duplicate_of=source_key, duplicate_chunks=len(demoted["chunk_ids"]))
+            self._stage(canonical_key, demoted)
+            for alternate_key in entry["alternates"][1:]:
+                self._stage(alternate_key, {**self._entry(alternate_key), "duplicate_of": source_key})
+
+        self._stage(source_key, {**entry, "chunk_ids": chunk_ids})
+        self._reprocess(orphan_keys)
+
+    def remove_source(self, source_key):
+        """
+        削除されたデータソースのチャンクをベクターストアとマニフェストから除去
+        （正本が削除された場合は、重複として登録を省いていたデータソースを登録し直す）
+
+        Args:
+            source_key: データソースのキー（ファイルパスまたはURL）
+        """
+        entry = self._entry(source_key)
+        if entry is None:
+            return
+
+        if entry["chunk_ids"]:
+            self.db.delete(ids=entry["chunk_ids"])
+        if entry.get("duplicate_of"):
+            self._remove_alternate(entry["duplicate_of"], source_key)
+        self.manifest["sources"].pop(source_key, None)
+        self._waiting.pop(source_key, None)
+        self._lsh.remove(source_key)
+
+        self._reprocess(entry.get("alternates", []))
+
+    def flush(self):
+        """
+        バッチに積んだチャンクをベクトル化して登録し、登録が完了したデータソースをマニフェストに反映
+        """
+        if self._batch_docs:
+            self.db.add_documents(self._batch_docs, ids=self._batch_ids)
+            self._batch_docs = []
+            self._batch_ids = []
+
+        self.manifest["sources"].update(self._waiting)
+        self._waiting = {}
+
+        self._flush_count += 1
+        if self._flush_count % self.checkpoint_interval == 0:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        ベクターストアを保存してから、マニフェストを書き出す（途中で落ちた場合の再開地点）
+        """
+        self.db.persist()
+        save_manifest(self.manifest)
+
+    def _entry(self, source_key):
+        """
+        データソースのエントリを取得
+
+        Args:
+            source_key: データソースのキー
+
+        Returns:
+            エントリ（登録完了待ちのエントリを優先。ない場合は None）
+        """
+        if source_key in self._waiting:
+            return self._waiting[source_key]
+        return self.manifest["sources"].get(source_key)
+
+    def _stage(self, source_key, entry):
+        """
+        エントリを登録完了待ちにし、LSH 索引にも反映
+
+        Args:
+            source_key: データソースのキー
+            entry: エントリ
+        """
+        self._waiting[source_key] = entry
+        self._index_entry(source_key, entry)
+
+    def _index_entry(self, source_key, entry):
+        """
+        正本の候補であれば LSH 索引に登録し、そうでなければ登録を解除
+        （重複のデータソースと、再処理待ち（ハッシュ値を消したエントリ）は比較対象外）
+        """
+        if entry.get("duplicate_of") or not entry.get("minhash") or not entry.get("sha256"):
+            self._lsh.remove(source_key)
+        else:
+            self._lsh.add(source_key, entry["minhash"])
+
+    def _find_duplicate(self, source_key, signature):
+        """
+        内容がほぼ同じ正本のデータソースを検索
+
+        Args:
+            source_key: 対象のデータソースのキー
+            signature: 対象のデータソースの MinHash の署名
+
+        Returns:
+            最も類似度が高い正本のキー（しきい値以上のものがない場合は None）
+        """
+        if not signature:
+            return None
+        best_key = None
+        best_similarity = ct.DEDUP_SIMILARITY_THRESHOLD
+        # LSH 索引でいずれかのバンドが一致した正本の候補のみと比較する（順序によらず同じ結果になるよう、キーの順に比較）
+        for key in sorted(self._lsh.candidates(signature) - {source_key}):
+            similarity = estimate_similarity(signature, self._entry(key)["minhash"])
+            if similarity >= best_similarity:
+                best_key, best_similarity = key, similarity
+        return best_key
+
+    def _set_alternates(self, canonical_key, alternates):
+        """
+        正本の別パスを更新し、登録済みのチャンクのメタデータにも反映（ベクトル化はやり直さない）
+
+        Args:
+            canonical_key: 正本のデータソースのキー
+            alternates: 別パスのリスト
+        """
+        # 正本のチャンクがバッチに積まれたままの場合は、先に登録しておく
+        if canonical_key in self._waiting:
+            self.flush()
+
+        entry = {**self._entry(canonical_key), "alternates": alternates}
+        if entry["chunk_ids"]:
+            data = self.db.get(ids=entry["chunk_ids"])
+            for metadata in data["metadatas"]:
+                metadata.pop("alternate_sources", None)
+                if alternates:
+                    metadata["alternate_sources"] = "\n".join(alternates)
+            self.db._collection.update(ids=data["ids"], metadatas=data["metadatas"])
+        self._stage(canonical_key, entry)
+
+    def _remove_alternate(self, canonical_key, source_key):
+        """
+        正本の別パスから、指定のデータソースを外す
+
+        Args:
+            canonical_key: 正本のデータソースのキー
+            source_key: 外すデータソースのキー
+        """
+        entry = self._entry(canonical_key)
+        if entry and source_key in entry.get("alternates", []):
+            self._set_alternates(canonical_key, [key for key in entry["alternates"] if key != source_key])
+
+    def _reprocess(self, source_keys):
+        """
+        正本が変更・削除されたことで、重複として登録を省いていたデータソースを読み込み直して登録
+
+        Args:
+            source_keys: 読み込み直すデータソースのキーのリスト
+        """
+        for source_key in source_keys:
+            entry = self._entry(source_key)
+            # すでに削除されたファイルは対象外（マニフェストからの除去は削除の処理で行う）
+            if entry is None or not os.path.isfile(source_key):
+                continue
+            stat = os.stat(source_key)
+            info = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": file_sha256(source_key)}
+            _, docs = next(load_files([source_key], max_workers=1, digest_of=lambda _: info["sha256"]))
+            if docs is None:
+                # 次回の更新時に再度読み込むよう、サイズ・ハッシュ値を消しておく
+                self._stage(source_key, {**entry, "size": None, "mtime": None, "sha256": None, "duplicate_of": None})
+                continue
+            self.add_source(source_key, info, docs)
@@ -9,17 +9,17 @@ import os
 import logging
 from logging.handlers import TimedRotatingFileHandler
 from uuid import uuid4
-import sys
-import unicodedata
 from dotenv import load_dotenv
 import streamlit as st
-from docx import Document
-from langchain_community.document_loaders import WebBaseLoader
-from langchain.text_splitter import CharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import Chroma
 import constants as ct
-from constants import RETRIEVER_TOP_K, CHUNK_SIZE, CHUNK_OVERLAP
+from embedding_cache import CachedEmbeddings
+from request_scheduler import ScheduledEmbeddings
+from index_manager import IndexManager
+from retrieval_client import RemoteIndexManager
+from answer_cache import AnswerCache
+from chains import ChainRegistry
+from chat_history import ChatHistory
 
 ############################################################
 # 設定関連
@@ -42,8 +42,10 @@ def initialize():
     initialize_session_id()
     # ログ出力の設定
     initialize_logger()
-    # RAGのRetrieverを作成
+    # RAGの検索に使うインデックス（Retriever・表形式データの集計用テーブル）を用意
     initialize_retriever()
+    # 回答キャッシュ・LLMのチェーンを用意
+    initialize_shared_resources()
 
 
 def initialize_logger():
@@ -100,145 +102,94 @@ def initialize_session_id():
 
 def initialize_retriever():
     """
-    画面読み込み時にRAGのRetriever（ベクターストアから検索するオブジェクト）を作成
+    画面読み込み時に、RAGの検索に使うインデックスの管理オブジェクトをセッションに割り当て
     """
     # ロガーを読み込むことで、後続の処理中に発生したエラーなどがログファイルに記録される
     logger = logging.getLogger(ct.LOGGER_NAME)
 
-    # すでにRetrieverが作成済みの場合、後続の処理を中断
-    if "retriever" in st.session_state:
+    # すでに割り当て済みの場合、後続の処理を中断
+    if "index_manager" in st.session_state:
         return
-    
-    # RAGの参照先となるデータソースの読み込み
-    docs_all = load_data_sources()
-
-    # OSがWindowsの場合、Unicode正規化と、cp932（Windows用の文字コード）で表現できない文字を除去
-    for doc in docs_all:
-        doc.page_content = adjust_string(doc.page_content)
-        for key in doc.metadata:
-            doc.metadata[key] = adjust_string(doc.metadata[key])
-    
-    # 埋め込みモデルの用意
-    embeddings = OpenAIEmbeddings()
-    
-    # チャンク分割用のオブジェクトを作成
-    text_splitter = CharacterTextSplitter(
-        chunk_size=CHUNK_SIZE,
-        chunk_overlap=CHUNK_OVERLAP,
-        separator="\n"
-    )
 
-    # チャンク分割を実施
-    splitted_docs = text_splitter.split_documents(docs_all)
+    # プロセス内で共有しているインデックスを取得（初回のみ作成、以降は全セッションで使い回す）
+    # - セッションが保持するのは管理オブジェクトのみで、検索時はその時点のスナップショット（Retriever など一式）を取り出して使う
+    st.session_state.index_manager = get_shared_index_manager()
+    logger.info(
+        f"共有インデックスをセッションに割り当てました（インデックスのバージョン: {st.session_state.index_manager.current.version}）"
+    )
 
-    # ベクターストアの作成
-    db = Chroma.from_documents(splitted_docs, embedding=embeddings)
 
-    # ベクターストアを検索するRetrieverの作成
-    st.session_state.retriever = db.as_retriever(search_kwargs={"k": RETRIEVER_TOP_K})
+@st.cache_resource(show_spinner=False)
+def get_shared_index_manager():
+    """
+    サーバープロセス内で共有するインデックスの管理オブジェクトの取得
+    - st.cache_resource により、プロセス内で1度だけ実行され、全セッションで同じオブジェクトを共有する
+    - 保存済みのインデックスがあれば読み込み、追加・変更・削除されたデータソースのみ差分更新する
+    - INDEX_WATCH_ENABLED が True の場合は、./data 配下の変更を監視し、バックグラウンドで差分更新して差し替える
+    - VECTOR_STORE_BACKEND が "numpy" の場合や監視する場合は、バージョンごとにメモリマップする行列に書き出し、
+      検索にはそちらを使う（検索中に Chroma への書き込みの影響を受けない）
 
+    - RETRIEVAL_SERVER_URL が設定されている場合は、インデックスを持たず検索サーバー（retrieval_server.py）に問い合わせる
+      （複数の Streamlit プロセスを起動しても、インデックス・埋め込みキャッシュ・監視は検索サーバーの1つだけになる）
 
-def initialize_session_state():
-    """
-    初期化データの用意
+    Returns:
+        共有の IndexManager（検索サーバーを使う場合は RemoteIndexManager）
     """
-    if "messages" not in st.session_state:
-        # 「表示用」の会話ログを順次格納するリストを用意
-        st.session_state.messages = []
-        # 「LLMとのやりとり用」の会話ログを順次格納するリストを用意
-        st.session_state.chat_history = []
+    if ct.RETRIEVAL_SERVER_URL:
+        return RemoteIndexManager(ct.RETRIEVAL_SERVER_URL)
+
+    # 埋め込みモデルの用意（一度ベクトル化したチャンクはローカルのキャッシュから再利用）
+    # - API の呼び出しは ScheduledEmbeddings がプロセス全体で制限・再試行するため、クライアント自身の再試行は無効にする
+    embeddings = CachedEmbeddings(ScheduledEmbeddings(OpenAIEmbeddings(
+        model=ct.EMBEDDING_MODEL, timeout=ct.OPENAI_REQUEST_TIMEOUT_SECONDS, max_retries=0
+    )))
+
+    index_manager = IndexManager.open(embeddings)
+    if ct.INDEX_WATCH_ENABLED:
+        index_manager.start_watching()
+
+    return index_manager
 
 
-def load_data_sources():
+@st.cache_resource(show_spinner=False)
+def get_shared_answer_cache():
     """
-    RAGの参照先となるデータソースの読み込み
+    サーバープロセス内で共有する回答キャッシュの取得
 
     Returns:
-        読み込んだ通常データソース
+        共有の AnswerCache
     """
-    # データソースを格納する用のリスト
-    docs_all = []
-    # ファイル読み込みの実行（渡した各リストにデータが格納される）
-    recursive_file_check(ct.RAG_TOP_FOLDER_PATH, docs_all)
+    return AnswerCache()
 
-    web_docs_all = []
-    # ファイルとは別に、指定のWebページ内のデータも読み込み
-    # 読み込み対象のWebページ一覧に対して処理
-    for web_url in ct.WEB_URL_LOAD_TARGETS:
-        # 指定のWebページを読み込み
-        loader = WebBaseLoader(web_url)
-        web_docs = loader.load()
-        # for文の外のリストに読み込んだデータソースを追加
-        web_docs_all.extend(web_docs)
-    # 通常読み込みのデータソースにWebページのデータを追加
-    docs_all.extend(web_docs_all)
 
-    return docs_all
-
-
-def recursive_file_check(path, docs_all):
+@st.cache_resource(show_spinner=False)
+def get_shared_chain_registry():
     """
-    RAGの参照先となるデータソースの読み込み
+    サーバープロセス内で共有する、LLMクライアントとモード別チェーンの取得
 
-    Args:
-        path: 読み込み対象のファイル/フォルダのパス
-        docs_all: データソースを格納する用のリスト
+    Returns:
+        共有の ChainRegistry
     """
-    # パスがフォルダかどうかを確認
-    if os.path.isdir(path):
-        # フォルダの場合、フォルダ内のファイル/フォルダ名の一覧を取得
-        files = os.listdir(path)
-        # 各ファイル/フォルダに対して処理
-        for file in files:
-            # ファイル/フォルダ名だけでなく、フルパスを取得
-            full_path = os.path.join(path, file)
-            # フルパスを渡し、再帰的にファイル読み込みの関数を実行
-            recursive_file_check(full_path, docs_all)
-    else:
-        # パスがファイルの場合、ファイル読み込み
-        file_load(path, docs_all)
+    return ChainRegistry()
 
 
-def file_load(path, docs_all):
+def initialize_shared_resources():
     """
-    ファイル内のデータ読み込み
-
-    Args:
-        path: ファイルパス
-        docs_all: データソースを格納する用のリスト
+    プロセス内で共有する回答キャッシュ・LLMのチェーンをセッションに割り当て
     """
-    # ファイルの拡張子を取得
-    file_extension = os.path.splitext(path)[1]
-    # ファイル名（拡張子を含む）を取得
-    file_name = os.path.basename(path)
+    if "answer_cache" in st.session_state:
+        return
 
-    # 想定していたファイル形式の場合のみ読み込む
-    if file_extension in ct.SUPPORTED_EXTENSIONS:
-        # ファイルの拡張子に合ったdata loaderを使ってデータ読み込み
-        loader = ct.SUPPORTED_EXTENSIONS[file_extension](path)
-        docs = loader.load()
-        docs_all.extend(docs)
+    st.session_state.answer_cache = get_shared_answer_cache()
+    st.session_state.chain_registry = get_shared_chain_registry()
 
 
-def adjust_string(s):
+def initialize_session_state():
     """
-    Windows環境でRAGが正常動作するよう調整
-    
-    Args:
-        s: 調整を行う文字列
-    
-    Returns:
-        調整を行った文字列
+    初期化データの用意
     """
-    # 調整対象は文字列のみ
-    if type(s) is not str:
-        return s
-
-    # OSがWindowsの場合、Unicode正規化と、cp932（Windows用の文字コード）で表現できない文字を除去
-    if sys.platform.startswith("win"):
-        s = unicodedata.normalize('NFC', s)
-        s = s.encode("cp932", "ignore").decode("cp932")
-        return s
-    
-    # OSがWindows以外の場合はそのまま返す
-    return s
\ No newline at end of file
+    if "messages" not in st.session_state:
+        # 「表示用」の会話ログを順次格納するリストを用意
+        st.session_state.messages = []
+        # 「LLMとのやりとり用」の会話ログを用意（古いターンは要約に畳み込まれる）
+        st.session_state.chat_history = ChatHistory()
@@ -0,0 +1,273 @@
+"""
+このファイルは、日本語の文・段落の区切りを考慮してドキュメントをチャンクに分割する処理が記述されたファイルです。
+- PDFの行末の改行（文の途中での折り返し）はつなげ、「。」「！」「？」などの文末で文に区切る
+- 箇条書き・見出しの記号、話者名（「佐藤健太: 」など）で始まる行や、空行（Word文書の段落の区切り）をまとまりの先頭とみなす
+- 文をトークン数の上限まで詰めてチャンクにし、上限を超える場合は最後のまとまりの先頭（なければ文の区切り）で区切る
+- テキストは先頭から1度だけ走査し、文ごとのトークン数も1度だけ数える
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import re
+from functools import partial
+from langchain.text_splitter import TextSplitter
+import constants as ct
+from token_counter import count_tokens
+
+
+############################################################
+# 設定関連
+############################################################
+# 文末（直後の閉じ括弧まで含める）
+_SENTENCE_END = re.compile(r"[。！？!?]+[」』）)]*")
+# まとまりの先頭となる行（箇条書き・番号・見出しの記号、話者名や項目名の「: 」）
+# PDFの箇条書きの記号の直後には、ゼロ幅スペースが入っていることがある
+_BLOCK_START = re.compile(
+    r"^(?:[・●○◎■□◆◇▶►•※＊*\-－]"
+    r"|\d+(?:[.．]\d+)*[.．)）]?[\s\u200b]"
+    r"|[（(]\d+[)）]"
+    r"|[①-⑳]"
+    r"|第[0-9０-９一二三四五六七八九十]+[章条節項]"
+    r"|【"
+    r"|#{1,6}\s"
+    r"|[^\s:：、。]{1,20}[:：])"
+)
+_ASCII_WORD = re.compile(r"[A-Za-z0-9]")
+# チャンクの大きさは、埋め込みモデルのトークナイザーで数える
+_count_tokens = partial(count_tokens, model=ct.EMBEDDING_MODEL)
+
+
+############################################################
+# クラス定義
+############################################################
+
+class JapaneseTextSplitter(TextSplitter):
+    """
+    日本語の文・段落の区切りを考慮し、トークン数でチャンクの大きさを決めるテキスト分割
+    """
+
+    def __init__(
+        self,
+        chunk_size=ct.CHUNK_SIZE_TOKENS,
+        chunk_overlap=ct.CHUNK_OVERLAP_TOKENS,
+        min_fill_ratio=ct.CHUNK_MIN_FILL_RATIO,
+        heading_max_chars=ct.CHUNK_HEADING_MAX_CHARS,
+        **kwargs
+    ):
+        """
+        Args:
+            chunk_size: 1チャンクの最大トークン数
+            chunk_overlap: 段落の途中で区切る場合に、前のチャンクから引き継ぐ文の最大トークン数
+            min_fill_ratio: まとまりの先頭で区切る場合の、チャンクの最小の充填率
+            heading_max_chars: 文末のない行を見出しとみなす最大文字数
+        """
+        super().__init__(chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=_count_tokens, **kwargs)
+        self._min_fill_tokens = int(chunk_size * min_fill_ratio)
+        self._heading_max_chars = heading_max_chars
+
+    def split_text(self, text):
+        """
+        テキストをチャンクに分割
+
+        Args:
+            text: 対象のテキスト
+
+        Returns:
+            チャンクの本文のリスト
+        """
+        chunks = []
+        current = []
+        current_tokens = 0
+
+        for unit in self._iter_units(text):
+            for piece in self._fit_unit(unit):
+                if current and current_tokens + piece["tokens"] > self._chunk_size:
+                    # 上限を超える場合は、最小の充填率を満たす範囲で最後のまとまりの先頭で区切る
+                    cut = self._block_cut(current, piece)
+                    if cut is not None:
+                        chunks.append(self._join(current[:cut]))
+                        current = current[cut:]
+                    # まとまりの先頭で区切れない場合や、区切った残りと合わせても上限を超える場合は
+                    # 文の区切りで区切り、末尾の文を次のチャンクに重ねる
+                    if cut is None or sum(unit["tokens"] for unit in current) + piece["tokens"] > self._chunk_size:
+                        chunks.append(self._join(current))
+                        current = self._overlap_tail(current)
+                        # 重ねる文と合わせて上限を超える場合は、重ねる文を古いものから減らす（すでにチャンクに含まれるため失われない）
+                        while current and sum(unit["tokens"] for unit in current) + piece["tokens"] > self._chunk_size:
+                            current = current[1:]
+                    current_tokens = sum(unit["tokens"] for unit in current)
+                current.append(piece)
+                current_tokens += piece["tokens"]
+
+        if current:
+            chunks.append(self._join(current))
+        return [chunk for chunk in chunks if chunk.strip()]
+
+    def _iter_units(self, text):
+        """
+        テキストを先頭から1度だけ走査し、文（または見出し・箇条書きの1行）の単位に分ける
+
+        Args:
+            text: 対象のテキスト
+
+        Yields:
+            text（本文）, tokens（トークン数）, separator（前の単位とのつなぎ）,
+            block_start（まとまりの先頭か）, heading（見出しとみなせるか）を持つ辞書
+        """
+        pending = ""
+        pending_separator = "\n"
+        pending_block_start = True
+        next_block_start = True
+
+        def _unit(body, separator, block_start, heading=False):
+            return {
+                "text": body,
+                # つなぎの改行も1トークンとして数える
+                "tokens": _count_tokens(body) + len(separator),
+                "separator": separator,
+                "block_start": block_start,
+                "heading": heading,
+            }
+
+        for raw_line in text.split("\n"):
+            line = raw_line.strip()
+            if not line:
+                # 空行（段落の区切り）までの文末のない行は、1つの単位として確定する
+                if pending:
+                    yield _unit(pending, pending_separator, pending_block_start,
+                                heading=len(pending) <= self._heading_max_chars)
+                    pending = ""
+                next_block_start = True
+                continue
+
+            if _BLOCK_START.match(line):
+                next_block_start = True
+
+            if next_block_start and pending:
+                yield _unit(pending, pending_separator, pending_block_start,
+                            heading=len(pending) <= self._heading_max_chars)
+                pending = ""
+
+            if not pending:
+                # 行末が文末だった場合やまとまりの先頭の場合は、前の単位と改行でつなぐ
+                pending_separator = "\n"
+                pending_block_start = next_block_start
+            elif _ASCII_WORD.match(pending[-1]) and _ASCII_WORD.match(line[0]):
+                # PDFの折り返しでつながった英単語同士の間には空白を入れる
+                pending += " "
+            next_block_start = False
+
+            # この行の中の文末で区切り、文末で終わらない残りは次の行とつなげる
+            start = 0
+            for match in _SENTENCE_END.finditer(line):
+                pending += line[start:match.end()]
+                yield _unit(pending, pending_separator, pending_block_start)
+                pending = ""
+                pending_separator = ""
+                pending_block_start = False
+                start = match.end()
+            pending += line[start:]
+
+        if pending:
+            yield _unit(pending, pending_separator, pending_block_start,
+                        heading=len(pending) <= self._heading_max_chars)
+
+    def _fit_unit(self, unit):
+        """
+        1つで上限を超える単位を、上限に収まる長さに切り分ける
+
+        Args:
+            unit: 文の単位
+
+        Returns:
+            単位のリスト
+        """
+        if unit["tokens"] <= self._chunk_size:
+            return [unit]
+        body = unit["text"]
+        pieces = []
+        start = 0
+        while start < len(body):
+            # 先頭の切片は、つなぎの改行の分も上限に含める
+            separator = unit["separator"] if start == 0 else ""
+            limit = self._chunk_size - len(separator)
+            # 文字数とトークン数の比から切り出す長さを見積もり、上限を超える間は同じ比で縮める
+            end = min(len(body), start + max(1, len(body) * limit // unit["tokens"]))
+            tokens = _count_tokens(body[start:end])
+            while tokens > limit and end - start > 1:
+                end = start + max(1, min(end - start - 1, (end - start) * limit // tokens))
+                tokens = _count_tokens(body[start:end])
+            pieces.append({
+                "text": body[start:end],
+                "tokens": tokens + len(separator),
+                "separator": separator,
+                "block_start": unit["block_start"] if start == 0 else False,
+                "heading": False,
+            })
+            start = end
+        return pieces
+
+    def _overlap_tail(self, units):
+        """
+        段落の途中で区切る場合に、次のチャンクに引き継ぐ末尾の文
+
+        Args:
+            units: 確定したチャンクの単位のリスト
+
+        Returns:
+            引き継ぐ単位のリスト
+        """
+        tail = []
+        tokens = 0
+        # 先頭の単位まで引き継ぐと分割が進まないため、2つ目以降から選ぶ
+        for unit in reversed(units[1:]):
+            if tokens + unit["tokens"] > self._chunk_overlap:
+                break
+            tail.append(unit)
+            tokens += unit["tokens"]
+        return tail[::-1]
+
+    def _block_cut(self, units, piece):
+        """
+        チャンクを区切る位置（最小の充填率を満たす、最後のまとまりの先頭）
+        直前の単位が見出しの場合は、見出しごと次のチャンクに移す
+
+        Args:
+            units: 区切る前のチャンクの単位のリスト
+            piece: 次に追加する単位
+
+        Returns:
+            区切る位置のインデックス（区切れない場合は None）
+        """
+        if piece["block_start"]:
+            cut = len(units)
+        else:
+            cut = None
+            # 見直すのは現在のチャンク内の単位のみ（チャンクの大きさで上限がある）
+            for i in range(len(units) - 1, 0, -1):
+                if units[i]["block_start"]:
+                    cut = i
+                    break
+            if cut is None:
+                return None
+        if cut > 1 and units[cut - 1]["heading"] and units[cut - 1]["block_start"]:
+            cut -= 1
+        if sum(unit["tokens"] for unit in units[:cut]) < self._min_fill_tokens:
+            return None
+        return cut
+
+    @staticmethod
+    def _join(units):
+        """
+        単位をつなげてチャンクの本文にする
+
+        Args:
+            units: 単位のリスト
+
+        Returns:
+            チャンクの本文
+        """
+        return "".join(
+            (unit["separator"] if i else "") + unit["text"] for i, unit in enumerate(units)
+        )
@@ -0,0 +1,195 @@
+"""
+このファイルは、チャンクに対する語彙検索（文字n-gramの転置インデックス + BM25）の処理が記述されたファイルです。
+- 形態素解析器に依存せず日本語を扱えるよう、文字の2-gram / 3-gram を索引語とする
+- 社員ID（EMP0001）、会社名、製品名のような「完全一致させたい語」を、ベクトル検索の取りこぼしから補う
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import re
+import unicodedata
+from collections import Counter
+import numpy as np
+from langchain_core.documents import Document
+import constants as ct
+
+
+############################################################
+# 関数定義
+############################################################
+
+def to_ngrams(text):
+    """
+    テキストを索引語（文字の2-gram / 3-gram）に分解
+
+    Args:
+        text: 対象のテキスト
+
+    Returns:
+        索引語のリスト（重複あり）
+    """
+    # 全角・半角や大文字・小文字の違いを吸収し、空白をまたぐn-gramは作らない
+    normalized = unicodedata.normalize("NFKC", text).lower()
+    grams = []
+    for run in normalized.split():
+        for n in ct.LEXICAL_NGRAM_SIZES:
+            grams.extend(run[i:i + n] for i in range(len(run) - n + 1))
+        # n-gramを作れない1文字の語も検索できるよう、そのまま索引語にする
+        if len(run) < min(ct.LEXICAL_NGRAM_SIZES):
+            grams.append(run)
+    return grams
+
+
+############################################################
+# クラス定義
+############################################################
+
+class LexicalIndex:
+    """
+    文字n-gramの転置インデックスとBM25による語彙検索のクラス
+    - 各ポスティング（索引語 → チャンク）には、BM25のスコアへの寄与分を作成時に計算して持たせる
+    - 検索時は、クエリの索引語ごとにスコア配列へ加算し、上位k件を argpartition で取り出すだけで済む
+    """
+
+    def __init__(self, documents, postings):
+        """
+        Args:
+            documents: チャンクのドキュメントのリスト
+            postings: 索引語から（チャンク番号の配列, スコア寄与の配列）への辞書
+        """
+        self.documents = documents
+        self.postings = postings
+        # 参照元のファイル → チャンク番号の配列（検索対象を特定のファイルに限定する場合に使用）
+        indexes_by_source = {}
+        for i, doc in enumerate(documents):
+            indexes_by_source.setdefault(doc.metadata.get("source"), []).append(i)
+        self.indexes_by_source = {source: np.array(indexes, dtype=np.int64) for source, indexes in indexes_by_source.items()}
+
+    @classmethod
+    def build(cls, documents, k1=ct.LEXICAL_BM25_K1, b=ct.LEXICAL_BM25_B):
+        """
+        チャンクのドキュメントから転置インデックスを作成
+
+        Args:
+            documents: チャンクのドキュメントのリスト
+            k1: BM25のパラメータ（索引語の出現回数の効き方）
+            b: BM25のパラメータ（チャンクの長さによる補正の強さ）
+
+        Returns:
+            作成した LexicalIndex
+        """
+        term_counts = [Counter(to_ngrams(doc.page_content)) for doc in documents]
+        doc_lengths = np.array([sum(counts.values()) for counts in term_counts], dtype=np.float32)
+        avg_length = float(doc_lengths.mean()) if len(documents) else 0.0
+
+        # 全ポスティングを1本の配列にまとめ、索引語ごとのスコア寄与をまとめて計算
+        gram_ids = {}
+        flat_grams, flat_docs, flat_tfs = [], [], []
+        for doc_index, counts in enumerate(term_counts):
+            for gram, tf in counts.items():
+                flat_grams.append(gram_ids.setdefault(gram, len(gram_ids)))
+                flat_docs.append(doc_index)
+                flat_tfs.append(tf)
+        flat_grams = np.array(flat_grams, dtype=np.int32)
+        flat_docs = np.array(flat_docs, dtype=np.int32)
+        flat_tfs = np.array(flat_tfs, dtype=np.float32)
+
+        df = np.bincount(flat_grams, minlength=len(gram_ids)).astype(np.float32)
+        idf = np.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+        norm = k1 * (1 - b + b * doc_lengths[flat_docs] / max(avg_length, 1.0))
+        weights = (idf[flat_grams] * flat_tfs * (k1 + 1) / (flat_tfs + norm)).astype(np.float32)
+
+        # 索引語の順に並べ替え、各索引語のポスティングは配列の一部分（ビュー）として持たせる
+        order = np.argsort(flat_grams, kind="stable")
+        flat_docs = flat_docs[order]
+        weights = weights[order]
+        offsets = np.concatenate([[0], np.cumsum(df.astype(np.int64))])
+        postings = {
+            gram: (flat_docs[offsets[gram_id]:offsets[gram_id + 1]], weights[offsets[gram_id]:offsets[gram_id + 1]])
+            for gram, gram_id in gram_ids.items()
+        }
+
+        return cls(documents, postings)
+
+    @classmethod
+    def from_vector_store(cls, db):
+        """
+        ベクターストアに登録済みの全チャンクから転置インデックスを作成
+
+        Args:
+            db: ベクターストア
+
+        Returns:
+            作成した LexicalIndex
+        """
+        data = db.get(include=["documents", "metadatas"])
+        documents = [
+            Document(page_content=text, metadata=metadata or {})
+            for text, metadata in zip(data["documents"], data["metadatas"])
+        ]
+        return cls.build(documents)
+
+    def search(self, query, k, sources=None):
+        """
+        BM25のスコアが高い順にチャンクを検索
+
+        Args:
+            query: 検索クエリ
+            k: 取得件数
+            sources: 検索対象とする参照元のファイルのパスの集合（省略時は全件）
+
+        Returns:
+            (ドキュメント, スコア) のリスト（スコアの降順）
+        """
+        if k <= 0:
+            return []
+
+        scores = np.zeros(len(self.documents), dtype=np.float32)
+        for gram in set(to_ngrams(query)):
+            posting = self.postings.get(gram)
+            if posting is not None:
+                # 1つの索引語のポスティング内でチャンク番号は重複しないため、そのまま加算できる
+                scores[posting[0]] += posting[1]
+
+        hit_indexes = np.flatnonzero(scores)
+        if sources is not None:
+            allowed = [self.indexes_by_source[source] for source in sources if source in self.indexes_by_source]
+            hit_indexes = np.intersect1d(hit_indexes, np.concatenate(allowed)) if allowed else hit_indexes[:0]
+        if len(hit_indexes) > k:
+            hit_indexes = hit_indexes[np.argpartition(-scores[hit_indexes], k - 1)[:k]]
+        hit_indexes = hit_indexes[np.argsort(-scores[hit_indexes], kind="stable")]
+
+        return [(self.documents[i], float(scores[i])) for i in hit_indexes]
+
+    def exact_match(self, query, pattern=ct.LEXICAL_EXACT_TERM_PATTERN, max_doc_ratio=ct.LEXICAL_EXACT_MATCH_MAX_DOC_RATIO):
+        """
+        クエリ中の社員ID・会社名のような語が、一部のチャンクにそのまま含まれているか
+        （ベクトル検索の関連度スコアが低くても、関連する文書があると判定するため）
+
+        Args:
+            query: 検索クエリ
+            pattern: 完全一致させたい語の正規表現（正規化後のクエリに適用する）
+            max_doc_ratio: 語を含むチャンクが全体のこの割合以下の場合のみ一致とみなす（どこにでも現れる語を除く）
+
+        Returns:
+            いずれかの語が一致した場合は True
+        """
+        max_docs = max(1, int(len(self.documents) * max_doc_ratio))
+        for term in set(re.findall(pattern, unicodedata.normalize("NFKC", query).lower())):
+            # 語の索引語をすべて含むチャンクに候補を絞ってから、語そのものを含むかを確かめる
+            candidates = None
+            for gram in set(to_ngrams(term)):
+                posting = self.postings.get(gram)
+                if posting is None:
+                    candidates = np.zeros(0, dtype=np.int32)
+                    break
+                candidates = posting[0] if candidates is None else np.intersect1d(candidates, posting[0])
+            if candidates is None or len(candidates) == 0 or len(candidates) > max_docs * 4:
+                continue
+            count = sum(
+                term in unicodedata.normalize("NFKC", self.documents[i].page_content).lower() for i in candidates
+            )
+            if 1 <= count <= max_docs:
+                return True
+        return False
@@ -195,7 +195,8 @@ if chat_message:
         # LLM呼び出し（RAG実行中はスピナー表示）
         with st.spinner(ct.SPINNER_TEXT):
             try:
-                llm_response = utils.get_llm_response(chat_message)
+                # 社内問い合わせの回答本文はストリーミングで受け取り、検索が終わり次第表示を始める
+                llm_response = utils.get_llm_response(chat_message, stream=ct.STREAM_INQUIRY_ANSWER)
             except Exception as e:
                 logger.error(f"{ct.GET_LLM_RESPONSE_ERROR_MESSAGE}\n{e}")
                 st.error(utils.build_error_message(ct.GET_LLM_RESPONSE_ERROR_MESSAGE), icon=ct.ERROR_ICON)
@@ -0,0 +1,179 @@
+"""
+このファイルは、インデックス作成時に内容がほぼ同じデータソース（同じ議事録のPDF版とWord版など）を検出する処理が記述されたファイルです。
+- データソースごとに MinHash の署名（文字n-gramの集合を固定長の整数列に要約したもの）を作成し、マニフェストに記録する
+- 署名同士の一致率から Jaccard 類似度を推定し、しきい値以上であれば重複とみなして1つ（正本）だけを登録する
+- 類似度を比較するのは、署名を分割したバンド（LSH）のいずれかが一致するデータソースのみ（データソース数の2乗に比例した比較を避ける）
+- 正本は拡張子の優先順位（ページ番号を持つPDFを優先）→ パスの短さ → パスの辞書順で決める
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import zlib
+import unicodedata
+import numpy as np
+import constants as ct
+
+
+############################################################
+# 設定関連
+############################################################
+# MinHash のハッシュ関数群（シードとの排他的論理和 + 64bitの乗算・シフトによる攪拌）
+# マニフェストに記録した署名と比較できるよう、乱数のシードは固定
+_HASH_SEEDS = np.random.RandomState(20240101).randint(0, 2**63 - 1, size=ct.DEDUP_NUM_PERM, dtype=np.int64).astype(np.uint64)
+_MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX_2 = np.uint64(0x94D049BB133111EB)
+
+
+############################################################
+# 関数定義
+############################################################
+
+def to_shingles(text, size=ct.DEDUP_SHINGLE_SIZE):
+    """
+    テキストを文字n-gram（シングル）のハッシュ値の配列に変換
+
+    Args:
+        text: 対象のテキスト
+        size: n-gramの長さ
+
+    Returns:
+        シングルのハッシュ値（32bit）の配列（重複なし）
+    """
+    # ファイル形式による改行・空白・全角半角の違いを吸収するため、正規化して空白を除いた文字列で比較
+    normalized = "".join(unicodedata.normalize("NFKC", text).split())
+    if len(normalized) < size:
+        grams = {normalized} if normalized else set()
+    else:
+        grams = {normalized[i:i + size] for i in range(len(normalized) - size + 1)}
+    return np.array([zlib.crc32(gram.encode("utf-8")) for gram in grams], dtype=np.uint64)
+
+
+def minhash_signature(text):
+    """
+    テキストの MinHash の署名を作成
+
+    Args:
+        text: 対象のテキスト
+
+    Returns:
+        署名（整数のリスト。テキストが空の場合は None）
+    """
+    shingles = to_shingles(text)
+    if len(shingles) == 0:
+        return None
+    # シングル数 × ハッシュ関数数の行列で計算（uint64 の乗算は桁あふれで切り捨てられる）
+    # 大きなファイルでもメモリ使用量が増えすぎないよう、一定数のシングルごとに最小値を更新
+    signature = np.full(len(_HASH_SEEDS), np.iinfo(np.uint64).max, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for start in range(0, len(shingles), 4096):
+            hashed = shingles[start:start + 4096, None] ^ _HASH_SEEDS
+            hashed = (hashed ^ (hashed >> np.uint64(30))) * _MIX_1
+            hashed = (hashed ^ (hashed >> np.uint64(27))) * _MIX_2
+            hashed ^= hashed >> np.uint64(31)
+            signature = np.minimum(signature, hashed.min(axis=0))
+    return signature.tolist()
+
+
+def estimate_similarity(signature_a, signature_b):
+    """
+    2つの署名から Jaccard 類似度を推定
+
+    Args:
+        signature_a: 署名
+        signature_b: 署名
+
+    Returns:
+        推定した Jaccard 類似度（0〜1）
+    """
+    if not signature_a or not signature_b or len(signature_a) != len(signature_b):
+        return 0.0
+    return float(np.mean(np.array(signature_a, dtype=np.uint64) == np.array(signature_b, dtype=np.uint64)))
+
+
+def canonical_rank(source_key):
+    """
+    重複したデータソースのうち、どれを正本として登録するかの順位（小さいほど優先）
+
+    Args:
+        source_key: データソースのキー（ファイルパス）
+
+    Returns:
+        比較用のタプル
+    """
+    extension = os.path.splitext(source_key)[1].lower()
+    if extension in ct.DEDUP_PREFERRED_EXTENSIONS:
+        extension_rank = ct.DEDUP_PREFERRED_EXTENSIONS.index(extension)
+    else:
+        extension_rank = len(ct.DEDUP_PREFERRED_EXTENSIONS)
+    return (extension_rank, len(source_key), source_key)
+
+
+############################################################
+# クラス定義
+############################################################
+
+class MinHashLSH:
+    """
+    MinHash の署名をバンドに分割し、バンドごとのバケットに登録する索引（LSH）
+    - いずれかのバンドが完全に一致したデータソースのみを候補として返すため、
+      全データソースと類似度を比較せずに済む（類似度はしきい値未満でも候補に入り得るので、呼び出し元で確認する）
+    """
+
+    def __init__(self, bands=ct.DEDUP_LSH_BANDS):
+        """
+        Args:
+            bands: 署名の分割数
+        """
+        self.bands = bands
+        # (バンドの番号, バンド内の値) → データソースのキーの集合
+        self._buckets = {}
+        # データソースのキー → 登録したバケットのキーのリスト（削除用）
+        self._band_keys = {}
+
+    def _split(self, signature):
+        rows = len(signature) // self.bands
+        return [(i, tuple(signature[i * rows:(i + 1) * rows])) for i in range(self.bands)]
+
+    def add(self, key, signature):
+        """
+        データソースを登録（登録済みの場合は置き換える）
+
+        Args:
+            key: データソースのキー
+            signature: 署名
+        """
+        self.remove(key)
+        band_keys = self._split(signature)
+        for band_key in band_keys:
+            self._buckets.setdefault(band_key, set()).add(key)
+        self._band_keys[key] = band_keys
+
+    def remove(self, key):
+        """
+        データソースの登録を解除（登録されていない場合は何もしない）
+
+        Args:
+            key: データソースのキー
+        """
+        for band_key in self._band_keys.pop(key, []):
+            bucket = self._buckets[band_key]
+            bucket.discard(key)
+            if not bucket:
+                del self._buckets[band_key]
+
+    def candidates(self, signature):
+        """
+        いずれかのバンドが一致するデータソースを取得
+
+        Args:
+            signature: 署名
+
+        Returns:
+            データソースのキーの集合
+        """
+        keys = set()
+        for band_key in self._split(signature):
+            keys |= self._buckets.get(band_key, set())
+        return keys
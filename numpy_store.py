@@ -0,0 +1,340 @@
+"""
+このファイルは、検索用のベクターストアを NumPy のメモリマップした行列として保持する処理が記述されたファイルです。
+- 正規化した埋め込みを float16 / int8（行ごとの倍率付き）の行列（vectors.npy）として保存し、検索時はメモリマップで開く
+  （複数プロセスで開いても、OSのページキャッシュ上の同じデータを読み取り専用で共有する）
+- チャンクの本文は1つのバイナリファイル（texts.bin）と位置の配列、IDとメタデータは小さなJSON（records.json）に保存する
+- 検索は全件との内積をブロック単位でまとめて計算し、argpartition で上位n件を取り出すだけのため、追加の索引を持たない
+- インデックスの作成・差分更新は従来どおり Chroma で行い、更新後のバージョンごとにこの形式へ書き出す
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import json
+import math
+import shutil
+import numpy as np
+from langchain_core.documents import Document
+import constants as ct
+
+
+############################################################
+# クラス定義
+############################################################
+
+class NumpyVectorStore:
+    """
+    メモリマップした行列による、読み取り専用のベクターストア
+    """
+
+    def __init__(self, path, embeddings=None):
+        """
+        Args:
+            path: 保存先のディレクトリ
+            embeddings: 検索クエリのベクトル化に使う埋め込みモデル
+        """
+        self.path = path
+        self._embedding_function = embeddings
+
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.text_offsets = np.load(os.path.join(path, "text_offsets.npy"), mmap_mode="r")
+        texts_path = os.path.join(path, "texts.bin")
+        if os.path.getsize(texts_path):
+            self.texts = np.memmap(texts_path, dtype=np.uint8, mode="r")
+        else:
+            self.texts = np.zeros(0, dtype=np.uint8)
+        with open(os.path.join(path, "records.json"), encoding="utf8") as f:
+            records = json.load(f)
+        self.ids = records["ids"]
+        self.metadatas = records["metadatas"]
+        # 参照元のファイル → 行番号の配列（検索対象を特定のファイルに限定する場合に使用）
+        rows_by_source = {}
+        for row, metadata in enumerate(self.metadatas):
+            rows_by_source.setdefault((metadata or {}).get("source"), []).append(row)
+        self.rows_by_source = {source: np.array(rows, dtype=np.int64) for source, rows in rows_by_source.items()}
+        # int8 の場合は、行ごとに「最大の絶対値が127になる倍率」を掛けて保存している
+        scales_path = os.path.join(path, "scales.npy")
+        self.scales = np.load(scales_path, mmap_mode="r") if os.path.isfile(scales_path) else None
+
+    @property
+    def embeddings(self):
+        return self._embedding_function
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, path, count, dim, batches, dtype=ct.NUMPY_STORE_DTYPE):
+        """
+        チャンクと埋め込みから保存先のディレクトリを作成（一時ディレクトリに書いてから置き換える）
+
+        Args:
+            path: 保存先のディレクトリ
+            count: チャンク数
+            dim: 埋め込みの次元数
+            batches: (IDのリスト, 本文のリスト, メタデータのリスト, 埋め込みの配列) のイテラブル
+            dtype: 保存する行列の型（"float16" または "int8"）
+        """
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        vectors = np.lib.format.open_memmap(
+            os.path.join(tmp_path, "vectors.npy"), mode="w+", dtype=np.dtype(dtype), shape=(count, dim)
+        )
+        scales = np.ones(count, dtype=np.float32)
+        text_offsets = np.zeros(count + 1, dtype=np.int64)
+        ids, metadatas = [], []
+        row = 0
+        with open(os.path.join(tmp_path, "texts.bin"), "wb") as texts_file:
+            for batch_ids, batch_texts, batch_metadatas, batch_vectors in batches:
+                batch_vectors = np.asarray(batch_vectors, dtype=np.float32)
+                norms = np.linalg.norm(batch_vectors, axis=1, keepdims=True)
+                batch_vectors = np.divide(batch_vectors, norms, out=np.zeros_like(batch_vectors), where=norms > 0)
+                if dtype == "int8":
+                    max_abs = np.abs(batch_vectors).max(axis=1)
+                    batch_scales = np.divide(127.0, max_abs, out=np.ones_like(max_abs), where=max_abs > 0)
+                    scales[row:row + len(batch_ids)] = batch_scales
+                    batch_vectors = np.clip(np.round(batch_vectors * batch_scales[:, None]), -127, 127)
+                vectors[row:row + len(batch_ids)] = batch_vectors
+
+                for text in batch_texts:
+                    encoded = text.encode("utf-8")
+                    texts_file.write(encoded)
+                    text_offsets[row + 1] = text_offsets[row] + len(encoded)
+                    row += 1
+                ids.extend(batch_ids)
+                metadatas.extend(metadata or {} for metadata in batch_metadatas)
+
+        vectors.flush()
+        del vectors
+        np.save(os.path.join(tmp_path, "text_offsets.npy"), text_offsets)
+        if dtype == "int8":
+            np.save(os.path.join(tmp_path, "scales.npy"), scales)
+        with open(os.path.join(tmp_path, "records.json"), "w", encoding="utf8") as f:
+            json.dump({"ids": ids, "metadatas": metadatas}, f, ensure_ascii=False)
+
+        # 他のプロセスが同じバージョンを先に書き出していた場合は、そちらを使う
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def from_chroma(cls, db, path, dtype=ct.NUMPY_STORE_DTYPE, batch_size=ct.NUMPY_STORE_EXPORT_BATCH_SIZE):
+        """
+        Chroma のベクターストアの全チャンクを書き出して開く（書き出し済みの場合は開くのみ）
+
+        Args:
+            db: 書き出し元の Chroma のベクターストア
+            path: 保存先のディレクトリ
+            dtype: 保存する行列の型
+            batch_size: Chroma から1度に読み出すチャンク数
+
+        Returns:
+            作成した NumpyVectorStore
+        """
+        if not os.path.isdir(path):
+            ids = db.get(include=[])["ids"]
+
+            def _batches():
+                for start in range(0, len(ids), batch_size):
+                    data = db._collection.get(
+                        ids=ids[start:start + batch_size], include=["embeddings", "documents", "metadatas"]
+                    )
+                    yield data["ids"], data["documents"], data["metadatas"], data["embeddings"]
+
+            dim = 0
+            if ids:
+                dim = len(db._collection.get(ids=ids[:1], include=["embeddings"])["embeddings"][0])
+            cls.build(path, len(ids), dim, _batches(), dtype)
+
+        return cls(path, db.embeddings)
+
+    def search_by_vector(self, vector, n, sources=None):
+        """
+        ベクトルとのコサイン類似度が高い順に、上位n件の行番号を取得
+
+        Args:
+            vector: 検索クエリの埋め込み
+            n: 取得件数
+            sources: 検索対象とする参照元のファイルのパスの集合（省略時は全件）
+
+        Returns:
+            (行番号の配列, コサイン類似度の配列) のタプル（類似度の降順）
+        """
+        if sources is not None:
+            return self._search_rows(vector, n, sources)
+
+        count = len(self)
+        n = min(n, count)
+        if n <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        query = self._normalize_query(vector)
+
+        # float16 / int8 の行列全体を float32 に変換するとメモリを大きく使うため、ブロックごとに計算
+        scores = np.empty(count, dtype=np.float32)
+        block = ct.NUMPY_STORE_SEARCH_BLOCK_ROWS
+        for start in range(0, count, block):
+            scores[start:start + block] = self.vectors[start:start + block].astype(np.float32) @ query
+        if self.scales is not None:
+            scores /= self.scales
+
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return top, scores[top]
+
+    def _search_rows(self, vector, n, sources):
+        """
+        参照元のファイルに限定した検索（対象の行だけと内積を計算する）
+        """
+        rows = [self.rows_by_source[source] for source in sources if source in self.rows_by_source]
+        rows = np.sort(np.concatenate(rows)) if rows else np.zeros(0, dtype=np.int64)
+        n = min(n, len(rows))
+        if n <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        scores = self.vectors[rows].astype(np.float32) @ self._normalize_query(vector)
+        if self.scales is not None:
+            scores /= self.scales[rows]
+
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return rows[top], scores[top]
+
+    @staticmethod
+    def _normalize_query(vector):
+        query = np.asarray(vector, dtype=np.float32)
+        return query / max(float(np.linalg.norm(query)), 1e-12)
+
+    def query_with_scores(self, query, n, include_embeddings=False, query_embedding=None, sources=None):
+        """
+        ベクトル検索を実行し、関連度スコアと（必要な場合は）埋め込みも合わせて返す
+
+        Args:
+            query: 検索クエリ
+            n: 取得件数
+            include_embeddings: 埋め込みも返すかどうか
+            query_embedding: 検索クエリの埋め込み（省略時はここでベクトル化する）
+            sources: 検索対象とする参照元のファイルのパスの集合（省略時は全件）
+
+        Returns:
+            (ドキュメント, 関連度スコア, 埋め込み or None) のリスト（関連度の降順）
+        """
+        if query_embedding is None:
+            query_embedding = self.embeddings.embed_query(query)
+        rows, similarities = self.search_by_vector(query_embedding, n, sources)
+        return [
+            (
+                self.document(row),
+                relevance_score(similarity),
+                self.vector(row) if include_embeddings else None
+            )
+            for row, similarity in zip(rows, similarities)
+        ]
+
+    def similarity_search_with_relevance_scores(self, query, k=ct.RETRIEVER_TOP_K):
+        """
+        LangChain のベクターストアと同じ形式で、ドキュメントと関連度スコアを返す
+
+        Args:
+            query: 検索クエリ
+            k: 取得件数
+
+        Returns:
+            (ドキュメント, 関連度スコア) のリスト（関連度の降順）
+        """
+        return [(doc, score) for doc, score, _ in self.query_with_scores(query, k)]
+
+    def get(self, include=("documents", "metadatas")):
+        """
+        全チャンクの取得（Chroma の get と同じ形式。語彙検索用インデックスの作成に使用）
+
+        Args:
+            include: 取得する項目（"documents", "metadatas"）
+
+        Returns:
+            ids, documents, metadatas を持つ辞書
+        """
+        return {
+            "ids": list(self.ids),
+            "documents": [self.text(row) for row in range(len(self))] if "documents" in include else None,
+            "metadatas": [dict(metadata) for metadata in self.metadatas] if "metadatas" in include else None,
+        }
+
+    def vector(self, row):
+        """
+        チャンクの正規化済みの埋め込み
+
+        Args:
+            row: 行番号
+
+        Returns:
+            埋め込み（float32 の配列）
+        """
+        vector = self.vectors[row].astype(np.float32)
+        if self.scales is not None:
+            vector /= self.scales[row]
+        return vector
+
+    def text(self, row):
+        """
+        チャンクの本文
+
+        Args:
+            row: 行番号
+
+        Returns:
+            本文
+        """
+        return bytes(self.texts[self.text_offsets[row]:self.text_offsets[row + 1]]).decode("utf-8")
+
+    def document(self, row):
+        """
+        チャンクのドキュメント
+
+        Args:
+            row: 行番号
+
+        Returns:
+            ドキュメント
+        """
+        return Document(page_content=self.text(row), metadata=dict(self.metadatas[row]))
+
+
+############################################################
+# 関数定義
+############################################################
+
+def relevance_score(similarity):
+    """
+    コサイン類似度から、Chroma の既定（L2の2乗距離）と同じ尺度の関連度スコアに変換
+    （正規化済みのベクトルでは L2の2乗距離 = 2 - 2 × コサイン類似度）
+
+    Args:
+        similarity: コサイン類似度
+
+    Returns:
+        関連度スコア
+    """
+    return 1.0 - (2.0 - 2.0 * float(similarity)) / math.sqrt(2)
+
+
+def prune_snapshots(base_dir, keep):
+    """
+    使われなくなった古いバージョンの書き出し先を削除
+    （他のプロセスがメモリマップで開いていても、Linux/macOS では閉じるまで読み続けられる）
+
+    Args:
+        base_dir: 書き出し先の親ディレクトリ
+        keep: 残すディレクトリ名のリスト
+    """
+    if not os.path.isdir(base_dir):
+        return
+    for name in os.listdir(base_dir):
+        if name not in keep and ".tmp-" not in name:
+            shutil.rmtree(os.path.join(base_dir, name), ignore_errors=True)
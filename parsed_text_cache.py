@@ -0,0 +1,327 @@
+"""
+このファイルは、データソースのファイルから抽出したテキスト（ページ単位の本文とメタデータ）をローカルにキャッシュする処理が記述されたファイルです。
+- キャッシュはファイルごとに1つの圧縮したJSONL（1行目がヘッダー、2行目以降がページ単位のドキュメント）
+- キャッシュキーは「ファイルの中身のハッシュ値 + 読み込み処理のバージョン」で、ライブラリのバージョンが変わると別のキーになる
+- チャンク分割の設定や文字列調整（adjust_string）を変えても、PDF・Wordファイルのテキスト抽出をやり直さずに済む
+- zstandard がインストールされていれば zstd、なければ gzip で圧縮する（どちらの形式も読み込める）
+- 「python -m parsed_text_cache warm / inspect / prune」で、キャッシュの作成・内容の確認・削除ができる
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import io
+import gzip
+import json
+import time
+import hashlib
+import logging
+import argparse
+from functools import lru_cache
+from importlib import metadata
+from langchain_core.documents import Document
+import constants as ct
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+############################################################
+# 設定関連
+############################################################
+# 読み込み処理のバージョンに含めるライブラリ（テキストの抽出結果が変わりうるもの）
+_LOADER_PACKAGES = ["langchain-community", "PyMuPDF", "docx2txt"]
+_EXTENSIONS = (".jsonl.zst", ".jsonl.gz")
+
+
+############################################################
+# 関数定義
+############################################################
+
+@lru_cache(maxsize=1)
+def loader_version():
+    """
+    読み込み処理のバージョン（抽出処理の変更時は PARSED_TEXT_CACHE_VERSION を上げる）
+
+    Returns:
+        バージョンの文字列
+    """
+    versions = [f"v{ct.PARSED_TEXT_CACHE_VERSION}"]
+    for package in _LOADER_PACKAGES:
+        try:
+            versions.append(f"{package}=={metadata.version(package)}")
+        except metadata.PackageNotFoundError:
+            versions.append(f"{package}==none")
+    return ";".join(versions)
+
+
+def loader_tag():
+    """
+    キャッシュのファイル名に含める、読み込み処理のバージョンの短いハッシュ値
+
+    Returns:
+        ハッシュ値の先頭8文字
+    """
+    return hashlib.sha256(loader_version().encode("utf-8")).hexdigest()[:8]
+
+
+def artifact_stem(digest, cache_dir=ct.PARSED_TEXT_CACHE_DIR_PATH):
+    """
+    キャッシュのファイルパス（拡張子を除く）
+
+    Args:
+        digest: データソースのファイルのハッシュ値
+        cache_dir: キャッシュの保存先のディレクトリ
+
+    Returns:
+        拡張子を除いたファイルパス
+    """
+    return os.path.join(cache_dir, f"{digest}-{loader_tag()}")
+
+
+def write_artifact(path, header, docs):
+    """
+    ドキュメントを圧縮したJSONLとして保存（一時ファイルに書いてから置き換える）
+
+    Args:
+        path: 保存先のファイルパス（拡張子で圧縮形式を決める）
+        header: 1行目に書くヘッダーの辞書
+        docs: ドキュメントのリスト
+    """
+    lines = [json.dumps(header, ensure_ascii=False)]
+    lines.extend(
+        json.dumps({"page_content": doc.page_content, "metadata": doc.metadata}, ensure_ascii=False)
+        for doc in docs
+    )
+    data = ("\n".join(lines) + "\n").encode("utf-8")
+    if path.endswith(".zst"):
+        data = zstandard.ZstdCompressor(level=ct.PARSED_TEXT_CACHE_ZSTD_LEVEL).compress(data)
+    else:
+        data = gzip.compress(data, compresslevel=6)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def read_artifact(path, header_only=False):
+    """
+    キャッシュのファイルの読み込み
+
+    Args:
+        path: キャッシュのファイルパス
+        header_only: ヘッダーのみを読むかどうか
+
+    Returns:
+        (ヘッダーの辞書, ドキュメントのリスト) のタプル（header_only の場合、ドキュメントは None）
+    """
+    with open(path, "rb") as f:
+        if path.endswith(".zst"):
+            stream = zstandard.ZstdDecompressor().stream_reader(f)
+        else:
+            stream = gzip.GzipFile(fileobj=f)
+        reader = io.TextIOWrapper(stream, encoding="utf-8")
+        header = json.loads(reader.readline())
+        if header_only:
+            return header, None
+        docs = [Document(**json.loads(line)) for line in reader if line.strip()]
+    return header, docs
+
+
+def find_artifact(digest, cache_dir=ct.PARSED_TEXT_CACHE_DIR_PATH):
+    """
+    ファイルのハッシュ値と現在の読み込み処理のバージョンに対応するキャッシュを探す
+
+    Args:
+        digest: データソースのファイルのハッシュ値
+        cache_dir: キャッシュの保存先のディレクトリ
+
+    Returns:
+        キャッシュのファイルパス（ない場合は None）
+    """
+    stem = artifact_stem(digest, cache_dir)
+    for extension in _EXTENSIONS:
+        if os.path.isfile(stem + extension):
+            return stem + extension
+    return None
+
+
+def load(path, digest, loader, cache_dir=ct.PARSED_TEXT_CACHE_DIR_PATH):
+    """
+    キャッシュがあればキャッシュから、なければ loader でファイルを読み込んでキャッシュに保存
+
+    Args:
+        path: データソースのファイルパス
+        digest: ファイルのハッシュ値
+        loader: キャッシュがない場合にファイルを読み込む関数
+        cache_dir: キャッシュの保存先のディレクトリ
+
+    Returns:
+        読み込んだドキュメントのリスト
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    artifact = find_artifact(digest, cache_dir)
+    if artifact is not None:
+        try:
+            header, docs = read_artifact(artifact)
+        except Exception as e:
+            logger.warning(f"抽出済みテキストのキャッシュを読み込めないため、ファイルを読み込み直します: {artifact}\n{e}")
+        else:
+            # 中身が同じ別のファイル（コピー・移動）のキャッシュの場合は、メタデータのファイルパスを置き換える
+            if header.get("source") != path:
+                for doc in docs:
+                    for key, value in doc.metadata.items():
+                        if value == header.get("source"):
+                            doc.metadata[key] = path
+            return docs
+
+    docs = loader(path)
+    extension = _EXTENSIONS[0] if zstandard is not None else _EXTENSIONS[1]
+    header = {
+        "source": path,
+        "sha256": digest,
+        "loader": loader_version(),
+        "pages": len(docs),
+        "chars": sum(len(doc.page_content) for doc in docs),
+        "created": time.time(),
+    }
+    try:
+        write_artifact(artifact_stem(digest, cache_dir) + extension, header, docs)
+    except Exception as e:
+        # キャッシュに保存できなくても、読み込み結果はそのまま使う
+        logger.warning(f"抽出済みテキストのキャッシュを保存できませんでした: {path}\n{e}")
+    return docs
+
+
+def iter_artifacts(cache_dir=ct.PARSED_TEXT_CACHE_DIR_PATH):
+    """
+    保存済みのキャッシュを順に返す
+
+    Args:
+        cache_dir: キャッシュの保存先のディレクトリ
+
+    Yields:
+        (ファイルパス, ヘッダーの辞書 または None（読み込めない場合）) のタプル
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    for name in sorted(os.listdir(cache_dir)):
+        if not name.endswith(_EXTENSIONS):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            header, _ = read_artifact(path, header_only=True)
+        except Exception:
+            header = None
+        yield path, header
+
+
+def prune(keep_digests=None, max_age_days=None, cache_dir=ct.PARSED_TEXT_CACHE_DIR_PATH):
+    """
+    使われなくなったキャッシュを削除
+    - 読み込み処理のバージョンが古いもの、読み込めないもの、書き込み途中で残った一時ファイルは常に削除する
+
+    Args:
+        keep_digests: 残すファイルのハッシュ値の集合（省略時はハッシュ値では削除しない）
+        max_age_days: この日数より前に作成したものを削除する（省略時は作成日時では削除しない）
+        cache_dir: キャッシュの保存先のディレクトリ
+
+    Returns:
+        (削除したファイル数, 削除したバイト数) のタプル
+    """
+    removed, removed_bytes = 0, 0
+    if not os.path.isdir(cache_dir):
+        return removed, removed_bytes
+
+    tag = loader_tag()
+    now = time.time()
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if ".tmp-" in name:
+            # 他のプロセスが書き込み中の可能性があるため、1時間以上前のもののみ削除
+            stale = now - os.path.getmtime(path) > 60 * 60
+        elif name.endswith(_EXTENSIONS):
+            digest, _, rest = name.partition("-")
+            header = None
+            try:
+                header, _ = read_artifact(path, header_only=True)
+            except Exception:
+                pass
+            stale = (
+                header is None
+                or not rest.startswith(tag)
+                or (keep_digests is not None and digest not in keep_digests)
+                or (max_age_days is not None and now - header.get("created", 0) > max_age_days * 24 * 60 * 60)
+            )
+        else:
+            continue
+        if stale:
+            removed_bytes += os.path.getsize(path)
+            os.remove(path)
+            removed += 1
+    return removed, removed_bytes
+
+
+def main():
+    # indexing はこのモジュールを読み込むため、CLIとして実行する場合のみ読み込む
+    from indexing import collect_source_files, file_sha256, load_files
+
+    parser = argparse.ArgumentParser(description="抽出済みテキストのキャッシュの作成・確認・削除")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    warm_parser = subparsers.add_parser("warm", help="データソースのファイルを読み込み、キャッシュを作成する")
+    warm_parser.add_argument("--data-dir", default=ct.RAG_TOP_FOLDER_PATH, help="データソースのディレクトリ")
+    warm_parser.add_argument("--workers", type=int, default=ct.LOAD_MAX_WORKERS, help="並列に読み込むプロセス数")
+    subparsers.add_parser("inspect", help="キャッシュの一覧と合計サイズを表示する")
+    prune_parser = subparsers.add_parser("prune", help="使われなくなったキャッシュを削除する")
+    prune_parser.add_argument("--data-dir", default=ct.RAG_TOP_FOLDER_PATH, help="データソースのディレクトリ（現在のファイル以外のキャッシュを削除）")
+    prune_parser.add_argument("--keep-all-sources", action="store_true", help="現在のファイル以外のキャッシュも残す")
+    prune_parser.add_argument("--max-age-days", type=float, help="この日数より前に作成したキャッシュを削除する")
+    args = parser.parse_args()
+
+    if args.command == "warm":
+        paths = collect_source_files(args.data_dir)
+        digests = {path: file_sha256(path) for path in paths}
+        missing = [path for path in paths if find_artifact(digests[path]) is None]
+        start = time.perf_counter()
+        failed = sum(docs is None for _, docs in load_files(missing, max_workers=args.workers, digest_of=digests.get))
+        print(
+            f"ファイル数: {len(paths)}, キャッシュ済み: {len(paths) - len(missing)}件, "
+            f"新たに作成: {len(missing) - failed}件, 失敗: {failed}件（{time.perf_counter() - start:.2f}秒）"
+        )
+
+    elif args.command == "inspect":
+        tag = loader_tag()
+        count, total_bytes, total_chars = 0, 0, 0
+        for path, header in iter_artifacts():
+            size = os.path.getsize(path)
+            count += 1
+            total_bytes += size
+            if header is None:
+                print(f"{os.path.basename(path)}: 読み込めません（{size:,}バイト）")
+                continue
+            total_chars += header.get("chars", 0)
+            state = "" if os.path.basename(path).split("-")[1].startswith(tag) else "（古い読み込み処理）"
+            print(
+                f"{header.get('source')}: {header.get('pages')}ページ, {header.get('chars', 0):,}文字, "
+                f"{size:,}バイト, 作成 {time.strftime('%Y-%m-%d %H:%M', time.localtime(header.get('created', 0)))}{state}"
+            )
+        print(
+            f"合計: {count}件, {total_bytes:,}バイト, {total_chars:,}文字, "
+            f"圧縮形式: {'zstd' if zstandard is not None else 'gzip'}, 読み込み処理: {loader_version()}"
+        )
+
+    elif args.command == "prune":
+        keep_digests = None
+        if not args.keep_all_sources:
+            keep_digests = {file_sha256(path) for path in collect_source_files(args.data_dir)}
+        removed, removed_bytes = prune(keep_digests, args.max_age_days)
+        print(f"削除: {removed}件, {removed_bytes:,}バイト")
+
+
+if __name__ == "__main__":
+    main()
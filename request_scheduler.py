@@ -0,0 +1,571 @@
+"""
+このファイルは、OpenAI API（チャット・埋め込み）の呼び出しをプロセス内でまとめて制御する処理が記述されたファイルです。
+- 同じ内容の呼び出しが同時に複数あれば、最初の1回だけ送信し、他の呼び出しはその結果を共有する（シングルフライト）
+  （ストリーミングで最初の呼び出し元が途中で読むのをやめても、共有している側が読み終えるまで応答を読み続ける）
+- 同時実行数・1分あたりのトークン数の上限を超える場合は、順番待ちしてから送信する
+- レート制限（429）などで失敗した場合は、ランダムな揺らぎ付きの指数的な間隔で再試行する
+  （429の場合は、他の呼び出しも同じ時間だけ送信を控え、一斉に再送しない）
+- 順番待ちの件数・待ち時間などは stats で取得でき、ログと検索サーバーの /health に出力する
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+import openai
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import Runnable
+import constants as ct
+from token_counter import count_tokens, count_message_tokens
+
+
+############################################################
+# 設定関連
+############################################################
+# 再試行する例外（残高不足による429は、待っても解消しないため再試行しない）
+_RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+# 遅い呼び出しの複製（ヘッジ）を送る間は、同じ内容の送信中の呼び出しに相乗りしない
+_independent = contextvars.ContextVar("request_scheduler_independent", default=False)
+
+
+############################################################
+# 関数定義
+############################################################
+
+@lru_cache(maxsize=None)
+def get_scheduler(kind):
+    """
+    プロセス内で共有する呼び出しの制御オブジェクトの取得
+
+    Args:
+        kind: "chat" または "embedding"
+
+    Returns:
+        RequestScheduler
+    """
+    if kind == "chat":
+        return RequestScheduler(kind, ct.OPENAI_CHAT_MAX_CONCURRENCY, ct.OPENAI_CHAT_TPM_LIMIT)
+    return RequestScheduler(kind, ct.OPENAI_EMBEDDING_MAX_CONCURRENCY, ct.OPENAI_EMBEDDING_TPM_LIMIT)
+
+
+def describe_schedulers():
+    """
+    チャット・埋め込みの呼び出しの状況（ログ出力用）
+
+    Returns:
+        状況の文字列
+    """
+    return ", ".join(
+        f"{kind}: 待機中 {stats['queued']}件 / 実行中 {stats['running']}件 / 平均待ち {stats['wait_avg_ms']:.1f}ms"
+        f" / 共有 {stats['coalesced']}回 / 再試行 {stats['retries']}回"
+        for kind, stats in ((kind, get_scheduler(kind).stats()) for kind in ("chat", "embedding"))
+    )
+
+
+@contextmanager
+def independent_calls():
+    """
+    この中での呼び出しは、同じ内容の送信中の呼び出しと共有せず、新しく送信する（ヘッジで複製を送る場合に使う）
+    """
+    token = _independent.set(True)
+    try:
+        yield
+    finally:
+        _independent.reset(token)
+
+
+def request_key(*parts):
+    """
+    シングルフライトのキー（呼び出しの内容のハッシュ値）
+
+    Args:
+        parts: JSON に変換できる呼び出しの内容
+
+    Returns:
+        キーの文字列
+    """
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+############################################################
+# クラス定義
+############################################################
+
+class _Flight:
+    """
+    送信中の1回の呼び出しの結果（同じ内容の呼び出しで共有する）
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.chunks = []
+        self.result = None
+        self.error = None
+        self.done = False
+        # ストリーミングの断片を読んでいる呼び出し元の数（RequestScheduler のロックを取得した状態で増減する）
+        self.readers = 1
+
+    def append(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    def finish(self, result=None):
+        with self._cond:
+            self.result = result
+            self.done = True
+            self._cond.notify_all()
+
+    def fail(self, error):
+        with self._cond:
+            self.error = error
+            self.done = True
+            self._cond.notify_all()
+
+    def wait(self):
+        """
+        結果が出るまで待って返す
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.done)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def replay(self):
+        """
+        ストリーミングの断片を、届いた順に返す
+        """
+        i = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self.done or len(self.chunks) > i)
+                chunks = self.chunks[i:]
+                done = self.done
+            yield from chunks
+            i += len(chunks)
+            if done and i == len(self.chunks):
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class RequestScheduler:
+    """
+    外部APIの呼び出しの同時実行数・1分あたりのトークン数の制限、同じ内容の呼び出しの共有、再試行を行うクラス
+    """
+
+    def __init__(
+        self,
+        name,
+        max_concurrency,
+        tokens_per_minute=0,
+        max_attempts=ct.OPENAI_RETRY_MAX_ATTEMPTS,
+        retry_base_seconds=ct.OPENAI_RETRY_BASE_SECONDS,
+        retry_max_seconds=ct.OPENAI_RETRY_MAX_SECONDS,
+        queue_timeout=ct.OPENAI_QUEUE_TIMEOUT_SECONDS
+    ):
+        """
+        Args:
+            name: ログに出力する名前
+            max_concurrency: 同時実行数の上限
+            tokens_per_minute: 1分あたりのトークン数の上限（0の場合は制限しない）
+            max_attempts: 最初の呼び出しを含む最大試行回数
+            retry_base_seconds: 再試行の待ち時間の基準
+            retry_max_seconds: 再試行の待ち時間の上限
+            queue_timeout: 順番待ちの最大時間[秒]
+        """
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.queue_timeout = queue_timeout
+
+        self._cond = threading.Condition()
+        self._running = 0
+        self._queued = 0
+        # 直近1分間に送信した (時刻, トークン数)
+        self._usage = deque()
+        self._usage_tokens = 0
+        # レート制限を受けた場合に、全体で送信を控える期限
+        self._paused_until = 0.0
+        self._flights = {}
+
+        self._calls = 0
+        self._coalesced = 0
+        self._retries = 0
+        self._rate_limited = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def stats(self):
+        """
+        現在の順番待ちの件数・実行中の件数と、これまでの待ち時間などの集計
+
+        Returns:
+            集計の辞書
+        """
+        with self._cond:
+            return {
+                "queued": self._queued,
+                "running": self._running,
+                "tokens_last_minute": self._usage_tokens,
+                "calls": self._calls,
+                "coalesced": self._coalesced,
+                "retries": self._retries,
+                "rate_limited": self._rate_limited,
+                "wait_avg_ms": self._wait_total / self._calls * 1000 if self._calls else 0.0,
+                "wait_max_ms": self._wait_max * 1000,
+            }
+
+    def run(self, fn, key=None, tokens=0):
+        """
+        呼び出しの実行（同じキーの呼び出しが送信中であれば、その結果を待って共有する）
+
+        Args:
+            fn: 外部APIを呼び出す関数
+            key: シングルフライトのキー（None の場合は共有しない）
+            tokens: 上限の判定に使う見込みのトークン数
+
+        Returns:
+            fn の戻り値
+        """
+        if key is None or _independent.get():
+            return self._call(fn, tokens)
+
+        flight, leader = self._join(key)
+        if not leader:
+            return flight.wait()
+        try:
+            result = self._call(fn, tokens)
+        except Exception as e:
+            self._leave(key)
+            flight.fail(e)
+            raise
+        self._leave(key)
+        flight.finish(result)
+        return result
+
+    def stream(self, fn, key=None, tokens=0):
+        """
+        ストリーミングの呼び出しの実行（同じキーの呼び出しが送信中であれば、その断片を順に共有する）
+
+        Args:
+            fn: 外部APIを呼び出し、断片のイテレーターを返す関数
+            key: シングルフライトのキー（None の場合は共有しない）
+            tokens: 上限の判定に使う見込みのトークン数
+
+        Yields:
+            断片
+        """
+        if key is None or _independent.get():
+            yield from self._stream_call(fn, tokens)
+            return
+
+        flight, leader = self._join(key)
+        if not leader:
+            try:
+                yield from flight.replay()
+            finally:
+                self._stop_reading(key, flight)
+            return
+
+        upstream = self._stream_call(fn, tokens)
+        try:
+            for chunk in upstream:
+                flight.append(chunk)
+                yield chunk
+        except GeneratorExit:
+            # 呼び出し元が途中で読むのをやめた場合、共有している側がいれば、その分の応答を別スレッドで読み続ける
+            if self._stop_reading(key, flight):
+                threading.Thread(
+                    target=self._drain, args=(key, flight, upstream), name=f"{self.name}-stream-drain", daemon=True
+                ).start()
+            else:
+                upstream.close()
+                flight.fail(RuntimeError(f"{self.name} の呼び出しが中断されました"))
+            raise
+        except BaseException as e:
+            self._leave(key)
+            flight.fail(e if isinstance(e, Exception) else RuntimeError(f"{self.name} の呼び出しが中断されました"))
+            raise
+        self._leave(key)
+        flight.finish()
+
+    def _stop_reading(self, key, flight):
+        """
+        ストリーミングの断片を読むのをやめる（最後の読み手の場合は、以降の呼び出しが相乗りしないようにする）
+
+        Returns:
+            まだ読んでいる呼び出し元がいるかどうか
+        """
+        with self._cond:
+            flight.readers -= 1
+            if flight.readers == 0 and self._flights.get(key) is flight:
+                self._flights.pop(key)
+            return flight.readers > 0
+
+    def _drain(self, key, flight, upstream):
+        """
+        最初の呼び出し元が読むのをやめた後、共有している側のために応答を読み続ける（別スレッドで実行）
+        - 断片ごとに読み手が残っているかを確認し、いなくなれば応答を閉じる
+        """
+        try:
+            for chunk in upstream:
+                with self._cond:
+                    readers = flight.readers
+                if readers == 0:
+                    break
+                flight.append(chunk)
+            else:
+                self._leave(key, flight)
+                flight.finish()
+                return
+        except Exception as e:
+            self._leave(key, flight)
+            flight.fail(e)
+            return
+        upstream.close()
+        flight.fail(RuntimeError(f"{self.name} の呼び出しが中断されました"))
+
+    def _join(self, key):
+        """
+        送信中の同じ呼び出しに相乗りするか、新しく送信する側になる
+
+        Returns:
+            (_Flight, 新しく送信する側かどうか)
+        """
+        with self._cond:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self._coalesced += 1
+                flight.readers += 1
+                return flight, False
+            flight = _Flight()
+            self._flights[key] = flight
+            return flight, True
+
+    def _leave(self, key, flight=None):
+        with self._cond:
+            if flight is None or self._flights.get(key) is flight:
+                self._flights.pop(key, None)
+
+    def _call(self, fn, tokens):
+        """
+        順番待ちしてから呼び出し、失敗した場合は再試行する
+        """
+        attempt = 1
+        while True:
+            self._acquire(tokens)
+            try:
+                return fn()
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                error = e
+            finally:
+                self._release()
+            self._backoff(error, attempt)
+            attempt += 1
+
+    def _stream_call(self, fn, tokens):
+        """
+        順番待ちしてから呼び出し、最初の断片が届く前に失敗した場合は再試行する
+        """
+        attempt = 1
+        while True:
+            self._acquire(tokens)
+            started = False
+            try:
+                for chunk in fn():
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                if started or not self._should_retry(e, attempt):
+                    raise
+                error = e
+            finally:
+                self._release()
+            self._backoff(error, attempt)
+            attempt += 1
+
+    def _acquire(self, tokens):
+        """
+        同時実行数・1分あたりのトークン数・レート制限による送信の控えを満たすまで待つ
+        """
+        logger = logging.getLogger(ct.LOGGER_NAME)
+
+        start = time.monotonic()
+        deadline = start + self.queue_timeout
+        with self._cond:
+            self._queued += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = self._admission_delay(now, tokens)
+                    if delay == 0:
+                        break
+                    if now >= deadline:
+                        raise TimeoutError(
+                            f"{self.name} の順番待ちが {self.queue_timeout:g}秒を超えました"
+                            f"（待機中: {self._queued}件, 実行中: {self._running}件）"
+                        )
+                    self._cond.wait(deadline - now if delay is None else min(delay, deadline - now))
+                self._running += 1
+                self._usage.append((now, tokens))
+                self._usage_tokens += tokens
+                self._calls += 1
+                waited = now - start
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+                queued, running = self._queued - 1, self._running
+            finally:
+                self._queued -= 1
+
+        if waited >= 0.1:
+            logger.info(
+                f"{self.name} の呼び出しを順番待ちしました（{waited * 1000:.0f}ms, 待機中: {queued}件, 実行中: {running}件）"
+            )
+
+    def _admission_delay(self, now, tokens):
+        """
+        送信できるまでの待ち時間（ロックを取得した状態で呼び出す）
+
+        Returns:
+            0: 送信できる / None: 実行中の呼び出しが終わるまで / それ以外: 待つ秒数
+        """
+        # 1分以上前の送信は、トークン数の集計から外す
+        while self._usage and self._usage[0][0] <= now - 60:
+            self._usage_tokens -= self._usage.popleft()[1]
+
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._running >= self.max_concurrency:
+            return None
+        # 1回で上限を超える呼び出しも、直近の送信がなければ送る
+        if self.tokens_per_minute and self._usage and self._usage_tokens + tokens > self.tokens_per_minute:
+            return self._usage[0][0] + 60 - now
+        return 0
+
+    def _release(self):
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+
+    def _should_retry(self, error, attempt):
+        if attempt >= self.max_attempts or not isinstance(error, _RETRYABLE_ERRORS):
+            return False
+        return getattr(error, "code", None) != "insufficient_quota"
+
+    def _backoff(self, error, attempt):
+        """
+        再試行までの待機（429の場合は、他の呼び出しも同じ時間だけ送信を控える）
+        """
+        logger = logging.getLogger(ct.LOGGER_NAME)
+
+        delay = random.uniform(0, min(self.retry_max_seconds, self.retry_base_seconds * 2 ** (attempt - 1)))
+        rate_limited = isinstance(error, openai.RateLimitError)
+        if rate_limited:
+            # Retry-After の指定があれば、それより早くは再送しない
+            headers = getattr(getattr(error, "response", None), "headers", None) or {}
+            try:
+                delay = max(delay, float(headers.get("retry-after", 0)))
+            except ValueError:
+                pass
+
+        with self._cond:
+            self._retries += 1
+            if rate_limited:
+                self._rate_limited += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        logger.warning(
+            f"{self.name} の呼び出しに失敗したため、{delay:.2f}秒後に再試行します"
+            f"（{attempt}/{self.max_attempts - 1}回目）: {type(error).__name__}: {error}"
+        )
+        time.sleep(delay)
+
+
+class ScheduledEmbeddings(Embeddings):
+    """
+    埋め込みモデルをラップし、呼び出しを RequestScheduler で制御するクラス
+    """
+
+    def __init__(self, embeddings, scheduler=None):
+        """
+        Args:
+            embeddings: ラップする埋め込みモデル
+            scheduler: 呼び出しの制御オブジェクト（省略時はプロセス内で共有する "embedding"）
+        """
+        self.embeddings = embeddings
+        # CachedEmbeddings のキャッシュキーが、ラップする前と変わらないようにする
+        self.model = getattr(embeddings, "model", None) or type(embeddings).__name__
+        self.scheduler = scheduler or get_scheduler("embedding")
+
+    def embed_documents(self, texts):
+        return self.scheduler.run(
+            lambda: self.embeddings.embed_documents(texts),
+            key=request_key(self.model, "documents", texts),
+            tokens=sum(count_tokens(text, ct.EMBEDDING_MODEL) for text in texts)
+        )
+
+    def embed_query(self, text):
+        return self.scheduler.run(
+            lambda: self.embeddings.embed_query(text),
+            key=request_key(self.model, "query", text),
+            tokens=count_tokens(text, ct.EMBEDDING_MODEL)
+        )
+
+
+class ScheduledChatModel(Runnable):
+    """
+    チャットモデルをラップし、呼び出しを RequestScheduler で制御する Runnable（チェーンの中で LLM の代わりに使う）
+    """
+
+    def __init__(self, llm, scheduler=None):
+        """
+        Args:
+            llm: ラップするチャットモデル
+            scheduler: 呼び出しの制御オブジェクト（省略時はプロセス内で共有する "chat"）
+        """
+        self.llm = llm
+        self.scheduler = scheduler or get_scheduler("chat")
+
+    def invoke(self, input, config=None, **kwargs):
+        key, tokens = self._request(input)
+        return self.scheduler.run(lambda: self.llm.invoke(input, config, **kwargs), key=key, tokens=tokens)
+
+    def stream(self, input, config=None, **kwargs):
+        key, tokens = self._request(input)
+        yield from self.scheduler.stream(
+            lambda: self.llm.stream(input, config, **kwargs), key=request_key("stream", key), tokens=tokens
+        )
+
+    def _request(self, input):
+        """
+        送信するメッセージから、シングルフライトのキーと見込みのトークン数を求める
+
+        Args:
+            input: プロンプト（PromptValue・メッセージのリスト・文字列）
+
+        Returns:
+            (キー, トークン数)
+        """
+        messages = self.llm._convert_input(input).to_messages()
+        key = request_key(
+            getattr(self.llm, "model_name", None),
+            getattr(self.llm, "temperature", None),
+            [[message.type, message.content] for message in messages]
+        )
+        return key, count_message_tokens(messages) + ct.OPENAI_CHAT_COMPLETION_TOKENS_ESTIMATE
@@ -0,0 +1,215 @@
+"""
+このファイルは、検索時のメモリ上のキャッシュ（2段階）が記述されたファイルです。
+- 1段目：正規化した検索クエリ → クエリの埋め込み（埋め込みモデルの呼び出しを省く）
+- 2段目：（クエリの埋め込みのハッシュ値, 検索条件, インデックスのバージョン）→ 検索結果のチャンクIDの順位（検索そのものを省く）
+- キャッシュはインデックスのスナップショットごとに作成するため、インデックスが更新されると自動的に使われなくなる
+- ヒット率はプロセス内の全セッションで集計し、ログに出力する
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+from langchain_core.documents import Document
+import constants as ct
+
+
+############################################################
+# 関数定義
+############################################################
+
+def normalize_query(query):
+    """
+    キャッシュキーとする検索クエリの正規化（全角・半角の違いと、前後・連続する空白の違いを無視する）
+
+    Args:
+        query: 検索クエリ
+
+    Returns:
+        正規化した検索クエリ
+    """
+    return " ".join(unicodedata.normalize("NFKC", query).split())
+
+
+def embedding_hash(query_embedding):
+    """
+    クエリの埋め込みのハッシュ値
+
+    Args:
+        query_embedding: クエリの埋め込み
+
+    Returns:
+        ハッシュ値（16進数の文字列）
+    """
+    return hashlib.blake2b(np.asarray(query_embedding, dtype=np.float32).tobytes(), digest_size=16).hexdigest()
+
+
+############################################################
+# クラス定義
+############################################################
+
+class LRUCache:
+    """
+    件数上限付きのLRUキャッシュ（複数スレッドから使用できる）
+    """
+
+    def __init__(self, max_size):
+        """
+        Args:
+            max_size: 保持する最大件数（0の場合はキャッシュしない）
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns:
+            キャッシュした値（ない場合は None）
+        """
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class RetrievalCache:
+    """
+    インデックスのあるバージョンに対する、クエリの埋め込みと検索結果のキャッシュ
+    """
+
+    # ヒット率（インデックスのバージョンをまたいで、プロセス内の全セッションで集計する）
+    _stats_lock = threading.Lock()
+    stats = {"embedding_hits": 0, "embedding_lookups": 0, "result_hits": 0, "result_lookups": 0}
+
+    def __init__(
+        self,
+        version,
+        embedding_cache_size=ct.QUERY_EMBEDDING_CACHE_SIZE,
+        result_cache_size=ct.RETRIEVAL_RESULT_CACHE_SIZE
+    ):
+        """
+        Args:
+            version: インデックスのバージョン
+            embedding_cache_size: クエリの埋め込みの保持件数
+            result_cache_size: 検索結果の保持件数
+        """
+        self.version = version
+        self.embeddings = LRUCache(embedding_cache_size)
+        self.results = LRUCache(result_cache_size)
+        # チャンクID → ドキュメント（検索結果のキャッシュがヒットした際に、チャンクIDからドキュメントを復元するため）
+        self._documents = None
+        self._documents_lock = threading.Lock()
+
+    def get_embedding(self, query):
+        """
+        Args:
+            query: 検索クエリ
+
+        Returns:
+            キャッシュしたクエリの埋め込み（ない場合は None）
+        """
+        embedding = self.embeddings.get(normalize_query(query))
+        self._count("embedding", embedding is not None)
+        return embedding
+
+    def put_embedding(self, query, embedding):
+        self.embeddings.put(normalize_query(query), embedding)
+
+    def result_key(self, query_embedding, query, options):
+        """
+        検索結果のキャッシュキー
+
+        Args:
+            query_embedding: クエリの埋め込み
+            query: 検索クエリ（語彙検索を併用する場合。ベクトル検索のみの場合は None）
+            options: 検索結果を左右する検索条件の組（取得件数、候補数、多様化の有無、絞り込み条件など。ハッシュ可能な値）
+
+        Returns:
+            キャッシュキー
+        """
+        return (
+            embedding_hash(query_embedding),
+            normalize_query(query) if query is not None else None,
+            options,
+            self.version,
+        )
+
+    def get_results(self, key, load_documents):
+        """
+        キャッシュした検索結果の取得
+
+        Args:
+            key: result_key で作成したキャッシュキー
+            load_documents: インデックスの全ドキュメントを返す関数（初回のヒット時に1回だけ呼び出す）
+
+        Returns:
+            (ドキュメントのリスト, ベクトル検索の関連度スコアのリスト, 語彙検索で完全一致した語があるか)（ない場合は None）
+        """
+        cached = self.results.get(key)
+        if cached is not None:
+            chunk_ids, scores, lexical_match = cached
+            documents = self._get_documents(load_documents)
+            if all(chunk_id in documents for chunk_id in chunk_ids):
+                self._count("result", True)
+                # 呼び出し元でメタデータを書き換えても、キャッシュや他のセッションの結果に影響しないよう複製を返す
+                docs = [
+                    Document(page_content=documents[chunk_id].page_content, metadata=dict(documents[chunk_id].metadata))
+                    for chunk_id in chunk_ids
+                ]
+                return docs, list(scores), lexical_match
+        self._count("result", False)
+        return None
+
+    def put_results(self, key, chunk_ids, scores, lexical_match):
+        self.results.put(key, (tuple(chunk_ids), tuple(scores), lexical_match))
+
+    def hit_rates(self):
+        """
+        Returns:
+            ヒット率のログ用の文字列
+        """
+        with RetrievalCache._stats_lock:
+            stats = dict(RetrievalCache.stats)
+        return (
+            f"クエリの埋め込み {self._rate(stats['embedding_hits'], stats['embedding_lookups'])}, "
+            f"検索結果 {self._rate(stats['result_hits'], stats['result_lookups'])}"
+        )
+
+    def _get_documents(self, load_documents):
+        with self._documents_lock:
+            if self._documents is None:
+                self._documents = dict(load_documents())
+            return self._documents
+
+    @staticmethod
+    def _count(level, hit):
+        with RetrievalCache._stats_lock:
+            RetrievalCache.stats[f"{level}_lookups"] += 1
+            RetrievalCache.stats[f"{level}_hits"] += hit
+
+    @staticmethod
+    def _rate(hits, lookups):
+        return f"{hits}/{lookups} = {hits / lookups:.1%}" if lookups else "0/0"
@@ -0,0 +1,199 @@
+"""
+このファイルは、検索サーバー（retrieval_server.py）に検索を問い合わせるクライアントが記述されたファイルです。
+- RETRIEVAL_SERVER_URL を設定した場合、各 Streamlit プロセスはインデックスを持たず、RemoteIndexManager 経由で検索する
+- 検索サーバーへの接続はプロセス内で使い回す（接続の確立・TLSのハンドシェイクを毎回行わない）
+- 表形式データ（CSV）の集計は件数が小さいため、各プロセスで読み込み、インデックスのバージョンが変わったときに読み直す
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import time
+import logging
+import threading
+from functools import lru_cache
+from typing import Any, List, Optional
+import httpx
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+import constants as ct
+import indexing
+from table_query import TableStore
+
+
+############################################################
+# 関数定義
+############################################################
+
+@lru_cache(maxsize=None)
+def get_http_client(url):
+    """
+    検索サーバーへの HTTP クライアントの取得（プロセス内で URL ごとに1つだけ作成し、接続を使い回す）
+
+    Args:
+        url: 検索サーバーの URL（"unix:" で始まる場合は Unix ドメインソケットのパス）
+
+    Returns:
+        httpx.Client
+    """
+    limits = httpx.Limits(
+        max_connections=ct.RETRIEVAL_CLIENT_MAX_CONNECTIONS,
+        max_keepalive_connections=ct.RETRIEVAL_CLIENT_MAX_CONNECTIONS
+    )
+    if url.startswith("unix:"):
+        transport = httpx.HTTPTransport(uds=url[len("unix:"):], limits=limits)
+        return httpx.Client(base_url="http://retrieval-server", transport=transport, timeout=ct.RETRIEVAL_CLIENT_TIMEOUT_SECONDS)
+    return httpx.Client(base_url=url, limits=limits, timeout=ct.RETRIEVAL_CLIENT_TIMEOUT_SECONDS)
+
+
+############################################################
+# クラス定義
+############################################################
+
+class IndexVersionChanged(Exception):
+    """
+    検索サーバーのインデックスのバージョンが、クライアントが前提とするバージョンから変わっていた
+    """
+
+    def __init__(self, expected, actual):
+        super().__init__(f"検索サーバーのインデックスのバージョンが変わっていました（{expected} → {actual}）")
+        self.expected = expected
+        self.actual = actual
+
+
+class RemoteRetriever(BaseRetriever):
+    """
+    検索サーバーに検索を問い合わせるRetriever（HybridRetriever と同じく search_with_scores を持つ）
+    - version を指定した場合は、そのバージョンのインデックスでのみ検索する（回答キャッシュのキーのバージョンと検索結果を一致させるため）
+    """
+
+    url: str
+    k: int = ct.RETRIEVER_TOP_K
+    client: Any = None
+    version: Optional[str] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        docs, _, _ = self.search_with_scores(query)
+        return docs
+
+    def search_with_scores(self, query):
+        """
+        検索を実行し、ベクトル検索の関連度スコアと語彙検索の完全一致の有無も合わせて返す
+
+        Args:
+            query: 検索クエリ
+
+        Returns:
+            (検索結果のドキュメントのリスト, ベクトル検索の関連度スコアのリスト（降順）, 語彙検索で完全一致した語があるか)
+        """
+        return self.search_batch([query])[0]
+
+    def search_batch(self, queries):
+        """
+        複数のクエリを1回のリクエストで検索（クエリの埋め込みは検索サーバーでまとめて行われる）
+
+        Args:
+            queries: 検索クエリのリスト
+
+        Returns:
+            クエリごとの (ドキュメントのリスト, 関連度スコアのリスト, 語彙検索の完全一致の有無) のリスト
+
+        Raises:
+            IndexVersionChanged: version を指定し、検索サーバーのバージョンが異なっていた場合
+        """
+        client = self.client or get_http_client(self.url)
+        response = client.post("/search", json={"queries": list(queries), "k": self.k, "version": self.version})
+        if response.status_code == 409:
+            raise IndexVersionChanged(self.version, response.json()["detail"]["version"])
+        response.raise_for_status()
+        return [
+            (
+                [Document(page_content=doc["page_content"], metadata=doc["metadata"]) for doc in result["documents"]],
+                result["scores"],
+                result.get("lexical_match", False),
+            )
+            for result in response.json()["results"]
+        ]
+
+
+class RemoteIndexSnapshot:
+    """
+    検索サーバーのある時点のインデックスのバージョンと、検索・集計に使うオブジェクトの組（IndexSnapshot と同じ属性を持つ）
+    """
+
+    def __init__(self, version, retriever, table_store):
+        """
+        Args:
+            version: 検索サーバーのインデックスのバージョン
+            retriever: このバージョンのインデックスでのみ検索する RemoteRetriever
+            table_store: 表形式データ（CSV）の集計用テーブル
+        """
+        self.version = version
+        self.retriever = retriever
+        self.table_store = table_store
+
+
+class RemoteIndexManager:
+    """
+    検索サーバーのインデックスを使う場合の、IndexManager の代わりとなるクラス
+    """
+
+    def __init__(self, url=None):
+        """
+        Args:
+            url: 検索サーバーの URL（省略時は RETRIEVAL_SERVER_URL）
+        """
+        self.url = url or ct.RETRIEVAL_SERVER_URL
+        self._client = get_http_client(self.url)
+        self._retriever = RemoteRetriever(url=self.url, client=self._client)
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._check_version()
+
+    def expire(self):
+        """
+        次に current を参照した時点で、検索サーバーのバージョンを確認し直す（バージョンが変わっていたことが分かった場合）
+        """
+        self._checked_at = 0.0
+
+    @property
+    def current(self):
+        """
+        現在のスナップショット（バージョンは RETRIEVAL_CLIENT_VERSION_CHECK_SECONDS の間隔で検索サーバーに確認する）
+        """
+        if time.monotonic() - self._checked_at >= ct.RETRIEVAL_CLIENT_VERSION_CHECK_SECONDS:
+            # 確認中の他のリクエストは、確認が終わるのを待たず取得済みのスナップショットを使う
+            if self._lock.acquire(blocking=False):
+                try:
+                    self._check_version()
+                except httpx.HTTPError as e:
+                    logging.getLogger(ct.LOGGER_NAME).warning(f"検索サーバーのバージョンを確認できませんでした: {e}")
+                    self._checked_at = time.monotonic()
+                finally:
+                    self._lock.release()
+        return self._snapshot
+
+    def _check_version(self):
+        """
+        検索サーバーのインデックスのバージョンを確認し、変わっていれば表形式データを読み直してスナップショットを差し替える
+        """
+        response = self._client.get("/version")
+        response.raise_for_status()
+        version = response.json()["version"]
+        self._checked_at = time.monotonic()
+        if self._snapshot is not None and self._snapshot.version == version:
+            return
+
+        table_store = TableStore.load(indexing.collect_source_files(ct.RAG_TOP_FOLDER_PATH))
+        previous = self._snapshot.version if self._snapshot is not None else None
+        self._snapshot = RemoteIndexSnapshot(version, self._retriever.copy(update={"version": version}), table_store)
+        logging.getLogger(ct.LOGGER_NAME).info(
+            f"検索サーバーのインデックスを使います（バージョン: {previous} → {version}）: {self.url}"
+        )
@@ -0,0 +1,274 @@
+"""
+このファイルは、インデックスを1か所で保持し、同じホスト上の複数の Streamlit プロセスからの検索を受け付ける検索サーバーが記述されたファイルです。
+- インデックス（ベクターストア・語彙検索用インデックス）・埋め込みキャッシュ・./data 配下の監視は、このプロセスのみが持つ
+  （Streamlit 側は RETRIEVAL_SERVER_URL を設定すると、retrieval_client の RemoteIndexManager 経由で検索する）
+- 複数のクエリをまとめた検索（POST /search）を受け付け、同時に届いたクエリの埋め込みは短い待ち時間でまとめて1回のリクエストにする
+- TCP（--host / --port）または Unix ドメインソケット（--uds）で待ち受ける
+- リポジトリのルートで「python -m retrieval_server」として実行します。
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import time
+import queue
+import logging
+import argparse
+import threading
+from logging.handlers import TimedRotatingFileHandler
+from concurrent.futures import Future
+from typing import List, Optional
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel
+from langchain_openai import OpenAIEmbeddings
+import constants as ct
+from embedding_cache import CachedEmbeddings
+from request_scheduler import ScheduledEmbeddings, get_scheduler
+from index_manager import IndexManager
+
+############################################################
+# 設定関連
+############################################################
+# 「.env」ファイルで定義した環境変数（OpenAI API キーなど）の読み込み
+load_dotenv()
+
+
+############################################################
+# クラス定義
+############################################################
+
+class SearchRequest(BaseModel):
+    """
+    検索リクエスト（複数のクエリをまとめて検索できる）
+    """
+    queries: List[str]
+    k: Optional[int] = None
+    # クライアントが前提とするインデックスのバージョン（異なる場合は 409 を返し、別のバージョンの結果を返さない）
+    version: Optional[str] = None
+
+
+class QueryEmbeddingBatcher:
+    """
+    同時に届いた検索クエリの埋め込みを、まとめて1回のリクエストでベクトル化するクラス
+    - 最初のクエリが届いてから最大 wait_seconds だけ待ち、その間に届いたクエリ（最大 max_batch_size 件）をまとめる
+    - 同じバッチ内の同じクエリは1回だけベクトル化する
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        max_batch_size=ct.RETRIEVAL_SERVER_EMBED_BATCH_SIZE,
+        wait_seconds=ct.RETRIEVAL_SERVER_EMBED_BATCH_WAIT_MS / 1000,
+        workers=ct.RETRIEVAL_SERVER_EMBED_WORKERS
+    ):
+        """
+        Args:
+            embeddings: 埋め込みモデル
+            max_batch_size: 1回のリクエストにまとめる最大クエリ数
+            wait_seconds: 最初のクエリが届いてから、まとめるために待つ最大秒数
+            workers: 同時に実行するリクエスト数（前のリクエストの応答待ちの間に、次のバッチを送れるようにする）
+        """
+        self.embeddings = embeddings
+        self.max_batch_size = max_batch_size
+        self.wait_seconds = wait_seconds
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self.query_count = 0
+        self.request_count = 0
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f"query-embedding-batcher-{i}", daemon=True).start()
+
+    def embed(self, texts):
+        """
+        クエリのベクトル化（他のスレッドから届いたクエリとまとめて実行されるまで待つ）
+
+        Args:
+            texts: 検索クエリのリスト
+
+        Returns:
+            埋め込みのリスト
+        """
+        futures = []
+        for text in texts:
+            future = Future()
+            self._queue.put((text, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def _run(self):
+        """
+        キューからクエリを取り出し、まとめてベクトル化する（ワーカースレッドで実行）
+        """
+        logger = logging.getLogger(ct.LOGGER_NAME)
+
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.wait_seconds
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                vectors = dict(zip(texts, self.embeddings.embed_documents(texts)))
+            except Exception as e:
+                logger.error(f"検索クエリのベクトル化に失敗しました（{len(texts)}件）: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            with self._stats_lock:
+                self.query_count += len(batch)
+                self.request_count += 1
+            for text, future in batch:
+                future.set_result(vectors[text])
+
+
+############################################################
+# 関数定義
+############################################################
+
+def create_app(index_manager, batcher):
+    """
+    検索サーバーの FastAPI アプリケーションの作成
+
+    Args:
+        index_manager: インデックスの管理オブジェクト
+        batcher: 検索クエリの埋め込みをまとめる QueryEmbeddingBatcher
+
+    Returns:
+        FastAPI アプリケーション
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    app = FastAPI(title="company_inner_search retrieval server")
+
+    @app.get("/version")
+    def version():
+        # クライアントは回答キャッシュのキーにこのバージョンを使う
+        return {"version": index_manager.current.version}
+
+    @app.get("/health")
+    def health():
+        snapshot = index_manager.current
+        return {
+            "version": snapshot.version,
+            "chunks": len(snapshot.lexical_index.documents) if snapshot.lexical_index is not None else None,
+            "last_refresh_seconds": index_manager.last_refresh_seconds,
+            "embedded_queries": batcher.query_count,
+            "embedding_requests": batcher.request_count,
+            "embedding_scheduler": get_scheduler("embedding").stats(),
+        }
+
+    # 同期関数のため、FastAPI のスレッドプールで並列に実行される（埋め込みの待ち合わせは QueryEmbeddingBatcher が行う）
+    @app.post("/search")
+    def search(request: SearchRequest):
+        start = time.perf_counter()
+        # リクエスト内の全クエリで同じバージョンのインデックスを使う
+        snapshot = index_manager.current
+        if request.version is not None and request.version != snapshot.version:
+            raise HTTPException(status_code=409, detail={"version": snapshot.version})
+        retriever = snapshot.retriever
+        if request.k is not None and request.k != retriever.k:
+            retriever = retriever.copy(update={"k": request.k})
+
+        query_embeddings = embed_queries(snapshot.retriever, batcher, request.queries)
+        embedded = time.perf_counter()
+        results = []
+        for query, query_embedding in zip(request.queries, query_embeddings):
+            docs, scores, lexical_match = retriever.search_with_scores(query, query_embedding=query_embedding)
+            results.append({
+                "documents": [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs],
+                "scores": [float(score) for score in scores],
+                "lexical_match": lexical_match,
+            })
+
+        logger.info(
+            f"検索しました（クエリ: {len(request.queries)}件, バージョン: {snapshot.version}, "
+            f"ベクトル化: {(embedded - start) * 1000:.1f}ms, 検索: {(time.perf_counter() - embedded) * 1000:.1f}ms）"
+        )
+        return {"version": snapshot.version, "results": results}
+
+    return app
+
+
+def embed_queries(retriever, batcher, queries):
+    """
+    検索クエリのベクトル化（スナップショットのクエリの埋め込みのキャッシュにないクエリのみ、まとめてベクトル化する）
+
+    Args:
+        retriever: スナップショットのRetriever（キャッシュを持たない場合はすべてベクトル化する）
+        batcher: QueryEmbeddingBatcher
+        queries: 検索クエリのリスト
+
+    Returns:
+        クエリごとの埋め込みのリスト
+    """
+    cache = getattr(retriever, "cache", None)
+    if cache is None:
+        return batcher.embed(queries)
+
+    query_embeddings = [cache.get_embedding(query) for query in queries]
+    missing = [i for i, embedding in enumerate(query_embeddings) if embedding is None]
+    if missing:
+        for i, embedding in zip(missing, batcher.embed([queries[i] for i in missing])):
+            cache.put_embedding(queries[i], embedding)
+            query_embeddings[i] = embedding
+    return query_embeddings
+
+
+def initialize_server_logger():
+    """
+    検索サーバーのログ出力の設定（Streamlit のセッションがないため、画面側とは別のファイルに出力）
+    """
+    os.makedirs(ct.LOG_DIR_PATH, exist_ok=True)
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    if logger.hasHandlers():
+        return
+    handler = TimedRotatingFileHandler(
+        os.path.join(ct.LOG_DIR_PATH, ct.RETRIEVAL_SERVER_LOG_FILE),
+        when="D",
+        encoding="utf8"
+    )
+    handler.setFormatter(logging.Formatter("[%(levelname)s] %(asctime)s line %(lineno)s, in %(funcName)s: %(message)s"))
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="インデックスを保持し、複数の Streamlit プロセスからの検索を受け付ける検索サーバー")
+    parser.add_argument("--host", default=ct.RETRIEVAL_SERVER_HOST, help="待ち受けるホスト")
+    parser.add_argument("--port", type=int, default=ct.RETRIEVAL_SERVER_PORT, help="待ち受けるポート")
+    parser.add_argument("--uds", help="Unix ドメインソケットのパス（指定した場合は --host / --port の代わりに使う）")
+    args = parser.parse_args()
+
+    initialize_server_logger()
+
+    # 埋め込みモデルの用意（インデックス作成時のチャンクはローカルのキャッシュから再利用）
+    embeddings = CachedEmbeddings(ScheduledEmbeddings(OpenAIEmbeddings(
+        model=ct.EMBEDDING_MODEL, timeout=ct.OPENAI_REQUEST_TIMEOUT_SECONDS, max_retries=0
+    )))
+    # 多数の検索を同時に処理するため、Chroma を複数スレッドから検索せず、常にバージョンごとの行列に書き出して検索する
+    index_manager = IndexManager.open(embeddings, isolate_snapshots=True)
+    if ct.INDEX_WATCH_ENABLED:
+        index_manager.start_watching()
+    # 検索クエリは埋め込みキャッシュ（SQLite）を通さず、スナップショットのメモリ上のキャッシュにないものだけをまとめて送る
+    batcher = QueryEmbeddingBatcher(embeddings.embeddings)
+
+    app = create_app(index_manager, batcher)
+    if args.uds:
+        uvicorn.run(app, uds=args.uds, log_level="warning")
+    else:
+        uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,492 @@
+"""
+このファイルは、ベクターストアの標準Retriever以外の検索方式（Retriever）が記述されたファイルです。
+- ハイブリッド検索：ベクトル検索と語彙検索（文字n-gram + BM25）の結果を Reciprocal Rank Fusion で統合
+- 参照元の多様化：多めに取得した候補から、ファイルごとの上限 + MMR で上位k件を選び、同じファイルのチャンクで上位が埋まるのを防ぐ
+- 関連度スコアと語彙検索の完全一致による「該当資料なし」の判定（社内文書検索でLLMを呼ばずに済ませるため）
+- クエリの埋め込みと検索結果のキャッシュ（retrieval_cache.py。インデックスのバージョンごと）
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+import constants as ct
+
+
+############################################################
+# 関数定義
+############################################################
+
+def document_key(doc):
+    """
+    検索結果のドキュメントを同一チャンクとして突き合わせるためのキー
+
+    Args:
+        doc: ドキュメント
+
+    Returns:
+        チャンクID（古い形式のインデックスの場合は参照元・ページ・本文の組）
+    """
+    chunk_id = doc.metadata.get("chunk_id")
+    if chunk_id:
+        return chunk_id
+    return (doc.metadata.get("source"), doc.metadata.get("page"), doc.page_content)
+
+
+def reciprocal_rank_fusion(ranked_lists, k=None, rrf_k=ct.RRF_K, weights=None):
+    """
+    複数の検索結果の順位を Reciprocal Rank Fusion で統合
+
+    Args:
+        ranked_lists: ドキュメントのリスト（各リストは関連度の降順）のリスト
+        k: 取得件数（None の場合は全件）
+        rrf_k: 下位の順位の影響を調整する定数
+        weights: リストごとの重み（None の場合はすべて1）
+
+    Returns:
+        統合後の (ドキュメント, 統合スコア) のリスト（統合スコアの降順）
+    """
+    scores = {}
+    documents = {}
+    if weights is None:
+        weights = [1.0] * len(ranked_lists)
+    for ranked, weight in zip(ranked_lists, weights):
+        for rank, doc in enumerate(ranked):
+            key = document_key(doc)
+            scores[key] = scores.get(key, 0.0) + weight / (rrf_k + rank + 1)
+            documents.setdefault(key, doc)
+
+    ranked_keys = sorted(scores, key=lambda key: scores[key], reverse=True)
+    return [(documents[key], scores[key]) for key in ranked_keys[:k]]
+
+
+def search_with_scores(retriever, query):
+    """
+    Retrieverの種類に関わらず、検索結果とベクトル検索の関連度スコアを1回の検索で取得
+
+    Args:
+        retriever: HybridRetriever またはベクターストアの標準Retriever（NumpyVectorStore の場合は HybridRetriever のみ）
+        query: 検索クエリ
+
+    Returns:
+        (ドキュメントのリスト, ベクトル検索の関連度スコアのリスト（降順）, 語彙検索で完全一致した語があるか)
+    """
+    if hasattr(retriever, "search_with_scores"):
+        return retriever.search_with_scores(query)
+
+    results = retriever.vectorstore.similarity_search_with_relevance_scores(query, **retriever.search_kwargs)
+    return [doc for doc, _ in results], [score for _, score in results], False
+
+
+def is_confident_match(scores, lexical_match=False, threshold=ct.DOC_SEARCH_SCORE_THRESHOLD, margin=ct.DOC_SEARCH_SCORE_MARGIN):
+    """
+    関連度スコアと語彙検索の結果から、検索結果に関連する文書があるかを判定
+
+    Args:
+        scores: ベクトル検索の関連度スコアのリスト（降順）
+        lexical_match: 社員IDや会社名のような語が、一部のチャンクにそのまま一致したか（一致した場合はスコアによらず関連ありとする）
+        threshold: 最上位のスコアに求める下限
+        margin: 最上位のスコアが、候補全体の平均をどれだけ上回る必要があるか（0の場合は判定しない）
+
+    Returns:
+        関連する文書があると判定した場合は True
+    """
+    if lexical_match:
+        return True
+    if not scores or scores[0] < threshold:
+        return False
+    # どの候補も同程度のスコアの場合は、特定の文書が関連しているのではなく質問が漠然としていると判断
+    return scores[0] - sum(scores) / len(scores) >= margin
+
+
+def diversity_key(doc, unit=ct.RETRIEVER_DIVERSITY_UNIT):
+    """
+    多様化の単位（ファイル単位 / ページ単位）のキー
+
+    Args:
+        doc: ドキュメント
+        unit: "source"（ファイル単位）または "page"（ページ単位）
+
+    Returns:
+        多様化の単位のキー
+    """
+    source = doc.metadata.get("source")
+    if unit == "page":
+        return (source, doc.metadata.get("page"))
+    return source
+
+
+def diversify(candidates, k, max_per_source=ct.RETRIEVER_MAX_CHUNKS_PER_SOURCE, lambda_mult=ct.RETRIEVER_MMR_LAMBDA):
+    """
+    候補から、ファイル（またはページ）ごとの件数上限と MMR（Maximal Marginal Relevance）で上位k件を選択
+    - 埋め込みは検索時に候補と一緒に取得したものを使い、ベクターストアへの再問い合わせは行わない
+    - 埋め込みがない候補（語彙検索のみでヒットしたチャンク）は、選択済みの候補との類似度を0として扱う
+
+    Args:
+        candidates: (ドキュメント, 関連度, 埋め込み or None) のリスト（関連度の降順）
+        k: 取得件数
+        max_per_source: 同じファイル（またはページ）から選ぶ最大件数
+        lambda_mult: 関連度と多様性の重み（1で関連度のみ、0で多様性のみ）
+
+    Returns:
+        選択したドキュメントのリスト
+    """
+    if not candidates or k <= 0:
+        return []
+
+    # 関連度は検索方式（RRF / ベクトル検索）によって尺度が異なるため、0〜1に揃える
+    relevance = np.array([score for _, score, _ in candidates], dtype=np.float32)
+    spread = float(relevance.max() - relevance.min())
+    relevance = (relevance - relevance.min()) / spread if spread > 0 else np.ones_like(relevance)
+
+    # 埋め込みを正規化した行列にまとめ、類似度は内積で計算（埋め込みがない候補はゼロベクトル）
+    dim = next((len(embedding) for _, _, embedding in candidates if embedding is not None), 0)
+    vectors = np.zeros((len(candidates), dim), dtype=np.float32)
+    for i, (_, _, embedding) in enumerate(candidates):
+        if embedding is not None:
+            vectors[i] = embedding
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+    keys = [diversity_key(doc) for doc, _, _ in candidates]
+    counts = {}
+    max_similarity = np.zeros(len(candidates), dtype=np.float32)
+    available = np.ones(len(candidates), dtype=bool)
+    selected = []
+    while len(selected) < k and available.any():
+        mmr = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        mmr[~available] = -np.inf
+        best = int(np.argmax(mmr))
+        available[best] = False
+
+        counts[keys[best]] = counts.get(keys[best], 0) + 1
+        selected.append(candidates[best][0])
+        # 上限に達したファイル（またはページ）の残りの候補は、以降の選択から外す
+        if counts[keys[best]] >= max_per_source:
+            available &= np.array([key != keys[best] for key in keys])
+        max_similarity = np.maximum(max_similarity, vectors @ vectors[best])
+
+    return selected
+
+
+############################################################
+# クラス定義
+############################################################
+
+class HybridRetriever(BaseRetriever):
+    """
+    ベクトル検索と語彙検索を組み合わせたRetriever
+    - 両方の検索で fetch_k 件ずつ取得し、Reciprocal Rank Fusion で統合する
+    - lexical_index が None の場合はベクトル検索のみ
+    - diversify が True の場合は、候補を多めに取得し、ファイルごとの上限 + MMR で上位 k 件を選ぶ
+      （False の場合は統合後の上位 k 件）
+    - cache がある場合は、クエリの埋め込みと検索結果（チャンクIDの順位）をキャッシュする
+    - entity_index がある場合は、質問に含まれる会社名などに対応するファイルに検索を限定、またはそのファイルを優先する
+    """
+
+    vector_store: Any
+    lexical_index: Optional[Any] = None
+    k: int = ct.RETRIEVER_TOP_K
+    fetch_k: int = ct.HYBRID_FETCH_K
+    diversify: bool = ct.RETRIEVER_DIVERSIFY
+    # クエリの埋め込みと検索結果のキャッシュ（RetrievalCache。None の場合はキャッシュしない）
+    cache: Optional[Any] = None
+    # 会社名・部署名・製品名の辞書（EntityIndex。None の場合は検索対象を絞り込まない）
+    entity_index: Optional[Any] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        docs, _, _ = self.search_with_scores(query)
+        return docs
+
+    def search_with_scores(self, query, query_embedding=None):
+        """
+        検索を実行し、ベクトル検索の関連度スコアと語彙検索の完全一致の有無も合わせて返す
+
+        Args:
+            query: 検索クエリ
+            query_embedding: 検索クエリの埋め込み（複数のクエリをまとめてベクトル化済みの場合。省略時はここでベクトル化する）
+
+        Returns:
+            (検索結果のドキュメントのリスト, ベクトル検索の関連度スコアのリスト（降順）, 語彙検索で完全一致した語があるか)
+        """
+        fetch_k = max(self.fetch_k, self.k * ct.RETRIEVER_DIVERSITY_FETCH_FACTOR) if self.diversify else self.fetch_k
+        route = self.entity_index.route(query) if self.entity_index is not None else None
+        if route is not None:
+            logging.getLogger(ct.LOGGER_NAME).info(f"質問に含まれる名前: {route.describe()}")
+        if self.cache is None:
+            return self._search(query, fetch_k, query_embedding, route)
+
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        # 語彙検索を併用する場合は、検索結果がクエリの文字列にも左右されるため、キーに含める
+        key = self.cache.result_key(
+            query_embedding,
+            query if self.lexical_index is not None else None,
+            (self.k, fetch_k, self.diversify, route.key if route is not None else ())
+        )
+        cached = self.cache.get_results(key, self._indexed_documents)
+        if cached is None:
+            docs, vector_scores, lexical_match = self._search(query, fetch_k, query_embedding, route)
+            self.cache.put_results(key, [document_key(doc) for doc in docs], vector_scores, lexical_match)
+        else:
+            docs, vector_scores, lexical_match = cached
+        logging.getLogger(ct.LOGGER_NAME).info(
+            f"検索結果のキャッシュ: {'ヒット' if cached is not None else 'ミス'}（ヒット率: {self.cache.hit_rates()}）"
+        )
+        return docs, vector_scores, lexical_match
+
+    def _search(self, query, fetch_k, query_embedding=None, route=None):
+        """
+        キャッシュを使わない検索
+
+        Args:
+            query: 検索クエリ
+            fetch_k: 各検索方式から取得する候補数
+            query_embedding: 検索クエリの埋め込み（省略時はここでベクトル化する）
+            route: 質問に含まれる名前から決めた検索対象（EntityRoute。None の場合は全件が対象）
+
+        Returns:
+            (検索結果のドキュメントのリスト, ベクトル検索の関連度スコアのリスト（降順）, 語彙検索で完全一致した語があるか)
+        """
+        restrict_sources = route.restrict_sources if route is not None else None
+        boost_sources = route.boost_sources if route is not None else None
+        if query_embedding is None and boost_sources is not None:
+            query_embedding = self.embed_query(query)
+
+        vector_results = self.vector_search(query, fetch_k, query_embedding, restrict_sources)
+        vector_scores = [score for _, score, _ in vector_results]
+
+        ranked_lists = [[doc for doc, _, _ in vector_results]]
+        weights = [1.0]
+        embeddings = {document_key(doc): embedding for doc, _, embedding in vector_results}
+        lexical_match = False
+        if self.lexical_index is not None:
+            ranked_lists.append([doc for doc, _ in self.lexical_index.search(query, fetch_k, restrict_sources)])
+            weights.append(1.0)
+            lexical_match = self.lexical_index.exact_match(query)
+        if boost_sources is not None:
+            # 名前に対応するファイルに限定した検索結果を、もう1つの順位として統合に加える
+            boosted_results = self.vector_search(query, fetch_k, query_embedding, boost_sources)
+            ranked_lists.append([doc for doc, _, _ in boosted_results])
+            weights.append(ct.ENTITY_BOOST_WEIGHT)
+            for doc, _, embedding in boosted_results:
+                embeddings.setdefault(document_key(doc), embedding)
+
+        if len(ranked_lists) == 1:
+            candidates = vector_results
+        else:
+            fused = reciprocal_rank_fusion(ranked_lists, weights=weights)
+            candidates = [(doc, score, embeddings.get(document_key(doc))) for doc, score in fused]
+
+        if self.diversify:
+            docs = diversify(candidates, self.k)
+        else:
+            docs = [doc for doc, _, _ in candidates[:self.k]]
+        return docs, vector_scores, lexical_match
+
+    def embed_query(self, query):
+        """
+        検索クエリのベクトル化（search_with_scores に渡す埋め込みを事前に用意する場合）
+
+        Args:
+            query: 検索クエリ
+
+        Returns:
+            検索クエリの埋め込み
+        """
+        if self.cache is None:
+            return self.vector_store.embeddings.embed_query(query)
+
+        query_embedding = self.cache.get_embedding(query)
+        if query_embedding is None:
+            query_embedding = self.vector_store.embeddings.embed_query(query)
+            self.cache.put_embedding(query, query_embedding)
+        return query_embedding
+
+    def _indexed_documents(self):
+        """
+        インデックスの全チャンクの (チャンクID, ドキュメント)（キャッシュした検索結果をドキュメントに戻すために使用）
+        """
+        if self.lexical_index is not None:
+            return ((document_key(doc), doc) for doc in self.lexical_index.documents)
+        data = self.vector_store.get(include=["documents", "metadatas"])
+        docs = (
+            Document(page_content=text, metadata=metadata or {})
+            for text, metadata in zip(data["documents"], data["metadatas"])
+        )
+        return ((document_key(doc), doc) for doc in docs)
+
+    def vector_search(self, query, n, query_embedding=None, sources=None):
+        """
+        ベクトル検索を実行し、関連度スコアと（多様化する場合は）埋め込みも1回の問い合わせで取得
+
+        Args:
+            query: 検索クエリ
+            n: 取得件数
+            query_embedding: 検索クエリの埋め込み（省略時はここでベクトル化する）
+            sources: 検索対象とする参照元のファイルのパスの集合（省略時は全件）
+
+        Returns:
+            (ドキュメント, 関連度スコア, 埋め込み or None) のリスト（関連度の降順）
+        """
+        # NumpyVectorStore の場合は、検索結果の埋め込みも返す検索メソッドを持つ
+        if hasattr(self.vector_store, "query_with_scores"):
+            return self.vector_store.query_with_scores(
+                query, n, include_embeddings=self.diversify, query_embedding=query_embedding, sources=sources
+            )
+
+        # LangChain の Chroma は検索結果の埋め込みを返さないため、コレクションに直接問い合わせる
+        include = ["documents", "metadatas", "distances"]
+        if self.diversify:
+            include.append("embeddings")
+        where = None
+        if sources is not None:
+            if not sources:
+                return []
+            conditions = [{"source": source} for source in sorted(sources)]
+            where = conditions[0] if len(conditions) == 1 else {"$or": conditions}
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        results = self.vector_store._collection.query(
+            query_embeddings=[query_embedding], n_results=n, where=where, include=include
+        )
+        relevance_score_fn = self.vector_store._select_relevance_score_fn()
+
+        embeddings = results["embeddings"][0] if self.diversify else [None] * len(results["ids"][0])
+        return [
+            (Document(page_content=text, metadata=metadata or {}), relevance_score_fn(distance), embedding)
+            for text, metadata, distance, embedding in zip(
+                results["documents"][0], results["metadatas"][0], results["distances"][0], embeddings
+            )
+        ]
+
+
+class SpeculativeSearch:
+    """
+    質問の言い換え（LLM呼び出し）と並行して、入力文そのままで先に検索しておくクラス
+    - 言い換え後の質問の埋め込みが入力文の埋め込みと十分近ければ、先に検索した結果をそのまま使う
+    - 近くなければ、言い換え後の質問で検索し直し、先に検索した結果を小さい重みで Reciprocal Rank Fusion により統合する
+    - 再利用できた割合は、プロセス内の全セッションで集計してログに出力する
+    """
+
+    _executor = ThreadPoolExecutor(max_workers=ct.SPECULATIVE_RETRIEVAL_WORKERS, thread_name_prefix="speculative-search")
+    _stats_lock = threading.Lock()
+    resolved_count = 0
+    reused_count = 0
+
+    def __init__(
+        self,
+        retriever,
+        query,
+        similarity_threshold=ct.SPECULATIVE_RETRIEVAL_SIMILARITY_THRESHOLD,
+        merge_weight=ct.SPECULATIVE_RETRIEVAL_MERGE_WEIGHT
+    ):
+        """
+        別スレッドで入力文そのままの検索を開始する
+
+        Args:
+            retriever: 埋め込みを指定して検索できるRetriever（embed_query を持つ HybridRetriever）
+            query: 入力文
+            similarity_threshold: 先に検索した結果をそのまま使う、埋め込みのコサイン類似度の下限
+            merge_weight: 検索し直した結果と統合する際の、先に検索した結果の重み
+        """
+        self.retriever = retriever
+        self.query = query
+        self.similarity_threshold = similarity_threshold
+        self.merge_weight = merge_weight
+        self._future = self._executor.submit(self._search)
+
+    @staticmethod
+    def is_supported(retriever):
+        """
+        投機的な検索に対応したRetrieverかどうか（検索サーバーに問い合わせる場合などは、埋め込みを比較できないため対象外）
+
+        Args:
+            retriever: Retriever
+
+        Returns:
+            対応しているかどうか
+        """
+        return hasattr(retriever, "embed_query")
+
+    def cancel(self):
+        """
+        先に開始した検索の結果を使わない場合の取り消し（実行前であれば検索自体を行わない。実行中の場合は結果を捨てる）
+        """
+        self._future.cancel()
+
+    def _search(self):
+        """
+        入力文そのままでの検索（別スレッドで実行）
+
+        Returns:
+            (入力文の埋め込み, (ドキュメントのリスト, 関連度スコアのリスト, 語彙検索の完全一致の有無), 所要時間[秒])
+        """
+        start = time.perf_counter()
+        query_embedding = self.retriever.embed_query(self.query)
+        result = self.retriever.search_with_scores(self.query, query_embedding=query_embedding)
+        return query_embedding, result, time.perf_counter() - start
+
+    def resolve(self, query):
+        """
+        言い換え後の質問に対する検索結果の取得
+
+        Args:
+            query: 言い換え後の質問
+
+        Returns:
+            (ドキュメントのリスト, ベクトル検索の関連度スコアのリスト（降順）, 語彙検索で完全一致した語があるか)
+        """
+        logger = logging.getLogger(ct.LOGGER_NAME)
+
+        start = time.perf_counter()
+        try:
+            speculative_embedding, speculative_result, speculative_seconds = self._future.result()
+        except Exception as e:
+            logger.warning(f"投機的な検索に失敗したため、言い換え後の質問で検索します: {e}")
+            return self.retriever.search_with_scores(query)
+        wait_seconds = time.perf_counter() - start
+
+        if query == self.query:
+            similarity = 1.0
+            query_embedding = speculative_embedding
+        else:
+            query_embedding = self.retriever.embed_query(query)
+            a = np.asarray(speculative_embedding, dtype=np.float32)
+            b = np.asarray(query_embedding, dtype=np.float32)
+            similarity = float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b) or 1.0))
+
+        reused = similarity >= self.similarity_threshold
+        if reused:
+            docs, scores, lexical_match = speculative_result
+        else:
+            docs, scores, lexical_match = self.retriever.search_with_scores(query, query_embedding=query_embedding)
+            if self.merge_weight > 0:
+                # 関連度スコア・完全一致の有無（「該当資料なし」の判定に使う）は、言い換え後の質問のものを使う
+                fused = reciprocal_rank_fusion([docs, speculative_result[0]], k=len(docs), weights=[1.0, self.merge_weight])
+                docs = [doc for doc, _ in fused]
+
+        with SpeculativeSearch._stats_lock:
+            SpeculativeSearch.resolved_count += 1
+            SpeculativeSearch.reused_count += reused
+            reused_count, resolved_count = SpeculativeSearch.reused_count, SpeculativeSearch.resolved_count
+        logger.info(
+            f"投機的な検索: {'再利用' if reused else '再検索'}（類似度: {similarity:.3f}, "
+            f"先行検索: {speculative_seconds * 1000:.1f}ms, 言い換え後の待ち: {wait_seconds * 1000:.1f}ms, "
+            f"結果の確定まで: {(time.perf_counter() - start) * 1000:.1f}ms, "
+            f"再利用率: {reused_count}/{resolved_count} = {reused_count / resolved_count:.1%}）"
+        )
+        return docs, scores, lexical_match
@@ -0,0 +1,240 @@
+"""
+このファイルは、CSVなどの表形式データに対する集計・絞り込み処理が記述されたファイルです。
+- CSVを1行1ドキュメントとしてベクトル検索すると上位k件しか取得できず、「一覧化」「人数」などの質問に答えきれない
+- そこでCSVは型付きの列指向テーブル（pandas.DataFrame）として読み込み、質問に含まれる値・列名から
+  絞り込み条件・グループ化・件数集計を組み立て、該当行をコンパクトな文脈としてLLMに渡す
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import re
+import logging
+import unicodedata
+import numpy as np
+import pandas as pd
+from langchain_core.documents import Document
+import constants as ct
+
+
+############################################################
+# 関数定義
+############################################################
+
+def normalize(text):
+    """
+    質問文と表の値の表記ゆれ（全角・半角など）を吸収するための正規化
+
+    Args:
+        text: 対象の文字列
+
+    Returns:
+        正規化した文字列
+    """
+    return unicodedata.normalize("NFKC", str(text)).strip()
+
+
+############################################################
+# クラス定義
+############################################################
+
+class TableSource:
+    """
+    1つのCSVファイルを型付きの列指向テーブルとして保持し、値から該当行を引く索引を持つクラス
+    - 値の種類が少ない列（部署、役職、従業員区分など。行ごとにほぼ異なる値の列は除く）と、カンマ区切りの複数値の列（スキルセットなど）を索引化する
+    - 索引は「値 → 列ごとの該当行番号の配列」のため、数万行でも絞り込みは配列の和集合・積集合で済む
+    """
+
+    def __init__(self, path, df):
+        """
+        Args:
+            path: CSVファイルのパス
+            df: 読み込んだテーブル
+        """
+        self.path = path
+        self.df = df
+        self.multi_value_columns = []
+        self.category_columns = []
+        # 正規化した値 → {列名: 該当行番号の配列}
+        self.value_index = {}
+
+        for column in df.columns:
+            series = df[column]
+            if series.dtype != object:
+                continue
+            values = series.dropna().astype(str)
+            if values.empty:
+                continue
+
+            # 半数以上の値がカンマ区切りであれば、複数値の列として値ごとに分解
+            if values.str.contains(", ").mean() >= 0.5:
+                exploded = values.str.split(",").explode().map(normalize)
+                exploded = exploded[exploded != ""]
+                self.multi_value_columns.append(column)
+            elif values.nunique() <= min(ct.TABLE_CATEGORY_MAX_VALUES, len(values) * ct.TABLE_CATEGORY_MAX_RATIO):
+                exploded = values.map(normalize)
+                self.category_columns.append(column)
+            else:
+                continue
+
+            for value, rows in exploded.groupby(exploded).groups.items():
+                self.value_index.setdefault(value, {})[column] = np.unique(np.asarray(rows, dtype=np.int64))
+
+        # 長い値から順に照合し、「人事部」と「人事」のような包含関係では長い方を優先する
+        self.vocabulary = sorted(self.value_index, key=len, reverse=True)
+
+    @classmethod
+    def load(cls, path):
+        """
+        CSVファイルを読み込み、日付らしい列は日付型に変換する
+
+        Args:
+            path: CSVファイルのパス
+
+        Returns:
+            作成した TableSource
+        """
+        df = pd.read_csv(path, encoding="utf-8")
+        for column in df.columns:
+            if df[column].dtype == object and df[column].dropna().astype(str).str.fullmatch(r"\d{4}-\d{2}-\d{2}").all():
+                df[column] = pd.to_datetime(df[column], format="%Y-%m-%d", errors="coerce")
+        return cls(path, df)
+
+    def match_values(self, question):
+        """
+        質問文に含まれる表の値を抽出
+
+        Args:
+            question: 質問文
+
+        Returns:
+            一致した値のリスト
+        """
+        remaining = normalize(question)
+        matched = []
+        for value in self.vocabulary:
+            if len(value) < 2 or value not in remaining:
+                continue
+            matched.append(value)
+            # 一致した部分は、より短い値との重複一致を防ぐため取り除く
+            remaining = remaining.replace(value, "\0")
+        return matched
+
+    def query(self, question):
+        """
+        質問文から絞り込み・グループ化・件数集計を組み立てて実行
+
+        Args:
+            question: 質問文
+
+        Returns:
+            集計結果を文脈としたドキュメント（表形式データを対象とした質問でない場合は None）
+        """
+        normalized_question = normalize(question)
+        matched_values = self.match_values(question)
+        # 列名を含む質問か、「社員」などの語と表の値の両方を含む質問のみを対象とする
+        mentions_table = (
+            any(normalize(column) in normalized_question for column in self.df.columns)
+            or (matched_values and any(keyword in normalized_question for keyword in ct.TABLE_QUERY_KEYWORDS))
+        )
+        if not mentions_table:
+            return None
+
+        group_by = [
+            column for column in self.category_columns + self.multi_value_columns
+            if re.search(f"{re.escape(normalize(column))}(ごと|別|毎)", normalized_question)
+        ]
+        wants_count = re.search(ct.TABLE_QUERY_COUNT_PATTERN, normalized_question) is not None
+        wants_list = re.search(ct.TABLE_QUERY_LIST_PATTERN, normalized_question) is not None
+        if not (matched_values or group_by or wants_count or wants_list):
+            return None
+
+        # 同じ列の値同士はOR、異なる列の値同士はANDで絞り込む
+        buckets = {}
+        for value in matched_values:
+            columns = frozenset(self.value_index[value])
+            rows = np.unique(np.concatenate(list(self.value_index[value].values())))
+            buckets.setdefault(columns, []).append(rows)
+        row_mask = np.ones(len(self.df), dtype=bool)
+        for rows_list in buckets.values():
+            bucket_mask = np.zeros(len(self.df), dtype=bool)
+            bucket_mask[np.concatenate(rows_list)] = True
+            row_mask &= bucket_mask
+        matched_df = self.df[row_mask]
+
+        conditions = [f"{'/'.join(sorted(self.value_index[value]))}={value}" for value in matched_values]
+        lines = [
+            f"【{os.path.basename(self.path)} の集計結果】",
+            f"絞り込み条件: {', '.join(conditions) if conditions else 'なし（全件）'}",
+            f"該当件数: {len(matched_df)}件（全{len(self.df)}件中）",
+        ]
+
+        for column in group_by:
+            if column in self.multi_value_columns:
+                groups = matched_df[column].dropna().astype(str).str.split(",").explode().map(normalize)
+            else:
+                groups = matched_df[column]
+            counts = groups.value_counts()
+            lines.append(f"{column}ごとの件数: " + ", ".join(f"{key}={count}件" for key, count in counts.items()))
+
+        # 件数やグループ化の質問は集計結果のみで答えられるため、行データを省略して文脈を小さく保つ
+        if not (wants_count or group_by):
+            shown_df = matched_df.head(ct.TABLE_QUERY_MAX_ROWS)
+            lines.append(f"該当データ（{len(shown_df)}件を表示）:")
+            lines.append(shown_df.to_csv(index=False, date_format="%Y-%m-%d").strip())
+
+        return Document(page_content="\n".join(lines), metadata={"source": self.path})
+
+
+class TableStore:
+    """
+    データソース内の全CSVファイルの TableSource をまとめて保持するクラス
+    """
+
+    def __init__(self, tables):
+        """
+        Args:
+            tables: TableSource のリスト
+        """
+        self.tables = tables
+
+    @classmethod
+    def load(cls, paths):
+        """
+        CSVファイルをまとめて読み込む（読み込みに失敗したファイルはログに記録してスキップ）
+
+        Args:
+            paths: ファイルパスのリスト（CSV以外は無視）
+
+        Returns:
+            作成した TableStore
+        """
+        logger = logging.getLogger(ct.LOGGER_NAME)
+
+        tables = []
+        for path in paths:
+            if os.path.splitext(path)[1] != ".csv":
+                continue
+            try:
+                tables.append(TableSource.load(path))
+            except Exception as e:
+                logger.error(f"表形式データの読み込みに失敗しました: {path}\n{e}")
+        return cls(tables)
+
+    def query(self, question):
+        """
+        質問文に最も多くの値が一致したテーブルで集計を実行
+
+        Args:
+            question: 質問文
+
+        Returns:
+            集計結果を文脈としたドキュメント（表形式データを対象とした質問でない場合は None）
+        """
+        ranked = sorted(self.tables, key=lambda table: len(table.match_values(question)), reverse=True)
+        for table in ranked:
+            result = table.query(question)
+            if result is not None:
+                return result
+        return None
@@ -0,0 +1,9 @@
+"""
+テストの共通設定
+- アプリのモジュールはリポジトリの直下にあるため、テストからそのまま読み込めるようパスに加える
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,102 @@
+"""
+AnswerCache のテスト（有効期限・件数上限・SQLiteファイルからの削除）
+"""
+
+import sqlite3
+import pytest
+from langchain_core.documents import Document
+import answer_cache
+from answer_cache import AnswerCache, build_cache_key
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(answer_cache.time, "time", clock.time)
+    return clock
+
+
+def count_rows(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+
+def test_key_ignores_notation_differences():
+    settings = {"model": "m", "temperature": 0.5}
+    assert build_cache_key("社内問い合わせ", "ＥＣサイトの担当者は？", settings, "v1") == \
+        build_cache_key("社内問い合わせ", "ecサイトの担当者は", settings, "v1")
+    assert build_cache_key("社内問い合わせ", "担当者は？", settings, "v1") != \
+        build_cache_key("社内問い合わせ", "担当者は？", settings, "v2")
+
+
+def test_answer_expires_after_ttl(clock):
+    cache = AnswerCache(ttl_seconds=60, persist_path=None)
+    cache.put("key", "回答", [Document(page_content="本文", metadata={"source": "a.pdf"})])
+
+    clock.now += 59
+    cached = cache.get("key")
+    assert cached["answer"] == "回答"
+    assert cached["context"][0].metadata == {"source": "a.pdf"}
+
+    clock.now += 2
+    assert cache.get("key") is None
+
+
+def test_least_recently_used_answer_is_evicted(clock):
+    cache = AnswerCache(max_entries=2, persist_path=None)
+    cache.put("a", "A", [])
+    cache.put("b", "B", [])
+    cache.get("a")
+    cache.put("c", "C", [])
+
+    assert cache.get("b") is None
+    assert cache.get("a")["answer"] == "A"
+    assert cache.get("c")["answer"] == "C"
+
+
+def test_persisted_answer_survives_restart(clock, tmp_path):
+    path = str(tmp_path / "answers.sqlite3")
+    AnswerCache(ttl_seconds=60, persist_path=path).put("key", "回答", [])
+
+    assert AnswerCache(ttl_seconds=60, persist_path=path).get("key")["answer"] == "回答"
+
+
+def test_expired_rows_are_deleted_on_open_and_on_get(clock, tmp_path):
+    path = str(tmp_path / "answers.sqlite3")
+    cache = AnswerCache(ttl_seconds=60, persist_path=path)
+    cache.put("old", "古い回答", [])
+    clock.now += 30
+    cache.put("new", "新しい回答", [])
+
+    # 起動時に、有効期限切れの行を削除
+    clock.now += 45
+    reopened = AnswerCache(ttl_seconds=60, persist_path=path)
+    assert count_rows(path) == 1
+
+    # 取得時に有効期限切れと分かった行も、その場で削除
+    clock.now += 30
+    assert reopened.get("new") is None
+    assert count_rows(path) == 0
+
+
+def test_expired_rows_are_purged_periodically_on_put(clock, tmp_path):
+    path = str(tmp_path / "answers.sqlite3")
+    cache = AnswerCache(ttl_seconds=60, persist_path=path, purge_interval_seconds=600)
+    cache.put("old", "古い回答", [])
+
+    # 削除の間隔が経つまでは、保存のたびには削除しない
+    clock.now += 120
+    cache.put("a", "A", [])
+    assert count_rows(path) == 2
+
+    clock.now += 600
+    cache.put("b", "B", [])
+    assert count_rows(path) == 1
@@ -0,0 +1,81 @@
+"""
+ChatHistory のテスト
+- トークナイザーを取得できない環境でも同じ結果になるよう、文字数をトークン数として数える
+"""
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+import token_counter
+from chat_history import ChatHistory, TRUNCATED_MARK
+
+
+@pytest.fixture(autouse=True)
+def count_chars(monkeypatch):
+    monkeypatch.setattr(token_counter, "get_encoding", lambda model=None: None)
+
+
+class FakeSummarizer:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = []
+
+    def invoke(self, inputs):
+        self.calls.append(inputs)
+        if self.fail:
+            raise RuntimeError("summary failed")
+        return f"要約{len(self.calls)}"
+
+
+def wait_for_fold(history):
+    if history._folding is not None:
+        history._folding.result()
+
+
+def test_newest_turns_are_packed_within_budget():
+    history = ChatHistory(max_turns=10)
+    for i in range(5):
+        history.add_turn(f"質問{i}", "回答" * 10)
+
+    # 1ターン = 質問3文字 + 回答20文字 + 区切り4×2 = 31トークン
+    messages, tokens = history.to_messages(token_budget=70)
+
+    assert tokens <= 70
+    assert [m.content for m in messages if isinstance(m, HumanMessage)] == ["質問3", "質問4"]
+
+
+def test_newest_turn_over_budget_is_truncated_not_dropped():
+    history = ChatHistory()
+    history.add_turn("長い回答の元の質問", "表" * 1000)
+
+    messages, tokens = history.to_messages(token_budget=100)
+
+    assert 0 < tokens <= 100
+    assert isinstance(messages[0], HumanMessage) and messages[0].content == "長い回答の元の質問"
+    assert isinstance(messages[1], AIMessage) and messages[1].content.endswith(TRUNCATED_MARK)
+
+
+def test_folded_turns_are_dropped_and_summary_is_sent():
+    history = ChatHistory(max_turns=2, fold_max_turns=4)
+    summarizer = FakeSummarizer()
+    for i in range(4):
+        history.add_turn(f"質問{i}", f"回答{i}", summarizer=summarizer)
+        wait_for_fold(history)
+
+    assert history.summary == "要約2"
+    assert history.turns == [("質問2", "回答2"), ("質問3", "回答3")]
+    messages, _ = history.to_messages(token_budget=1000)
+    assert isinstance(messages[0], SystemMessage) and "要約2" in messages[0].content
+    assert len(messages) == 5
+
+
+def test_failed_summary_keeps_turns():
+    history = ChatHistory(max_turns=1, fold_max_turns=4)
+    summarizer = FakeSummarizer(fail=True)
+    for i in range(3):
+        history.add_turn(f"質問{i}", f"回答{i}", summarizer=summarizer)
+        wait_for_fold(history)
+
+    assert history.summary == ""
+    assert len(history.turns) == 3
+    messages, _ = history.to_messages(token_budget=1000)
+    assert [m.content for m in messages if isinstance(m, HumanMessage)] == ["質問0", "質問1", "質問2"]
@@ -0,0 +1,116 @@
+"""
+deadlines.py の期限付き実行と、期限切れの場合の縮退（utils.retrieve）のテスト
+"""
+
+import threading
+import pytest
+from langchain_core.documents import Document
+import utils
+from deadlines import RequestDeadline, StageTimeout, latency_tracker
+
+
+@pytest.fixture
+def release():
+    # 期限切れで見切った呼び出しが、共有のスレッドを占有し続けないよう最後に解放する
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+def test_run_returns_result_within_deadline():
+    deadline = RequestDeadline(10, {"rewrite": 1.0})
+
+    assert deadline.run("rewrite", lambda: "結果", track_as="test-fast") == "結果"
+    assert len(latency_tracker._samples["test-fast"]) >= 1
+
+
+def test_run_raises_stage_timeout_and_records_it(release):
+    deadline = RequestDeadline(10, {"rewrite": 0.05})
+
+    with pytest.raises(StageTimeout) as e:
+        deadline.run("rewrite", lambda: release.wait(5), track_as="test-slow")
+
+    assert e.value.stage == "rewrite"
+    assert e.value.timeout == pytest.approx(0.05)
+    # 期限切れの呼び出しも、期限の秒数以上かかったものとして記録する
+    assert latency_tracker._samples["test-slow"][-1] >= 0.05
+
+
+def test_run_is_bounded_by_total_deadline(release):
+    deadline = RequestDeadline(0.05, {"rewrite": 10.0})
+
+    with pytest.raises(StageTimeout) as e:
+        deadline.run("rewrite", lambda: release.wait(5), track_as="test-total")
+    assert e.value.timeout <= 0.05
+
+    # 全体の期限を過ぎた後の段階は、実行せずに期限切れとする
+    with pytest.raises(StageTimeout):
+        deadline.run("rewrite", lambda: "結果", track_as="test-total")
+
+
+def test_run_propagates_errors():
+    deadline = RequestDeadline(10, {"rewrite": 1.0})
+
+    def fail():
+        raise ValueError("失敗")
+
+    with pytest.raises(ValueError):
+        deadline.run("rewrite", fail, track_as="test-error")
+
+
+def test_iterate_stops_and_closes_stream(release):
+    closed = threading.Event()
+
+    def stream():
+        try:
+            yield "途中"
+            release.wait(5)
+            yield "続き"
+        finally:
+            closed.set()
+
+    deadline = RequestDeadline(10, {"generate": 0.1})
+    chunks = []
+    with pytest.raises(StageTimeout):
+        for chunk in deadline.iterate("generate", stream()):
+            chunks.append(chunk)
+
+    assert chunks == ["途中"]
+    release.set()
+    assert closed.wait(5)
+
+
+class SlowRetriever:
+    """
+    ベクトル化が期限内に終わらない Retriever
+    """
+
+    k = 2
+
+    def __init__(self, release, lexical_index=None):
+        self.release = release
+        self.lexical_index = lexical_index
+
+    def embed_query(self, query):
+        self.release.wait(5)
+        return [0.0]
+
+
+class FakeLexicalIndex:
+    def search(self, query, k):
+        return [(Document(page_content=f"{query}の語彙検索の結果{i}"), 1.0) for i in range(k)]
+
+
+def test_retrieve_falls_back_to_lexical_search(release):
+    deadline = RequestDeadline(10, {"embed": 0.05, "retrieve": 1.0})
+
+    docs, scores, lexical_match = utils.retrieve(SlowRetriever(release, FakeLexicalIndex()), "有給休暇", deadline)
+
+    assert [doc.page_content for doc in docs] == ["有給休暇の語彙検索の結果0", "有給休暇の語彙検索の結果1"]
+    assert scores is None and not lexical_match
+
+
+def test_retrieve_without_lexical_index_returns_nothing(release):
+    deadline = RequestDeadline(10, {"embed": 0.05, "retrieve": 1.0})
+
+    assert utils.retrieve(SlowRetriever(release), "有給休暇", deadline) == ([], None, False)
@@ -0,0 +1,211 @@
+"""
+indexing.py の差分更新（マニフェストとの比較・チャンクの入れ替え）のテスト
+"""
+
+import os
+import random
+import pytest
+from langchain_core.documents import Document
+import indexing
+from indexing import IndexWriter, iter_changed_files, file_sha256
+
+
+class FakeVectorStore:
+    """
+    チャンクIDとドキュメントを辞書で保持するだけのベクターストア
+    """
+
+    class _Collection:
+        def __init__(self, store):
+            self.store = store
+
+        def update(self, ids, metadatas):
+            for chunk_id, metadata in zip(ids, metadatas):
+                self.store.docs[chunk_id].metadata = metadata
+
+    def __init__(self):
+        self.docs = {}
+        self._collection = self._Collection(self)
+
+    def add_documents(self, docs, ids):
+        self.docs.update(zip(ids, docs))
+
+    def delete(self, ids):
+        for chunk_id in ids:
+            self.docs.pop(chunk_id, None)
+
+    def get(self, ids):
+        found = [chunk_id for chunk_id in ids if chunk_id in self.docs]
+        return {"ids": found, "metadatas": [dict(self.docs[chunk_id].metadata) for chunk_id in found]}
+
+    def persist(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def no_side_effects(monkeypatch):
+    # マニフェストは書き出さず、チャンク分割は1ドキュメント=1チャンクにする
+    monkeypatch.setattr(indexing, "save_manifest", lambda manifest: None)
+    monkeypatch.setattr(
+        indexing, "split_documents",
+        lambda docs: [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in docs],
+    )
+
+
+def write(path, text):
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+
+def info_of(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": file_sha256(path)}
+
+
+def changed(paths, sources):
+    pending = {}
+    stats = {"skipped": 0}
+    return list(iter_changed_files(paths, sources, pending, stats)), pending, stats
+
+
+def test_new_and_modified_files_are_returned(tmp_path):
+    unchanged = write(tmp_path / "a.txt", "変更なし")
+    modified = write(tmp_path / "b.txt", "変更前")
+    added = write(tmp_path / "c.txt", "追加")
+    sources = {unchanged: info_of(unchanged), modified: info_of(modified)}
+    write(tmp_path / "b.txt", "変更後の内容")
+
+    paths, pending, stats = changed([unchanged, modified, added], sources)
+
+    assert paths == [modified, added]
+    assert set(pending) == {modified, added}
+    assert pending[modified]["sha256"] == file_sha256(modified)
+    assert stats["skipped"] == 1
+
+
+def test_touched_file_with_same_content_is_skipped(tmp_path):
+    path = write(tmp_path / "a.txt", "本文")
+    sources = {path: info_of(path)}
+    os.utime(path, (1_000_000, 1_000_000))
+
+    paths, pending, stats = changed([path], sources)
+
+    assert paths == [] and pending == {}
+    assert stats["skipped"] == 1
+    # 次回は中身を読まずにスキップできるよう、更新日時をマニフェストに反映
+    assert sources[path]["mtime"] == 1_000_000
+
+
+def test_source_is_recorded_only_after_flush():
+    db = FakeVectorStore()
+    writer = IndexWriter(db, {"sources": {}}, dedup=False)
+
+    writer.add_source("data/a.txt", {"size": 1, "mtime": 1, "sha256": "a" * 64}, [Document(page_content="本文", metadata={})])
+    assert writer.manifest["sources"] == {}
+
+    writer.flush()
+    entry = writer.manifest["sources"]["data/a.txt"]
+    assert entry["chunk_ids"] == list(db.docs)
+    assert db.docs[entry["chunk_ids"][0]].metadata["chunk_id"] == entry["chunk_ids"][0]
+
+
+def test_updated_source_replaces_its_chunks():
+    db = FakeVectorStore()
+    writer = IndexWriter(db, {"sources": {}}, dedup=False)
+    writer.add_source("data/a.txt", {"size": 1, "mtime": 1, "sha256": "a" * 64}, [Document(page_content="古い本文", metadata={})])
+    writer.add_source("data/b.txt", {"size": 1, "mtime": 1, "sha256": "b" * 64}, [Document(page_content="別の文書", metadata={})])
+    writer.flush()
+    other_ids = writer.manifest["sources"]["data/b.txt"]["chunk_ids"]
+
+    docs = [Document(page_content="新しい本文1", metadata={}), Document(page_content="新しい本文2", metadata={})]
+    writer.add_source("data/a.txt", {"size": 2, "mtime": 2, "sha256": "c" * 64}, docs)
+    writer.flush()
+
+    new_ids = writer.manifest["sources"]["data/a.txt"]["chunk_ids"]
+    assert sorted(db.docs) == sorted(new_ids + other_ids)
+    assert [db.docs[chunk_id].page_content for chunk_id in new_ids] == ["新しい本文1", "新しい本文2"]
+
+
+def test_removed_source_drops_its_chunks():
+    db = FakeVectorStore()
+    writer = IndexWriter(db, {"sources": {}}, dedup=False)
+    writer.add_source("data/a.txt", {"size": 1, "mtime": 1, "sha256": "a" * 64}, [Document(page_content="本文", metadata={})])
+    writer.flush()
+
+    writer.remove_source("data/a.txt")
+
+    assert db.docs == {}
+    assert writer.manifest["sources"] == {}
+
+
+def random_text(seed):
+    rng = random.Random(seed)
+    words = ["".join(rng.choice("あいうえおかきくけこさしすせそたちつてと") for _ in range(6)) for _ in range(500)]
+    return "".join(rng.choice(words) for _ in range(200))
+
+
+def test_near_duplicate_is_registered_only_once():
+    db = FakeVectorStore()
+    writer = IndexWriter(db, {"sources": {}})
+    text = random_text(0)
+    writer.add_source("data/a.txt", {"size": 1, "mtime": 1, "sha256": "a" * 64}, [Document(page_content=text, metadata={})])
+    writer.add_source("data/b.txt", {"size": 1, "mtime": 1, "sha256": "b" * 64}, [Document(page_content=random_text(1), metadata={})])
+    writer.flush()
+
+    # 同じ文書のPDF版は、拡張子の優先順位によりテキスト版に代わって正本になる
+    writer.add_source("data/a.pdf", {"size": 1, "mtime": 1, "sha256": "c" * 64}, [Document(page_content=text + "追記", metadata={})])
+    writer.flush()
+
+    sources = writer.manifest["sources"]
+    assert sources["data/a.txt"]["duplicate_of"] == "data/a.pdf"
+    assert sources["data/a.txt"]["chunk_ids"] == []
+    assert sources["data/a.pdf"]["alternates"] == ["data/a.txt"]
+    assert sources["data/b.txt"]["duplicate_of"] is None
+    assert sorted(db.docs) == sorted(sources["data/a.pdf"]["chunk_ids"] + sources["data/b.txt"]["chunk_ids"])
+    assert all(db.docs[i].metadata["alternate_sources"] == "data/a.txt" for i in sources["data/a.pdf"]["chunk_ids"])
+
+    # 後から追加された優先度の低い重複は、正本の別パスとして記録するのみ
+    writer.add_source("data/a.docx", {"size": 1, "mtime": 1, "sha256": "d" * 64}, [Document(page_content=text, metadata={})])
+    writer.flush()
+    assert sources["data/a.docx"]["duplicate_of"] == "data/a.pdf"
+    assert sources["data/a.pdf"]["alternates"] == ["data/a.txt", "data/a.docx"]
+    assert all(
+        db.docs[i].metadata["alternate_sources"] == "data/a.txt\ndata/a.docx" for i in sources["data/a.pdf"]["chunk_ids"]
+    )
+
+
+def test_duplicates_are_found_after_reload():
+    db = FakeVectorStore()
+    writer = IndexWriter(db, {"sources": {}})
+    text = random_text(0)
+    writer.add_source("data/a.pdf", {"size": 1, "mtime": 1, "sha256": "a" * 64}, [Document(page_content=text, metadata={})])
+    writer.flush()
+
+    # マニフェストから作り直した LSH 索引でも検出できる
+    reloaded = IndexWriter(db, writer.manifest)
+    reloaded.add_source("data/a.txt", {"size": 1, "mtime": 1, "sha256": "b" * 64}, [Document(page_content=text, metadata={})])
+    reloaded.flush()
+
+    assert reloaded.manifest["sources"]["data/a.txt"]["duplicate_of"] == "data/a.pdf"
+
+
+def test_removing_canonical_registers_its_duplicate(tmp_path, monkeypatch):
+    text = random_text(0)
+    duplicate = write(tmp_path / "a.txt", text)
+    monkeypatch.setattr(
+        indexing, "load_files",
+        lambda paths, max_workers=None, digest_of=None: iter([(paths[0], [Document(page_content=text, metadata={})])]),
+    )
+    db = FakeVectorStore()
+    writer = IndexWriter(db, {"sources": {}})
+    writer.add_source("data/a.pdf", {"size": 1, "mtime": 1, "sha256": "a" * 64}, [Document(page_content=text, metadata={})])
+    writer.add_source(duplicate, info_of(duplicate), [Document(page_content=text, metadata={})])
+    writer.flush()
+    assert writer.manifest["sources"][duplicate]["duplicate_of"] == "data/a.pdf"
+
+    writer.remove_source("data/a.pdf")
+    writer.flush()
+
+    entry = writer.manifest["sources"][duplicate]
+    assert entry["duplicate_of"] is None
+    assert entry["chunk_ids"] and sorted(db.docs) == sorted(entry["chunk_ids"])
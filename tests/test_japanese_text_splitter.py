@@ -0,0 +1,65 @@
+"""
+JapaneseTextSplitter のテスト
+- トークナイザーを取得できない環境でも同じ結果になるよう、文字数をトークン数として数える
+"""
+
+import random
+import pytest
+import japanese_text_splitter
+from japanese_text_splitter import JapaneseTextSplitter
+
+
+@pytest.fixture(autouse=True)
+def count_chars(monkeypatch):
+    monkeypatch.setattr(japanese_text_splitter, "_count_tokens", len)
+
+
+def make_text(rng):
+    """
+    見出し・箇条書き・話者名・長い文・空行が混ざった文書
+    """
+    lines = []
+    for section in range(rng.randint(3, 8)):
+        lines.append(f"【第{section + 1}項】")
+        for _ in range(rng.randint(1, 6)):
+            kind = rng.random()
+            length = rng.choice([5, 20, 40, 90, 180])
+            body = "".join(rng.choice("社員規程承認申請手続きのためにはを") for _ in range(length))
+            if kind < 0.3:
+                lines.append(f"・{body}")
+            elif kind < 0.5:
+                lines.append(f"佐藤: {body}。")
+            else:
+                # PDFの折り返しのように、文の途中で改行する
+                sentence = f"{body}。"
+                lines.extend(sentence[i:i + 30] for i in range(0, len(sentence), 30))
+        lines.append("")
+    return "\n".join(lines)
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_chunks_never_exceed_chunk_size(seed):
+    splitter = JapaneseTextSplitter(chunk_size=100, chunk_overlap=20, min_fill_ratio=0.5)
+    chunks = splitter.split_text(make_text(random.Random(seed)))
+
+    assert chunks
+    assert max(len(chunk) for chunk in chunks) <= 100
+
+
+def test_sentences_are_kept():
+    text = make_text(random.Random(0))
+    splitter = JapaneseTextSplitter(chunk_size=100, chunk_overlap=20, min_fill_ratio=0.5)
+    joined = "".join(splitter.split_text(text))
+
+    # 上限より短い文は、いずれかのチャンクにそのまま含まれる
+    for line in text.split("\n"):
+        if line and len(line) <= 30:
+            assert line in joined
+
+
+def test_overlong_sentence_is_cut_within_the_limit():
+    splitter = JapaneseTextSplitter(chunk_size=50, chunk_overlap=10, min_fill_ratio=0.5)
+    chunks = splitter.split_text("前置き。\n" + "あ" * 260 + "。")
+
+    assert max(len(chunk) for chunk in chunks) <= 50
+    assert "".join(chunks).count("あ") == 260
@@ -0,0 +1,55 @@
+"""
+lexical_index.py の語彙検索と、社員ID・会社名の完全一致の判定のテスト
+"""
+
+from langchain_core.documents import Document
+from lexical_index import LexicalIndex
+
+
+def build_index():
+    # 40チャンクのうち、社員IDと会社名はそれぞれ1チャンクにのみ現れ、「サービス」は全チャンクに現れる
+    docs = [
+        Document(page_content=f"第{i}回の定例会議で、サービスの改善方針を確認した。", metadata={"source": f"data/minutes{i}.txt"})
+        for i in range(38)
+    ]
+    docs.append(Document(page_content="社員ID：EMP0012 の所属は人事部です。", metadata={"source": "data/employees.csv"}))
+    docs.append(Document(page_content="取引先のコスモテックとサービス契約を締結した。", metadata={"source": "data/contract.txt"}))
+    return LexicalIndex.build(docs)
+
+
+def test_exact_match_on_rare_id_or_name():
+    index = build_index()
+
+    assert index.exact_match("EMP0012の所属部署は？")
+    # 全角・小文字で入力されても一致する
+    assert index.exact_match("ｅｍｐ００１２について")
+    assert index.exact_match("コスモテックとの契約内容")
+
+
+def test_no_exact_match_on_absent_or_common_term():
+    index = build_index()
+
+    assert not index.exact_match("EMP9999の所属部署は？")
+    # ID・会社名の形をしていない語は対象外
+    assert not index.exact_match("人事部の社員")
+    # ほぼすべてのチャンクに現れる語は、特定の文書を指しているとはみなさない
+    assert not index.exact_match("サービスの改善")
+    assert index.exact_match("サービスの改善", max_doc_ratio=1.0)
+
+
+def test_search_ranks_matching_chunk_first():
+    index = build_index()
+
+    results = index.search("EMP0012", k=3)
+
+    assert results[0][0].metadata["source"] == "data/employees.csv"
+    assert index.search("EMP0012", k=0) == []
+
+
+def test_search_limited_to_sources():
+    index = build_index()
+
+    results = index.search("サービス", k=5, sources={"data/contract.txt", "data/missing.txt"})
+
+    assert [doc.metadata["source"] for doc, _ in results] == ["data/contract.txt"]
+    assert index.search("サービス", k=5, sources={"data/missing.txt"}) == []
@@ -0,0 +1,59 @@
+"""
+retrievers.py の検索結果の統合（Reciprocal Rank Fusion）と「該当資料なし」の判定のテスト
+"""
+
+import pytest
+from langchain_core.documents import Document
+from retrievers import reciprocal_rank_fusion, document_key, is_confident_match
+
+
+def doc(chunk_id):
+    return Document(page_content=f"本文{chunk_id}", metadata={"chunk_id": chunk_id, "source": f"{chunk_id}.pdf"})
+
+
+def ids(fused):
+    return [document_key(d) for d, _ in fused]
+
+
+def test_documents_ranked_in_both_lists_come_first():
+    fused = reciprocal_rank_fusion([[doc("a"), doc("b"), doc("c")], [doc("c"), doc("d"), doc("a")]], rrf_k=60)
+
+    assert ids(fused) == ["a", "c", "b", "d"]
+    assert fused[0][1] == pytest.approx(1 / 61 + 1 / 63)
+
+
+def test_weights_decide_which_list_wins():
+    vector = [doc("a"), doc("b")]
+    lexical = [doc("b"), doc("a")]
+
+    assert ids(reciprocal_rank_fusion([vector, lexical], weights=[2.0, 1.0])) == ["a", "b"]
+    assert ids(reciprocal_rank_fusion([vector, lexical], weights=[1.0, 2.0])) == ["b", "a"]
+
+
+def test_zero_weight_ignores_the_list():
+    fused = reciprocal_rank_fusion([[doc("a")], [doc("b")]], weights=[1.0, 0.0], rrf_k=60)
+
+    assert fused[0] == (doc("a"), pytest.approx(1 / 61))
+    assert fused[1][1] == 0.0
+
+
+def test_k_truncates_the_result():
+    fused = reciprocal_rank_fusion([[doc("a"), doc("b"), doc("c")]], k=2)
+
+    assert ids(fused) == ["a", "b"]
+
+
+def test_chunks_without_id_are_matched_by_content():
+    old = Document(page_content="本文", metadata={"source": "a.pdf", "page": 0})
+    same = Document(page_content="本文", metadata={"source": "a.pdf", "page": 0})
+
+    assert len(reciprocal_rank_fusion([[old], [same]])) == 1
+
+
+def test_confident_match():
+    assert is_confident_match([0.2], lexical_match=True, threshold=0.5)
+    assert not is_confident_match([], threshold=0.5)
+    assert not is_confident_match([0.4, 0.3], threshold=0.5, margin=0.0)
+    assert is_confident_match([0.9, 0.5, 0.4], threshold=0.5, margin=0.2)
+    # どの候補も同程度のスコアの場合は、質問が漠然としていると判断
+    assert not is_confident_match([0.8, 0.79, 0.78], threshold=0.5, margin=0.2)
@@ -0,0 +1,140 @@
+"""
+このファイルは、LLMに送るテキストのトークン数を数える処理が記述されたファイルです。
+- 会話履歴・文脈をトークン数の上限内に収めるため、および送信トークン数のログ出力に使用
+- チャンク分割では、埋め込みモデルのトークナイザーで数える
+- トークナイザーの定義ファイルは TIKTOKEN_CACHE_DIR に保存し、一度取得すればオフラインでも読み込めるようにする
+- トークナイザーを取得できない環境（オフラインなど）では、文字数をトークン数とみなす（日本語では多めの見積もりになる）
+  取得の失敗は一定時間だけ覚えておき、その後の呼び出しで取得し直す（取得できるようになれば、プロセスを再起動せずに使える）
+"""
+
+############################################################
+# ライブラリの読み込み
+############################################################
+import os
+import time
+import logging
+import threading
+import tiktoken
+import constants as ct
+
+
+############################################################
+# 設定関連
+############################################################
+# tiktoken は読み込み時ではなくトークナイザーの取得時にこの環境変数を参照するため、ここで設定すれば足りる
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", ct.TIKTOKEN_CACHE_DIR)
+# モデル名 → 取得したトークナイザー
+_encodings = {}
+# モデル名 → 最後に取得に失敗した時刻（time.monotonic()）
+_failed_at = {}
+# 複数スレッドから同時に取得（ダウンロード）しないためのロック
+_encodings_lock = threading.Lock()
+
+
+############################################################
+# 関数定義
+############################################################
+
+def get_encoding(model=ct.MODEL):
+    """
+    モデルのトークナイザーの取得（取得できたものはプロセス内で使い回し、失敗した場合は一定時間後に取得し直す）
+
+    Args:
+        model: モデル名
+
+    Returns:
+        トークナイザー（取得できない場合は None）
+    """
+    encoding = _encodings.get(model)
+    if encoding is not None:
+        return encoding
+
+    with _encodings_lock:
+        if model in _encodings:
+            return _encodings[model]
+        failed_at = _failed_at.get(model)
+        if failed_at is not None and time.monotonic() - failed_at < ct.TOKENIZER_RETRY_SECONDS:
+            return None
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except Exception as e:
+            logger = logging.getLogger(ct.LOGGER_NAME)
+            logger.warning(
+                f"トークナイザーを取得できないため、文字数をトークン数とみなします"
+                f"（{ct.TOKENIZER_RETRY_SECONDS}秒後以降に取得し直します）: {e}"
+            )
+            _failed_at[model] = time.monotonic()
+            return None
+        _encodings[model] = encoding
+        _failed_at.pop(model, None)
+        return encoding
+
+
+def get_encoding_name(model=ct.MODEL):
+    """
+    モデルが使うトークナイザーの名前（定義ファイルを取得できるかどうかによらず、モデル名から決まる）
+
+    Args:
+        model: モデル名
+
+    Returns:
+        トークナイザーの名前（モデル名から決まらない場合は "chars"）
+    """
+    try:
+        return tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        return "chars"
+
+
+def count_tokens(text, model=ct.MODEL):
+    """
+    テキストのトークン数
+
+    Args:
+        text: 対象のテキスト
+        model: トークナイザーを使うモデル名
+
+    Returns:
+        トークン数
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text, max_tokens, model=ct.MODEL):
+    """
+    テキストの先頭から、トークン数の上限に収まる部分を切り出す
+
+    Args:
+        text: 対象のテキスト
+        max_tokens: トークン数の上限
+        model: トークナイザーを使うモデル名
+
+    Returns:
+        切り出したテキスト（上限に収まる場合はそのまま）
+    """
+    if max_tokens <= 0:
+        return ""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return text[:max_tokens]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    # 文字の途中で切れた場合の置換文字は除く
+    return encoding.decode(tokens[:max_tokens]).rstrip("\ufffd")
+
+
+def count_message_tokens(messages):
+    """
+    メッセージのリストのトークン数（メッセージごとの区切りの分を含む）
+
+    Args:
+        messages: メッセージのリスト
+
+    Returns:
+        トークン数
+    """
+    return sum(count_tokens(message.content) + 4 for message in messages)
@@ -1,21 +1,26 @@
 """
 このファイルは、画面表示以外の様々な関数定義のファイルです。
 - アイコン種別の判定、エラーメッセージ整形
-- RAG（履歴考慮リトリーバ）× 会話チェーンの組み立てと実行
+- RAG（履歴考慮リトリーバ）× 会話チェーンの実行
+- 回答キャッシュの確認
 """
 
 ############################################################
 # ライブラリの読み込み
 ############################################################
 import os
+import time
+import logging
 from dotenv import load_dotenv
 import streamlit as st
-from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.schema import HumanMessage  # ※ 会話履歴への追加で使用
-from langchain_openai import ChatOpenAI
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
 import constants as ct
+from answer_cache import build_cache_key
+from retrievers import search_with_scores, is_confident_match, SpeculativeSearch
+from retrieval_client import IndexVersionChanged
+from token_counter import count_tokens
+from context_packing import pack_context
+from request_scheduler import describe_schedulers
+from deadlines import RequestDeadline, StageTimeout
 
 
 ############################################################
@@ -59,73 +64,302 @@ def build_error_message(message: str) -> str:
     return "\n".join([message, ct.COMMON_ERROR_MESSAGE])
 
 
-def get_llm_response(chat_message: str):
+def get_llm_response(chat_message: str, stream: bool = False):
     """
     LLM から回答を取得して返す（RAG + 会話履歴考慮）
 
     フロー概要：
-      1) ChatOpenAI を準備（モデル・温度は constants.py で一元管理）
-      2) 履歴を踏まえた「質問の言い換え」用プロンプトを作成
-      3) モードに応じた本問合せプロンプト（文書検索 or 社内問い合わせ）を用意
-      4) 履歴考慮リトリーバ + スタッフィングチェーンで RAG チェーンを構築
-      5) チェーンに input（= ユーザー入力）と chat_history を渡して実行
-      6) レスポンスを chat_history に追加（次ターンでの文脈維持用）
+      1) 共有のチェーン（「質問の言い換え」用 / モード別の本問合せ用）を取得し、
+         モードごとのトークン数の上限に収まる会話履歴（直近のターン + 古いターンの要約）を用意
+      2) 会話履歴がある場合のみ、「独立した質問」を生成
+      3) 回答キャッシュを確認し、なければ検索（または表形式データの集計）→ 文脈を組み立てて stuff し、回答生成
+         ※ 社内文書検索は、LLMを使わず検索の関連度スコアで「該当資料なし」を判定
+      4) レスポンスを chat_history に追加（次ターンでの文脈維持用）
+
+    各段階（質問の言い換え・クエリのベクトル化・検索・回答の生成）は、段階ごとの期限とモードごとの全体の期限付きで実行し、
+    期限切れの場合は縮退した結果を返す（縮退した回答は回答キャッシュに保存しない）。
+
+    ストリーミング時（社内問い合わせのみ）は、検索が終わった時点で返し、回答本文は
+    answer_stream（トークンを順次返すジェネレーター）から受け取る。読み切った時点で answer が設定され、
+    回答キャッシュへの保存と chat_history への追加も行われる。
 
     Args:
         chat_message: ユーザーの入力文字列
+        stream: 回答本文をストリーミングで受け取るかどうか
 
     Returns:
-        LangChain のチェーンが返す辞書（answer, context などを含む）
-    """
-    # 1) LLM本体の用意（モデル名・温度は constants 側で集中管理）
-    llm = ChatOpenAI(model_name=ct.MODEL, temperature=ct.TEMPERATURE)
-
-    # 2) 履歴を踏まえた「独立した質問」生成プロンプト
-    #    - 会話履歴が長くなっても、検索に最適化されたクエリを毎回生成できる
-    question_generator_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", ct.SYSTEM_PROMPT_CREATE_INDEPENDENT_TEXT),
-            MessagesPlaceholder("chat_history"),
-            ("human", "{input}")
-        ]
+        LangChain のチェーンが返す辞書（answer, context などを含む。ストリーミング時は answer の代わりに answer_stream）
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+    start = time.perf_counter()
+    deadline = RequestDeadline.for_mode(st.session_state.mode)
+    # 期限切れにより縮退した結果を使ったかどうか
+    degraded = False
+
+    # 1) 共有のチェーン（モデル名・温度は constants 側で集中管理）
+    #    - プロセス内で1度だけ組み立てたものを全セッションで共有（HTTPのコネクションプールも共有）
+    #    - 会話履歴・モードなどのリクエストごとの値は、実行時に渡す
+    registry = st.session_state.chain_registry
+    question_answer_chain = registry.question_answer_chains[st.session_state.mode]
+    # このリクエストで使うインデックス（途中でバックグラウンドの更新により差し替わっても、最後までこの版を使う）
+    snapshot = st.session_state.index_manager.current
+    logger.info(f"インデックスのバージョン: {snapshot.version}")
+    logger.info(f"OpenAI API の呼び出し状況: {describe_schedulers()}")
+
+    history_messages, history_tokens = st.session_state.chat_history.to_messages(
+        ct.CHAT_HISTORY_TOKEN_BUDGET[st.session_state.mode]
     )
+    llm_response = {
+        "input": chat_message,
+        "chat_history": history_messages,
+    }
 
-    # 3) モード別の本問合せプロンプト（文書検索 / 社内問い合わせ）
-    if st.session_state.mode == ct.ANSWER_MODE_1:
-        # 社内文書検索：関連がなければ「該当資料なし」を厳格に返す設計
-        question_answer_template = ct.SYSTEM_PROMPT_DOC_SEARCH
+    # 2) 「独立した質問」の生成（会話履歴がない場合は、入力をそのまま検索に使う）
+    speculation = None
+    if history_messages:
+        logger.info(
+            f"質問の言い換えに送信するトークン数: {history_tokens + count_tokens(chat_message)}"
+            f"（うち会話履歴: {history_tokens}、上限: {ct.CHAT_HISTORY_TOKEN_BUDGET[st.session_state.mode]}）"
+        )
+        # 言い換えの応答を待つ間に、入力文そのままで検索を始めておく
+        # （入力文で回答キャッシュにヒットする質問や、表形式データを対象とした質問は、検索結果を使わない見込みが高いため始めない）
+        if (
+            ct.SPECULATIVE_RETRIEVAL_ENABLED
+            and SpeculativeSearch.is_supported(snapshot.retriever)
+            and not is_answered_without_search(chat_message, registry, snapshot)
+        ):
+            speculation = SpeculativeSearch(snapshot.retriever, chat_message)
+        try:
+            standalone_question = deadline.run("rewrite", lambda: registry.question_generator_chain.invoke(llm_response))
+        except StageTimeout as e:
+            logger.warning(f"{e}。入力文をそのまま検索に使います")
+            standalone_question = chat_message
+            degraded = True
     else:
-        # 社内問い合わせ：文脈に基づき Markdown 詳細回答。必要に応じ一般情報も許容
-        question_answer_template = ct.SYSTEM_PROMPT_INQUIRY
-
-    question_answer_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", question_answer_template),
-            MessagesPlaceholder("chat_history"),
-            ("human", "{input}")
-        ]
-    )
+        standalone_question = chat_message
 
-    # 4) 履歴考慮リトリーバ + RAG チェーンを構築
-    #    - 「独立した質問」生成 → retriever で検索 → 文脈を stuff して回答生成、の流れ
-    history_aware_retriever = create_history_aware_retriever(
-        llm, st.session_state.retriever, question_generator_prompt
+    # 3) 回答キャッシュの確認
+    #    - キーにインデックスのバージョンを含めるため、データソースが変わった場合は自動的に無効になる
+    cache_key = build_cache_key(
+        st.session_state.mode,
+        standalone_question,
+        registry.model_settings(st.session_state.mode),
+        snapshot.version
     )
-    question_answer_chain = create_stuff_documents_chain(llm, question_answer_prompt)
-    chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
+    cached = st.session_state.answer_cache.get(cache_key)
+    if cached is not None:
+        if speculation is not None:
+            speculation.cancel()
+        llm_response.update(cached)
+        logger.info(f"回答キャッシュにヒットしました（{(time.perf_counter() - start) * 1000:.1f}ms）: {standalone_question}")
+    elif st.session_state.mode == ct.ANSWER_MODE_1 and ct.DOC_SEARCH_FAST_PATH:
+        # 社内文書検索：LLMに関連性を判定させず、関連度スコアで判定してファイルのありかを直接返す
+        docs, scores, lexical_match = retrieve(snapshot.retriever, standalone_question, deadline, speculation)
+        if scores is None and not docs:
+            # 期限内に検索できず、語彙検索の索引もない場合は、検索できなかった旨のみを返す（会話履歴にも残さない）
+            llm_response["context"] = []
+            llm_response["answer"] = ct.RETRIEVAL_TIMEOUT_ANSWER
+            return llm_response
+        # 縮退した場合（語彙検索のみ・検索サーバーのインデックスの更新直後。scores が None）は、スコアで判定できないため検索結果をそのまま返す
+        # 社員IDや会社名がそのまま一致した場合は、ベクトル検索のスコアが低くても該当ありとする
+        if scores is None or is_confident_match(scores, lexical_match):
+            llm_response["context"] = docs
+            llm_response["answer"] = ""
+        else:
+            llm_response["context"] = []
+            llm_response["answer"] = ct.NO_DOC_MATCH_ANSWER
+        logger.info(
+            f"社内文書検索をスコアで判定しました（{(time.perf_counter() - start) * 1000:.1f}ms, "
+            f"最大スコア: {scores[0] if scores else None}, 完全一致: {lexical_match}, 判定: {llm_response['answer'] or '該当あり'}）"
+        )
+        if not degraded and scores is not None:
+            st.session_state.answer_cache.put(cache_key, llm_response["answer"], llm_response["context"])
+    else:
+        # 社内問い合わせで表形式データ（社員名簿など）を対象とした質問の場合、
+        # ベクトル検索（上位k件）ではなく、テーブルの絞り込み・集計結果を文脈として回答を生成
+        table_context = None
+        if st.session_state.mode == ct.ANSWER_MODE_2:
+            table_context = snapshot.table_store.query(standalone_question)
 
-    # 5) チェーンを実行（input と chat_history を渡す）
-    llm_response = chain.invoke({
-        "input": chat_message,
-        "chat_history": st.session_state.chat_history
-    })
+        if table_context is not None:
+            if speculation is not None:
+                speculation.cancel()
+            logger.info(f"表形式データの集計結果を文脈として使用します: {table_context.metadata['source']}")
+            llm_response["context"] = [table_context]
+        else:
+            # 同じファイル・ページの連続するチャンクをまとめ、トークン数の上限に収まる分だけを文脈にする
+            docs, scores, _ = retrieve(snapshot.retriever, standalone_question, deadline, speculation)
+            if scores is None and not docs:
+                # 期限内に検索できず、語彙検索の索引もない場合は、文脈なしで回答を生成せず、検索できなかった旨のみを返す
+                llm_response["context"] = []
+                llm_response["answer"] = ct.RETRIEVAL_TIMEOUT_ANSWER
+                return llm_response
+            degraded = degraded or scores is None
+            llm_response["context"] = pack_context(docs, ct.CONTEXT_TOKEN_BUDGET[st.session_state.mode])
+
+        logger.info(
+            f"回答生成に送信するトークン数: {count_prompt_tokens(registry, llm_response, history_tokens)}"
+            f"（うち会話履歴: {history_tokens}）"
+        )
+
+        # 社内問い合わせのストリーミング時は、検索結果（参照元）を先に表示できるよう、ここで返す
+        if stream and st.session_state.mode == ct.ANSWER_MODE_2:
+            llm_response["answer_stream"] = stream_answer(
+                question_answer_chain, llm_response, None if degraded else cache_key, start, deadline
+            )
+            return llm_response
 
-    # 6) 会話履歴へ今回のターンを追加
-    #    - HumanMessage はオブジェクト、LLM 側は llm_response["answer"]（str）をそのまま保存。
-    #      ※ より厳密に型を揃えるなら AIMessage(content=...) を使う方法もある。
-    st.session_state.chat_history.extend([
-        HumanMessage(content=chat_message),
-        llm_response["answer"]
-    ])
+        try:
+            # 社内文書検索の判定は短い応答で冪等なため、遅い場合は同じ呼び出しをもう1つ送る
+            llm_response["answer"] = deadline.run(
+                "generate",
+                lambda: question_answer_chain.invoke(llm_response),
+                hedge=st.session_state.mode == ct.ANSWER_MODE_1,
+                track_as=f"generate:{st.session_state.mode}"
+            )
+        except StageTimeout as e:
+            # 社内文書検索は検索結果のファイル一覧のみ、社内問い合わせは参照元のみを表示する
+            logger.warning(f"{e}。検索結果のみを返します")
+            llm_response["answer"] = "" if st.session_state.mode == ct.ANSWER_MODE_1 else ct.GENERATION_TIMEOUT_ANSWER
+            degraded = True
+        logger.info(f"回答を返します（全体: {(time.perf_counter() - start) * 1000:.1f}ms）")
+        if not degraded:
+            st.session_state.answer_cache.put(cache_key, llm_response["answer"], llm_response["context"])
+
+    # 4) 会話履歴へ今回のターンを追加
+    add_chat_history(chat_message, llm_response["answer"])
 
     return llm_response
+
+
+def is_answered_without_search(chat_message, registry, snapshot):
+    """
+    入力文のままで、検索せずに回答できる見込みの質問か（回答キャッシュにヒットする・表形式データの集計で答える）
+
+    Args:
+        chat_message: ユーザーの入力文字列
+        registry: 共有のチェーン
+        snapshot: このリクエストで使うインデックス
+
+    Returns:
+        検索せずに回答できる見込みかどうか
+    """
+    mode = st.session_state.mode
+    cache_key = build_cache_key(mode, chat_message, registry.model_settings(mode), snapshot.version)
+    if st.session_state.answer_cache.get(cache_key) is not None:
+        return True
+    return mode == ct.ANSWER_MODE_2 and snapshot.table_store.query(chat_message) is not None
+
+
+def retrieve(retriever, query, deadline, speculation=None):
+    """
+    検索の実行（言い換えと並行して先に検索している場合は、その結果を使うか検索し直すかを判定する）
+    - クエリのベクトル化は冪等なため、遅い場合は同じ呼び出しをもう1つ送る
+    - ベクトル化・検索が期限内に終わらない場合は、語彙検索のみの結果を使う
+      （語彙検索の索引がない場合（ベクトル検索のみの設定・検索サーバーを使う場合）は、検索結果なしとする）
+    - 検索サーバーのインデックスのバージョンが変わっていた場合は、最新のインデックスで検索し直す
+      （回答キャッシュのキーのバージョンと異なる結果のため、縮退した結果として扱う）
+
+    Args:
+        retriever: このリクエストで使うRetriever
+        query: 検索クエリ（言い換え後の質問）
+        deadline: このリクエストの RequestDeadline
+        speculation: 入力文そのままで先に開始した SpeculativeSearch（ない場合は None）
+
+    Returns:
+        (ドキュメントのリスト, ベクトル検索の関連度スコアのリスト（降順。縮退した場合は None）,
+         語彙検索で完全一致した語があるか)
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    try:
+        try:
+            if speculation is not None:
+                return deadline.run("retrieve", lambda: speculation.resolve(query))
+            if hasattr(retriever, "embed_query"):
+                query_embedding = deadline.run("embed", lambda: retriever.embed_query(query), hedge=True)
+                return deadline.run("retrieve", lambda: retriever.search_with_scores(query, query_embedding=query_embedding))
+            return deadline.run("retrieve", lambda: search_with_scores(retriever, query))
+        except IndexVersionChanged as e:
+            logger.warning(f"{e}。最新のインデックスで検索し直します（回答キャッシュには保存しません）")
+            st.session_state.index_manager.expire()
+            latest = retriever.copy(update={"version": None})
+            docs, _, lexical_match = deadline.run("retrieve", lambda: latest.search_with_scores(query))
+            return docs, None, lexical_match
+    except StageTimeout as e:
+        lexical_index = getattr(retriever, "lexical_index", None)
+        if lexical_index is None:
+            logger.warning(f"{e}。語彙検索の索引がないため、検索結果なしとして扱います")
+            return [], None, False
+        logger.warning(f"{e}。語彙検索のみの結果を使います")
+        return [doc for doc, _ in lexical_index.search(query, retriever.k)], None, False
+
+
+def stream_answer(question_answer_chain, llm_response, cache_key, start, deadline):
+    """
+    回答本文をトークン単位で順次返し、読み切った時点で回答キャッシュと会話履歴に反映する
+    - 期限内に読み切れない場合は、途中までの回答（何も届いていなければ参照元のみ）を返し、回答キャッシュには保存しない
+
+    Args:
+        question_answer_chain: 本問合せチェーン
+        llm_response: get_llm_response が返す辞書（読み切った時点で answer を設定する）
+        cache_key: 回答キャッシュのキー（None の場合は保存しない）
+        start: get_llm_response の開始時刻（最初のトークンまでの時間の計測用）
+        deadline: このリクエストの RequestDeadline
+
+    Yields:
+        回答本文の断片
+    """
+    logger = logging.getLogger(ct.LOGGER_NAME)
+
+    chunks = []
+    try:
+        for chunk in deadline.iterate("generate", question_answer_chain.stream(llm_response)):
+            if not chunks:
+                logger.info(f"最初のトークンまでの時間: {(time.perf_counter() - start) * 1000:.1f}ms")
+            chunks.append(chunk)
+            yield chunk
+    except StageTimeout as e:
+        logger.warning(f"{e}。{'途中までの回答' if chunks else '参照元のみ'}を返します")
+        chunk = "\n\n" + ct.GENERATION_TIMEOUT_NOTE if chunks else ct.GENERATION_TIMEOUT_ANSWER
+        chunks.append(chunk)
+        yield chunk
+        cache_key = None
+
+    llm_response["answer"] = "".join(chunks)
+    logger.info(f"回答の生成が完了しました（{(time.perf_counter() - start) * 1000:.1f}ms）")
+    if cache_key is not None:
+        st.session_state.answer_cache.put(cache_key, llm_response["answer"], llm_response["context"])
+    add_chat_history(llm_response["input"], llm_response["answer"])
+
+
+def count_prompt_tokens(registry, llm_response, history_tokens):
+    """
+    回答生成で送信するトークン数（システムプロンプト + 会話履歴 + 入力 + 文脈）
+
+    Args:
+        registry: 共有のチェーン
+        llm_response: get_llm_response が作成中の辞書（input, context を含む）
+        history_tokens: 会話履歴のトークン数
+
+    Returns:
+        トークン数
+    """
+    system_prompt = registry.question_answer_templates[st.session_state.mode]
+    context_tokens = sum(count_tokens(doc.page_content) for doc in llm_response["context"])
+    return count_tokens(system_prompt) + history_tokens + count_tokens(llm_response["input"]) + context_tokens
+
+
+def add_chat_history(chat_message, answer):
+    """
+    会話履歴へ今回のターンを追加（直近のターン数を超えた古いターンは、別スレッドで要約に畳み込む）
+
+    Args:
+        chat_message: ユーザーの入力文字列
+        answer: LLMの回答本文
+    """
+    st.session_state.chat_history.add_turn(
+        chat_message,
+        answer,
+        summarizer=st.session_state.chain_registry.history_summary_chain
+    )